@@ -0,0 +1,100 @@
+"""
+This script evaluates densely sampled candidate trajectories instead of the fiducials of the .fcsv files: entry points just outside the surface of the cortex and target points inside the target structure (the right hippocampus).
+The volumes, meshes and intersection backends of the chosen set are loaded by `src.modules.dataset.load`, like in planner_daemon.py.
+
+The N x M pairs (10^6 to 10^8 of them) are never listed: they are evaluated in blocks of entries, sized by `run_chunked` from the measured throughput, and the reason bits of each block are written to a memory-mapped (N, M) uint8 .npy file, so only the blocks being evaluated are in memory.
+For example, about 10^8 pairs:
+    python dense_sampling.py --set actual --entries 20000 --targets 5000
+or a density, in entries per mm² of cortex and targets per mm³ of hippocampus:
+    python dense_sampling.py --set testset --entry-density 0.05 --target-density 0.5
+"""
+
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+from src.config import SETS, MAX_LENGTH, ELECTRODE_RADIUS
+from src.modules.dataset import load
+from src.utils.candidates import PairGrid, sample_surface, sample_mask, surface_area, mask_volume
+from src.utils.exclusion import pair_reasons, combination_counts, REASONS
+from src.utils.scheduler import run_chunked
+
+# voxels, the distance of the entries from the surface of the cortex: a segment starting on it is not counted as
+# crossing it, and would pass constraint (d) unchecked (see `sample_surface`)
+ENTRY_OFFSET = 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--set", choices=SETS, default="testset")
+    entries = parser.add_mutually_exclusive_group()
+    entries.add_argument("--entries", type=int, help="number of entry points (default 2000)")
+    entries.add_argument("--entry-density", type=float, help="entry points per mm² of cortex")
+    targets = parser.add_mutually_exclusive_group()
+    targets.add_argument("--targets", type=int, help="number of target points (default 500)")
+    targets.add_argument("--target-density", type=float, help="target points per mm³ of the target structure")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="default: dense_reasons_<set>.npz and .npy")
+    args = parser.parse_args()
+
+    _, target, cortex = SETS[args.set]
+    data = load(args.set)
+    backends, spacing = data.backends, data.spacing
+    output = args.output or Path(f"dense_reasons_{args.set}")
+
+    # sample the candidates
+    rng = np.random.default_rng(args.seed)
+    n_entries = args.entries or 2000
+    if args.entry_density is not None:
+        n_entries = max(1, round(args.entry_density * surface_area(data.meshes[cortex], spacing)))
+    n_targets = args.targets or 500
+    if args.target_density is not None:
+        n_targets = max(1, round(args.target_density * mask_volume(data.masks[target], spacing)))
+    pairs = PairGrid(
+        sample_surface(data.meshes[cortex], n_entries, rng, offset=ENTRY_OFFSET, mask=data.masks[cortex]),
+        sample_mask(data.masks[target], n_targets, rng),
+    )
+    print(f"{len(pairs)} candidate pairs: {n_entries} entries on {cortex} x {n_targets} targets in {target}")
+    # the backends were culled to the fiducials of the main script, cull them once for all the candidates instead of
+    # block by block (see `SweepBackend`)
+    points = np.concatenate([pairs.entries, pairs.targets])
+    for name in (target, "ventricles_vessels", cortex):
+        backends[name].cover(points, ELECTRODE_RADIUS if name == "ventricles_vessels" else 0.0, spacing)
+
+    # stream through the blocks of entries; the kernels release the GIL, so threads share the backends
+    reasons = np.lib.format.open_memmap(output.with_suffix(".npy"), mode="w+", dtype=np.uint8, shape=(n_entries, n_targets))
+
+    def evaluate_entries(start, end):
+        block = pair_reasons(
+            pairs.entries[start:end],
+            pairs.targets,
+            spacing,
+            backends[target],
+            backends["ventricles_vessels"],
+            data.cortex_angles,
+            MAX_LENGTH,
+            radius=ELECTRODE_RADIUS,
+        )
+        reasons[start:end] = block
+        return np.bincount(block.ravel(), minlength=256)[None]  # only the histogram goes back
+
+    start = perf_counter()
+    workers = mp.cpu_count()
+    with ThreadPoolExecutor(workers) as executor:
+        counts = run_chunked(evaluate_entries, n_entries, executor, workers, target_seconds=0.5, first_chunk=1).sum(axis=0)
+    reasons.flush()
+    elapsed = perf_counter() - start
+
+    np.savez(output.with_suffix(".npz"), entries=pairs.entries, targets=pairs.targets, counts=counts)
+    print(f"Evaluated {len(pairs)} pairs in {elapsed:.1f} s ({len(pairs) / elapsed:.0f} pairs/s), reasons saved in {output.with_suffix('.npy')}")
+    print(f"Valid pairs: {counts[0]} ({counts[0] / len(pairs):.2%})")
+    for bit, label in REASONS.items():
+        print(f"{label}: {counts[np.arange(256) & bit != 0].sum()}")
+    for combination, count in combination_counts(counts=counts).items():
+        print(f"{' & '.join(combination) or 'valid'}: {count}")
+
+
+if __name__ == "__main__":
+    main()
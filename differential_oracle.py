@@ -0,0 +1,56 @@
+"""
+This script checks that every intersection engine (the numba kernels, the BVH and its packet, batch and bricked queries, the component, box and sweep culling, the VTK locators) gives exactly the answers of the brute-force `check_intersect` and `check_angle_of_intersection`.
+First on random phantoms (smooth blobs, staircase voxel surfaces, triangle soups) and segments through their vertices and edges, along the axes, in the plane of a face, ending on a face or of zero length, all on a dyadic grid so that the arithmetic is exact: every disagreement is shrunk to a minimal reproducer and printed.
+Then on a random sample of the pairs of the chosen set, on the meshes of the target, the critical structures and the cortex; there the disagreements of pairs within rounding of the limits of a face (e.g. t ≈ 1) are counted as ties.
+
+Usage:
+    python differential_oracle.py --set testset --phantoms 5 --segments 50 --pairs 300
+"""
+
+import argparse
+from time import perf_counter
+import numpy as np
+from src.config import SETS
+from src.modules.dataset import load
+from src.utils.oracle import ENGINES, APPROXIMATE_ENGINES, run_campaign, reproducer, agreement
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--set", choices=SETS, default="testset")
+    parser.add_argument("--phantoms", type=int, default=5, help="phantoms of each kind")
+    parser.add_argument("--segments", type=int, default=50, help="segments of each kind per phantom")
+    parser.add_argument("--pairs", type=int, default=300, help="pairs of the set checked (0 to skip)")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    start = perf_counter()
+    report, reproducers = run_campaign(args.phantoms, args.segments, rng, args.engines)
+    print(f"Phantoms checked in {perf_counter() - start:.1f} s, disagreements per kind of segment:")
+    print(report.to_string(index=False))
+    for name, cases in reproducers.items():
+        for case in cases:
+            print(reproducer(name, *case))
+
+    if args.pairs:
+        _, target, cortex = SETS[args.set]
+        data = load(args.set)
+        entries, targets = data.entries_idx, data.targets_idx
+        pairs = rng.choice(len(entries) * len(targets), size=min(args.pairs, len(entries) * len(targets)), replace=False)
+        p1s, p2s = entries[pairs // len(targets)], targets[pairs % len(targets)]
+        meshes = {i: data.meshes[i] for i in (target, "ventricles_vessels", cortex)}
+
+        start = perf_counter()
+        table = agreement(meshes, p1s, p2s, args.engines)
+        print(f"{len(pairs)} pairs of the {args.set} checked in {perf_counter() - start:.1f} s:")
+        print(table.to_string(index=False))
+        report = report[~report["engine"].isin(APPROXIMATE_ENGINES)]
+        table = table[~table["engine"].isin(APPROXIMATE_ENGINES)]
+        failed = report.iloc[:-1, 1:].to_numpy().sum() + table["disagree"].sum()
+        print("All the exact engines agree with the brute force" if not failed else f"{failed} disagreements")
+
+
+if __name__ == "__main__":
+    main()
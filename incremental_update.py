@@ -0,0 +1,41 @@
+"""
+This script updates the evaluation after a local edit of the segmentation of the ventricles or vessels, e.g. a few slices touched up in 3D Slicer and saved again, instead of meshing and evaluating everything again.
+It sends the edited file to a running planner_daemon.py (started with --port), which keeps the volumes, the meshes and the reasons of the chosen set loaded, so the update pays for neither the startup nor a full meshing.
+
+The daemon keeps the critical structures as a `src.modules.incremental.IncrementalSurface`. The edited file is compared with the current mask brick by brick: only the bricks around the changed voxels are meshed again and spliced into the mesh, the BVH that the daemon queries rebuilds their subtrees and refits its top levels, and only the pairs whose segment passes through the changed region are evaluated again; their reasons stay in the daemon (exclusion_reasons_<set>.npz keeps those of the volumes on disk).
+
+Usage:
+    python planner_daemon.py --set testset --port 8765
+    python incremental_update.py --port 8765 --structure vesselsTestDilate1.nii.gz --edited edited/vesselsTestDilate1.nii.gz
+"""
+
+import argparse
+import json
+import socket
+from pathlib import Path
+from time import perf_counter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, required=True, help="the local TCP port of planner_daemon.py")
+    parser.add_argument("--structure", required=True, help="the name of the edited structure, e.g. vessels.nii.gz")
+    parser.add_argument("--edited", type=Path, required=True, help="the edited segmentation of the structure (.nii.gz)")
+    args = parser.parse_args()
+
+    request = {"op": "update", "structure": args.structure, "path": str(args.edited.resolve())}
+    start = perf_counter()
+    with socket.create_connection(("127.0.0.1", args.port)) as connection:
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        response = json.loads(connection.makefile("rb").readline())
+    if not response["ok"]:
+        raise SystemExit(response["error"])
+
+    result = response["result"]
+    print(f"{result['dirty_regions']} dirty regions meshed again and spliced: {result['faces']} faces")
+    print(f"{result['pairs_evaluated']} pairs evaluated again, {result['valid_pairs']} valid pairs in the daemon")
+    print(f"Updated in {response['latency_ms'] / 1000:.3f} s ({perf_counter() - start:.3f} s with the request)")
+
+
+if __name__ == "__main__":
+    main()
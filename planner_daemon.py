@@ -0,0 +1,129 @@
+"""
+This script keeps a planner running so that trajectories can be checked interactively, e.g. while moving fiducials in 3D Slicer.
+The volumes, meshes, intersection backends and compiled kernels are loaded once (by `src.modules.dataset.load`), then every request is answered in milliseconds.
+
+Requests and responses are one JSON object per line, read from stdin and written to stdout, or over a local TCP socket with --port.
+The points are in world coordinates, like the .fcsv files. For example:
+    {"id": 1, "op": "evaluate", "entry": [x, y, z], "target": [x, y, z]}
+    {"id": 2, "op": "best_target", "entry": [x, y, z]}
+    {"id": 3, "op": "rescore", "trajectories": [[[x, y, z], [x, y, z]], ...], "k": 5}
+    {"id": 4, "op": "stats"}
+The "stats" request returns the latency histogram of each kind of request. See `src.modules.planner.Planner.handle`.
+
+The ventricles and vessels are kept as an `IncrementalSurface`, so their segmentation can be edited while the planner runs:
+    {"id": 5, "op": "edit", "lower": [i, j, k], "values": [[[0, 1, ...], ...], ...]}
+writes a block of voxels (in numpy indices) into their mask, and
+    {"id": 6, "op": "update", "structure": "vessels.nii.gz", "path": "/abs/path/edited/vessels.nii.gz"}
+replaces one of them by its segmentation saved again (see incremental_update.py). Either way only the bricks around the
+changed voxels are meshed again, the BVH that the requests query is refit, and the reasons of the pairs of the
+fiducials whose segment passes through the changed region are evaluated again. Those reasons are kept in memory only:
+the edits are not saved to the volumes, so exclusion_reasons_<set>.npz keeps the reasons of the masks on disk.
+"""
+
+import argparse
+import json
+import socketserver
+import sys
+import threading
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+from src.modules.planner import Planner
+from src.config import SETS, MAX_LENGTH, ELECTRODE_RADIUS
+from src.modules.dataset import load
+from src.modules.incremental import IncrementalSurface
+from src.modules.volumes import VolumeStore, union_masks
+from src.utils.exclusion import CRITICAL, constraint_reasons, update_reasons
+
+
+def build_planner(name: str, brick: int = 16) -> Planner:
+    data = load(name)  # loads the volumes, meshes and backends, and warms the kernels up
+    surface = IncrementalSurface(data.masks["ventricles_vessels"], brick=brick, memory_budget=data.memory_budget)
+    planner = Planner(
+        data.backends[data.target],
+        surface.backend,
+        data.cortex_angles,
+        data.reference_image,
+        targets=data.targets_coords,
+        target_ids=data.targets.content_df["id"].tolist(),
+        max_length=MAX_LENGTH,
+        radius=ELECTRODE_RADIUS,
+        surface=surface,
+    )
+    # the reasons of the pairs of the fiducials, with constraint (a) evaluated on the mesh of the surface: the pairs
+    # through the edits are evaluated on it again, so an edit and its undo give back the same reasons
+    reasons = data.saved_reasons() & ~CRITICAL
+    tested = data.graph.result("prefilter")["test_critical"]
+    reasons |= constraint_reasons(CRITICAL, surface.backend, data.entries_idx, data.targets_idx, tested, radius=ELECTRODE_RADIUS, spacing=data.spacing)
+
+    def refresh(boxes) -> dict:
+        # the reasons of the pairs through the dirty regions, evaluated again with the refit BVH (in memory only)
+        affected = update_reasons(reasons, CRITICAL, surface.backend, data.entries_idx, data.targets_idx, boxes, radius=ELECTRODE_RADIUS, spacing=data.spacing)
+        return {
+            "dirty_regions": len(boxes),
+            "faces": len(surface.mesh.faces),
+            "pairs_evaluated": int(np.count_nonzero(affected)),
+            "valid_pairs": int(np.count_nonzero(reasons == 0)),
+        }
+
+    def update_request(request):
+        if request["structure"] not in data.critical:
+            raise ValueError(f"Unknown structure {request['structure']!r}, expected one of {list(data.critical)}")
+        path = Path(request["path"])
+        data.masks[request["structure"]] = VolumeStore(path.parent, memory_budget=data.memory_budget).mask(path.name)
+        return refresh(planner.update(union_masks(*(data.masks[i] for i in data.critical))))
+
+    planner.operations["edit"] = lambda request: refresh(planner.edit(request["lower"], request["values"]))
+    planner.operations["update"] = update_request
+    return planner
+
+
+def answer(planner: Planner, line: str) -> str:
+    try:
+        request = json.loads(line)
+    except json.JSONDecodeError as error:
+        return json.dumps({"ok": False, "error": f"JSONDecodeError: {error}"})
+    return json.dumps(planner.handle(request))
+
+
+def serve_stdin(planner: Planner):
+    for line in sys.stdin:
+        if line.strip():
+            print(answer(planner, line), flush=True)
+
+
+def serve_socket(planner: Planner, port: int):
+    lock = threading.Lock()  # one request at a time, the kernels use all the time they get anyway
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    with lock:
+                        response = answer(planner, line.decode())
+                    self.wfile.write(response.encode() + b"\n")
+
+    with socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler) as server:
+        server.daemon_threads = True
+        print(f"Listening on 127.0.0.1:{port}", file=sys.stderr)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--set", choices=list(SETS), default="testset", help="the data set to load")
+    parser.add_argument("--port", type=int, help="listen on this local TCP port instead of reading stdin")
+    parser.add_argument("--brick", type=int, default=16, help="the side of the bricks of the ventricles and vessels, in cubes")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    planner = build_planner(args.set, args.brick)
+    # the first request of each kind must not pay for anything that was not loaded yet
+    planner.best_target(planner.targets[0])
+    planner.latency.clear()
+    print(f"Planner ready in {perf_counter() - start:.3f}s", file=sys.stderr)
+
+    if args.port is None:
+        serve_stdin(planner)
+    else:
+        serve_socket(planner, args.port)
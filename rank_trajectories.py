@@ -0,0 +1,72 @@
+"""
+This script ranks the valid trajectories on several objectives at once: the clearance to the vessels and to the ventricles, the length, and the angle to the normal of the cortex where the trajectory enters it.
+The objectives of every valid pair are computed as the columns of one array (see `src.utils.pareto.trajectory_objectives`); the trajectories are sorted into Pareto fronts by a non-dominated sort, and those of a front by the weighted sum of their normalised objectives.
+The valid pairs are those saved by the main script of the chosen set (evaluated here otherwise), or with --dense those saved by dense_sampling.py.
+
+Usage:
+    python rank_trajectories.py --set testset --weights 1 1 0.5 0.5 --top 20
+    python rank_trajectories.py --set actual --dense dense_reasons_actual
+"""
+
+import argparse
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas
+from src.config import SETS, CRITICAL_STRUCTURES
+from src.modules.dataset import load
+from src.modules.distance_field import DistanceField
+from src.utils.pareto import OBJECTIVES, trajectory_objectives, rank_trajectories
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--set", choices=SETS, default="testset")
+    parser.add_argument("--weights", type=float, nargs=len(OBJECTIVES), default=[1.0] * len(OBJECTIVES), help=f"weights of {', '.join(OBJECTIVES)}")
+    parser.add_argument("--top", type=int, default=20, help="number of trajectories to print")
+    parser.add_argument("--max-distance", type=float, default=10.0, help="clearances are clipped at this distance in mm")
+    parser.add_argument("--dense", type=Path, default=None, help="the output of dense_sampling.py, without suffix")
+    parser.add_argument("--output", type=Path, default=None, help="save the ranking of all the valid trajectories (.csv)")
+    args = parser.parse_args()
+
+    _, target, cortex = SETS[args.set]
+    data = load(args.set)
+    masks, backends, spacing = data.masks, data.backends, data.spacing
+
+    if args.dense is not None:
+        reasons = np.load(args.dense.with_suffix(".npy"), mmap_mode="r")
+        points = np.load(args.dense.with_suffix(".npz"))
+        valid = np.concatenate([np.argwhere(reasons[i : i + 1024] == 0) + [i, 0] for i in range(0, len(reasons), 1024)])
+        entries, targets = points["entries"][valid[:, 0]], points["targets"][valid[:, 1]]
+        entry_ids, target_ids = valid[:, 0], valid[:, 1]
+    else:
+        reasons = data.saved_reasons()
+        valid = np.argwhere(reasons == 0)
+        entries = data.entries_idx[valid[:, 0]]
+        targets = data.targets_idx[valid[:, 1]]
+        entry_ids = data.entries.content_df["id"].to_numpy()[valid[:, 0]]
+        target_ids = data.targets.content_df["id"].to_numpy()[valid[:, 1]]
+
+    start = perf_counter()
+    ventricles, vessels = (DistanceField(masks[i], spacing, args.max_distance, data.memory_budget) for i in CRITICAL_STRUCTURES[args.set])
+    fields = perf_counter()
+    objectives = trajectory_objectives(entries, targets, spacing, vessels, ventricles, data.cortex_angles)
+    computed = perf_counter()
+    order, fronts, scores = rank_trajectories(objectives, args.weights)
+    end = perf_counter()
+    print(f"Distance fields of the vessels and ventricles in {fields - start:.2f} s")
+    print(f"Objectives of {len(valid)} valid trajectories in {computed - fields:.3f} s, ranked in {end - computed:.3f} s")
+    print(f"{np.count_nonzero(fronts == 0)} trajectories on the Pareto front, {fronts.max(initial=-1) + 1} fronts")
+
+    table = pandas.DataFrame({"entry_id": entry_ids, "target_id": target_ids, "front": fronts, "score": scores})
+    for name, column in zip(OBJECTIVES, objectives.T):
+        table[name] = column
+    table = table.iloc[order]
+    print(table.head(args.top).to_string(index=False))
+    if args.output is not None:
+        table.to_csv(args.output, index=False)
+        print(f"Saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+This script checks how robust the best valid trajectories are to registration and placement errors (Monte Carlo).
+The valid pairs are those saved by the main script of the chosen set (evaluated here otherwise); the top ones, ranked by their clearance to the ventricles and vessels, are perturbed many times and every perturbed trajectory is checked against the hard constraints and scored for clearance, in one batched, parallel evaluation.
+
+Usage:
+    python robust_trajectories.py --set testset --top 10 --samples 1000 --entry-error 1.5 --target-error 1.0 --model normal
+"""
+
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import numpy as np
+import pandas
+from src.config import SETS, MAX_LENGTH, ELECTRODE_RADIUS
+from src.modules.dataset import load
+from src.modules.distance_field import DistanceField
+from src.utils.exclusion import reason_counts
+from src.utils.robustness import ERROR_MODELS, robustness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--set", choices=SETS, default="testset")
+    parser.add_argument("--top", type=int, default=10, help="number of trajectories to check")
+    parser.add_argument("--samples", type=int, default=1000, help="perturbations of each trajectory")
+    parser.add_argument("--entry-error", type=float, default=1.0, help="error of the entry points in mm")
+    parser.add_argument("--target-error", type=float, default=1.0, help="error of the target points in mm")
+    parser.add_argument("--model", choices=ERROR_MODELS, default="normal")
+    parser.add_argument("--min-clearance", type=float, default=0.0, help="minimum distance to the critical structures in mm")
+    parser.add_argument("--max-distance", type=float, default=10.0, help="clearances are clipped at this distance in mm")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    _, target, cortex = SETS[args.set]
+    data = load(args.set)
+    backends, spacing = data.backends, data.spacing
+
+    reasons = data.saved_reasons()
+    valid = np.argwhere(reasons == 0)
+    entries = data.entries_idx[valid[:, 0]]
+    targets = data.targets_idx[valid[:, 1]]
+
+    # rank the valid trajectories by their clearance, the shortest first among equals
+    start = perf_counter()
+    field = DistanceField(data.masks["ventricles_vessels"], spacing, args.max_distance, data.memory_budget)
+    clearance = field.segment_clearance(entries, targets)
+    lengths = np.linalg.norm((targets - entries) * np.asarray(spacing), axis=1)
+    top = np.lexsort((lengths, -clearance))[: args.top]
+    print(f"Distance field {field.array.shape} and clearance of {len(valid)} valid trajectories in {perf_counter() - start:.2f} s")
+
+    start = perf_counter()
+    workers = mp.cpu_count()
+    with ThreadPoolExecutor(workers) as executor:
+        result = robustness(
+            entries[top],
+            targets[top],
+            spacing,
+            backends[target],
+            backends["ventricles_vessels"],
+            data.cortex_angles,
+            field,
+            executor,
+            workers,
+            n_samples=args.samples,
+            entry_error=args.entry_error,
+            target_error=args.target_error,
+            model=args.model,
+            min_clearance=args.min_clearance,
+            max_length=MAX_LENGTH,
+            radius=ELECTRODE_RADIUS,
+            rng=np.random.default_rng(args.seed),
+        )
+    elapsed = perf_counter() - start
+    print(f"Evaluated {len(top) * args.samples} perturbed trajectories in {elapsed:.2f} s")
+
+    table = pandas.DataFrame(
+        {
+            "entry_id": data.entries.content_df["id"].to_numpy()[valid[top, 0]],
+            "target_id": data.targets.content_df["id"].to_numpy()[valid[top, 1]],
+            "length_mm": lengths[top],
+            "clearance_mm": result["clearance"],
+            "clearance_p05_mm": result["clearance_p05"],
+            "valid_fraction": result["valid_fraction"],
+            "safe_fraction": result["safe_fraction"],
+            "most_violated": [max(reason_counts(i).items(), key=lambda j: j[1])[0] if i.any() else "" for i in result["reasons"]],
+        }
+    )
+    print(table.sort_values(["safe_fraction", "clearance_mm"], ascending=False).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,59 +3,57 @@ This script is used to check the source of exclusion for the test set.
 I.e., if the entry-target pair is excluded because it is in the ventricles or vessels, or because it is too shear the cortex.
 """
 
-import json
+import numpy as np
 from matplotlib import pyplot as plt
 from supervenn import supervenn
-from src.utils.marching_cubes import check_intersect, check_angle_of_intersection
-from main_testset import images_meshes, entries_targets_combs
+from src.utils.marching_cubes import intersected_component
+from src.utils.exclusion import CRITICAL, reason_counts, combination_counts, reason_sets
+from src.modules.dataset import load
+from src.utils.scheduler import run_chunked
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing as mp
-from tqdm import tqdm
-import os
-
-
-def check_source_validity(entry_target_tuple):
-    entry, target = entry_target_tuple
-    conditions = []
-    if not check_intersect(
-        entry, target, verts=images_meshes["r_hippoTest.nii.gz"]["verts"], faces=images_meshes["r_hippoTest.nii.gz"]["faces"]
-    ):
-        conditions.append("not intersect with hippo campus")
-    if check_angle_of_intersection(
-        entry, target, verts=images_meshes["r_cortexTest.nii.gz"]["verts"], faces=images_meshes["r_cortexTest.nii.gz"]["faces"]
-    ) > (90 - 55):
-        conditions.append("too shear cortex")
-    if check_intersect(
-        entry, target, verts=images_meshes["ventricles_vessels"]["verts"], faces=images_meshes["ventricles_vessels"]["faces"]
-    ):
-        conditions.append("in vessels or ventricles")
-    return conditions
-
-
-# check source of exclusion for the first time (takes a while)
-if not os.path.exists("sources.json"):
-    with mp.Pool(mp.cpu_count()) as pool:
-        sources = list(tqdm(pool.imap(check_source_validity, entries_targets_combs), total=len(entries_targets_combs)))
-
-    with open("sources.json", "w") as writer:
-        json.dump(sources, writer)
-else:
-    with open("sources.json", "r") as reader:
-        sources = json.load(reader)
-
-# visualize the sources of exclusion using circles
-sources = [set(i) for i in sources]
-not_intersect_with_hippo_campus = set([index for index, i in enumerate(sources) if "not intersect with hippo campus" in i])
-too_shear_cortex = set([index for index, i in enumerate(sources) if "too shear cortex" in i])
-in_vessels_or_ventricles = set([index for index, i in enumerate(sources) if "in vessels or ventricles" in i])
-
-supervenn(
-    [
-        not_intersect_with_hippo_campus,
-        too_shear_cortex,
-        in_vessels_or_ventricles,
-    ],
-    ["not intersect with hippo campus", "too shear cortex", "in vessels or ventricles"],
-    side_plots=False,
-)
+from pathlib import Path
+
+
+def check_source_components(start, end):
+    # the components hit by the pairs start to end (excluded) of excluded_pairs
+    return np.array(
+        [intersected_component(*data.pairs[k], data.meshes["ventricles_vessels"]) for k in excluded_pairs[start:end]], dtype=np.int32
+    )
+
+
+data = load("testset")
+# the reasons of exclusion of every pair, one bit per constraint, as saved by main_testset.py (computed here otherwise)
+reasons = data.saved_reasons()
+
+print("Number of pairs excluded by each constraint:")
+[print(f"{i}: {j}") for i, j in reason_counts(reasons).items()]
+print("Number of pairs excluded by exactly each combination of constraints:")
+[print(f"{' & '.join(i) or 'valid'}: {j}") for i, j in combination_counts(reasons).items()]
+
+# which connected component of the ventricles and vessels (e.g. which vessel) excluded the pairs, cached under .cache/
+# for the reasons file they were computed from, like the masks of `VolumeStore`: a new version of it replaces them
+stat = data.reasons_path.stat()
+components_path = Path(".cache", "source_components", f"{data.reasons_path.stem}.{stat.st_size}.{stat.st_mtime_ns}.npy")
+if not components_path.exists():
+    excluded_pairs = np.flatnonzero(reasons.ravel() & CRITICAL)
+    # the kernel releases the GIL, so the threads share the mesh
+    with ThreadPoolExecutor(mp.cpu_count()) as pool:
+        components = run_chunked(check_source_components, len(excluded_pairs), pool, mp.cpu_count())
+    components_path.parent.mkdir(parents=True, exist_ok=True)
+    for old in components_path.parent.glob(f"{data.reasons_path.stem}.*"):
+        old.unlink()
+    np.save(components_path, components.astype(np.int32))
+
+components = np.load(components_path)
+component_hits = np.bincount(components[components >= 0], minlength=len(data.meshes["ventricles_vessels"].component_ranges))
+print("Components of the ventricles and vessels excluding the most pairs:")
+for component in np.argsort(component_hits)[::-1][:10]:
+    lower, upper = data.meshes["ventricles_vessels"].component_bounds[component]
+    print(f"component {component}: {component_hits[component]} pairs, bounding box {lower} - {upper}")
+
+# visualize the sources of exclusion
+sets = reason_sets(reasons)
+supervenn(list(sets.values()), list(sets), side_plots=False)
 
 plt.show()
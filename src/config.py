@@ -0,0 +1,50 @@
+"""
+Settings shared by the main scripts: the data sets, then settings that can each be overridden with an environment variable
+of the same name, e.g. `INTERSECTION_BACKEND=vtk_cell_locator python main_testset.py`.
+"""
+
+import os
+from pathlib import Path
+
+# the folder of the volumes of each set and the names of its target and cortex structures (see `src.modules.dataset`)
+SETS = {
+    "testset": (Path("week-2", "practicals", "TestSet"), "r_hippoTest.nii.gz", "r_cortexTest.nii.gz"),
+    "actual": (Path("week-2", "practicals", "BrainParcellation"), "r_hippo.nii.gz", "cortex.nii.gz"),
+}
+# the structures making up "ventricles_vessels" in each set: the ventricles and the vessels
+CRITICAL_STRUCTURES = {
+    "testset": ("ventriclesTest.nii.gz", "vesselsTestDilate1.nii.gz"),
+    "actual": ("ventricles.nii.gz", "vessels.nii.gz"),
+}
+
+# mm, constraint (c); None disables it as the threshold is not specified
+MAX_LENGTH = float(os.environ["MAX_LENGTH"]) if os.environ.get("MAX_LENGTH") else None
+
+# the "segment vs surface" queries, one of the names in `src.modules.backends.BACKENDS`
+INTERSECTION_BACKEND = os.environ.get("INTERSECTION_BACKEND", "bvh")
+
+# how the pairs are evaluated: "packet" answers the queries of one entry and all its candidate targets together (see
+# `IntersectionBackend.intersects_packet`), "single" answers those of ranges of pairs together, pair by pair (see
+# `IntersectionBackend.intersects_batch`)
+QUERY_MODE = os.environ.get("QUERY_MODE", "packet")
+
+# mm, the radius of the electrode for constraint (a): with a radius > 0 the trajectory is a capsule that must stay at
+# least this far from the critical structures; 0 checks the line only
+ELECTRODE_RADIUS = float(os.environ.get("ELECTRODE_RADIUS", 0))
+
+# MB, the memory available to the volume layer: with a budget, the volumes are streamed into memory-mapped files and
+# meshed brick by brick (see `src.modules.bricks`), so the peak memory no longer grows with the size of the volumes;
+# None keeps them in memory
+MEMORY_BUDGET_MB = float(os.environ["MEMORY_BUDGET_MB"]) if os.environ.get("MEMORY_BUDGET_MB") else None
+
+# cull each mesh to the triangles inside the convex hull of the entries and targets before building its backend (see
+# `src.modules.sweep.SweepBackend`); "0" builds the backends on the whole meshes
+SWEEP_CULLING = os.environ.get("SWEEP_CULLING", "1") != "0"
+
+# how the angle of constraint (d) is measured: "mesh" with the normal of the first crossed triangle of the cortex (see
+# `IntersectionBackend.angle`), "field" with the smoothed normal field of the cortex mask where the trajectory first
+# crosses it (see `src.modules.normal_field.NormalField`), without its mesh
+CORTEX_ANGLE_MODE = os.environ.get("CORTEX_ANGLE_MODE", "mesh")
+
+# voxels, the standard deviation of the gaussian smoothing the cortex mask for CORTEX_ANGLE_MODE "field"
+NORMAL_SMOOTHING = float(os.environ.get("NORMAL_SMOOTHING", 1.0))
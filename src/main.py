@@ -0,0 +1,81 @@
+"""
+The main script of a data set, shared by main_testset.py and main_actual.py: it checks the validity of the entries and
+targets, saves the reasons of exclusion of every pair and shows the valid ones.
+"""
+
+import argparse
+import numpy as np
+from src.config import QUERY_MODE, SWEEP_CULLING
+from src.modules.backends import compare_backends
+from src.modules.dataset import DataSet
+from src.modules.dataset import load as load_data_set
+from src.utils.exclusion import reason_counts
+from src.utils.show_volume import show_volume
+
+
+def main(data: DataSet, shown: list) -> list:
+    """
+    Evaluate every pair of a started `DataSet`, save and print the reasons of exclusion and show the valid pairs.
+
+    Parameters:
+    - data (DataSet): The data set, started (see `DataSet.start`).
+    - shown (list): The names of the structures whose mesh is shown.
+
+    Returns:
+    - list: The (entry id, target id) of the valid pairs.
+    """
+    if QUERY_MODE == "packet":
+        # start evaluating each constraint as soon as its structure is ready
+        data.add_evaluation()
+    data.finish()
+
+    # print image dimensions
+    print("Image dimensions:")
+    [print(data.volumes.info(i).GetSize()) for i in data.volumes.names]
+    print(f"Number of points in entries: {data.entries.content_df.shape[0]}")
+    print(f"Number of points in targets: {data.targets.content_df.shape[0]}")
+    print("Startup times (start -> end of each task, since the start of the startup):")
+    [print(f"{i}: {j[0]:.3f}s -> {j[1]:.3f}s") for i, j in data.times.items()]
+    if SWEEP_CULLING:
+        print("Triangles kept by the sweep culling (in the convex hull of the entries and targets):")
+        [print(f"{i}: {len(j.culled)} / {len(j.mesh)} ({100 * len(j.culled) / max(len(j.mesh), 1):.1f}%)") for i, j in data.backends.items()]
+
+    reasons = data.evaluate_pairs()
+    evaluation = [j for i, j in data.graph.times.items() if i.startswith("reasons")]
+    if evaluation:
+        print(f"Evaluation of the constraints: {min(evaluation)[0]:.3f}s -> {max(j for _, j in evaluation):.3f}s")
+    data.save_reasons(reasons)
+    print(f"Number of combinations excluded by each constraint (saved in {data.reasons_path}):")
+    [print(f"{i}: {j}") for i, j in reason_counts(reasons).items()]
+
+    valid = np.argwhere(reasons == 0)
+    show_volume(
+        data.volumes.image(data.target),
+        data.entries_idx,  # for point plotting
+        data.targets_idx,
+        valid_entries_targets=[(data.entries_idx[i], data.targets_idx[j]) for i, j in valid[:100]],  # for line plotting; visualize only the first 100 to save time
+        meshes=[data.meshes[i] for i in shown],
+    )
+
+    # the ids of the valid pairs, from the content_df of the entries and targets
+    entry_ids, target_ids = data.entries.content_df["id"].to_numpy(), data.targets.content_df["id"].to_numpy()
+    return [(entry_ids[i], target_ids[j]) for i, j in valid]
+
+
+def run(name: str, shown: list):
+    """The command line of the main script of the data set `name` of `SETS`, showing the meshes of `shown`."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--compare-backends",
+        action="store_true",
+        help="check that the intersection backends agree and report their throughput on the loaded meshes, then exit",
+    )
+    args = parser.parse_args()
+
+    if args.compare_backends:
+        data = load_data_set(name)
+        compare_backends({i: data.meshes[i] for i in data.backends}, data.pairs[::50])
+        raise SystemExit
+
+    valid = main(load_data_set(name, finish=False), shown)
+    print(f"Number of valid entries and targets: {len(valid)}")
@@ -0,0 +1,264 @@
+import numpy as np
+import pandas
+import vtk
+from time import perf_counter
+from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+
+from src.modules.mesh import Mesh
+from src.modules.bvh import BVH
+from src.utils.marching_cubes import check_intersect_mesh, check_angle_of_intersection_mesh, segment_triangle_t, segment_mesh_distance
+
+
+class IntersectionBackend:
+    """
+    IntersectionBackend Class, the interface of the "segment vs surface" queries used by the planner.
+
+    A backend is built once per `Mesh` and then answers queries about segments between two points in numpy indices.
+    Every backend must give the answers of the brute-force kernels in `src.utils.marching_cubes`: a segment intersects
+    the surface if it crosses a triangle strictly between its two points, and the angle is taken with the first crossed
+    triangle in the face order of the mesh.
+
+    Attributes:
+        - name (str): The name of the backend in `BACKENDS`.
+        - mesh (Mesh): The triangle surface.
+
+    Methods:
+        - intersects: Check if the segment p1 -> p2 intersects with the surface.
+        - angle: The angle in degrees between the segment and the normal of the first triangle it crosses, 0.0 if none.
+        - intersects_packet: `intersects` for the segments from one start point p1 to each of the end points p2s.
+        - angle_packet: `angle` for the segments from one start point p1 to each of the end points p2s.
+        - intersects_batch: `intersects` for the segments p1s[k] -> p2s[k].
+        - angle_batch: `angle` for the segments p1s[k] -> p2s[k].
+        - capsule_packet: `intersects_packet` for capsules of `radius` mm around the segments (an electrode of finite
+          diameter), with the voxel `spacing`; the segments themselves if radius <= 0.
+        - capsule_batch: `capsule_packet` for the segments p1s[k] -> p2s[k].
+        - cover: Prepare for segments between some points (see `src.modules.sweep.SweepBackend`); nothing by default.
+    """
+
+    name = None
+
+    def __init__(self, mesh: Mesh):
+        self.mesh = mesh
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.mesh})"
+
+    def intersects(self, p1: np.ndarray, p2: np.ndarray) -> bool:
+        raise NotImplementedError
+
+    def angle(self, p1: np.ndarray, p2: np.ndarray) -> float:
+        raise NotImplementedError
+
+    def intersects_packet(self, p1: np.ndarray, p2s: np.ndarray) -> np.ndarray:
+        return np.array([self.intersects(p1, p2) for p2 in p2s], dtype=bool)
+
+    def angle_packet(self, p1: np.ndarray, p2s: np.ndarray) -> np.ndarray:
+        return np.array([self.angle(p1, p2) for p2 in p2s], dtype=np.float64)
+
+    def intersects_batch(self, p1s: np.ndarray, p2s: np.ndarray) -> np.ndarray:
+        return np.array([self.intersects(p1, p2) for p1, p2 in zip(p1s, p2s)], dtype=bool)
+
+    def angle_batch(self, p1s: np.ndarray, p2s: np.ndarray) -> np.ndarray:
+        return np.array([self.angle(p1, p2) for p1, p2 in zip(p1s, p2s)], dtype=np.float64)
+
+    def capsule_packet(self, p1: np.ndarray, p2s: np.ndarray, radius: float, spacing) -> np.ndarray:
+        return self.capsule_batch(np.broadcast_to(p1, np.shape(p2s)), p2s, radius, spacing)
+
+    def cover(self, points: np.ndarray, radius: float = 0.0, spacing=None) -> "IntersectionBackend":
+        return self
+
+    def capsule_batch(self, p1s: np.ndarray, p2s: np.ndarray, radius: float, spacing) -> np.ndarray:
+        if radius <= 0:
+            return self.intersects_batch(p1s, p2s)
+        scale, mesh = np.asarray(spacing, dtype=np.float64), self.mesh
+        distances = [segment_mesh_distance(p1, p2, mesh.v0, mesh.edge1, mesh.edge2, scale) for p1, p2 in zip(p1s, p2s)]
+        return np.array(distances, dtype=np.float64).reshape(-1) <= radius
+
+
+class NumbaBackend(IntersectionBackend):
+    """The hand-written numba loops over all the triangles (skipping the connected components the segment misses)."""
+
+    name = "numba"
+
+    def intersects(self, p1, p2):
+        return check_intersect_mesh(p1, p2, self.mesh)
+
+    def angle(self, p1, p2):
+        return check_angle_of_intersection_mesh(p1, p2, self.mesh)
+
+
+class BVHBackend(IntersectionBackend):
+    """A bounding volume hierarchy traversed by numba kernels (see `src.modules.bvh`), with packet queries."""
+
+    name = "bvh"
+
+    def __init__(self, mesh: Mesh, bvh: BVH = None):
+        super().__init__(mesh)
+        self.bvh = BVH(mesh) if bvh is None else bvh  # e.g. a `BrickedBVH` kept up to date with the mesh
+
+    def intersects(self, p1, p2):
+        return self.bvh.intersects(p1, p2)
+
+    def angle(self, p1, p2):
+        return self.bvh.angle(p1, p2)
+
+    def intersects_packet(self, p1, p2s):
+        return self.bvh.intersects_packet(p1, p2s)
+
+    def angle_packet(self, p1, p2s):
+        return self.bvh.angle_packet(p1, p2s)
+
+    def intersects_batch(self, p1s, p2s):
+        return self.bvh.intersects_batch(p1s, p2s)
+
+    def angle_batch(self, p1s, p2s):
+        return self.bvh.angle_batch(p1s, p2s)
+
+    def capsule_packet(self, p1, p2s, radius, spacing):
+        return self.bvh.intersects_packet(p1, p2s, radius=radius, spacing=spacing)
+
+    def capsule_batch(self, p1s, p2s, radius, spacing):
+        return self.bvh.intersects_batch(p1s, p2s, radius=radius, spacing=spacing)
+
+
+class VTKBackend(IntersectionBackend):
+    """
+    A VTK cell locator answering `IntersectWithLine`.
+
+    VTK uses its own tolerance and counts the end points of the segment, so the cells it returns (with a small positive
+    tolerance, i.e. a superset) are checked again with the same predicate as the numba kernels. It misses crossings at
+    the very ends of the line, which the predicate may count (t = 1 - 1e-16 after rounding), so the line given to VTK is
+    grown by `extension` times its length on both sides.
+    """
+
+    locator_class = None
+    tolerance = 1e-6
+    extension = 1e-3
+
+    def __init__(self, mesh: Mesh):
+        super().__init__(mesh)
+        points = vtk.vtkPoints()
+        points.SetData(numpy_to_vtk(mesh.verts.astype(np.float64), deep=True))
+        polys = vtk.vtkCellArray()
+        polys.SetData(3, numpy_to_vtkIdTypeArray(mesh.faces.ravel().astype(np.int64), deep=True))
+        self.polydata = vtk.vtkPolyData()
+        self.polydata.SetPoints(points)
+        self.polydata.SetPolys(polys)
+
+        self.locator = self.locator_class()
+        self.locator.SetDataSet(self.polydata)
+        self.locator.BuildLocator()
+
+    def intersect_with_line(self, p1, p2, points, cell_ids):
+        self.locator.IntersectWithLine(p1, p2, self.tolerance, points, cell_ids)
+
+    def crossed_cells(self, p1, p2):
+        """The cells crossed strictly between p1 and p2, in increasing cell (face) index."""
+        points = vtk.vtkPoints()
+        cell_ids = vtk.vtkIdList()
+        d = p2 - p1
+        self.intersect_with_line(tuple(p1 - self.extension * d), tuple(p2 + self.extension * d), points, cell_ids)
+        mesh = self.mesh
+        crossed = []
+        for i in sorted(cell_ids.GetId(k) for k in range(cell_ids.GetNumberOfIds())):
+            t = segment_triangle_t(p1[0], p1[1], p1[2], d[0], d[1], d[2], mesh.v0, mesh.edge1, mesh.edge2, i)
+            if 1e-10 < t < 1:  # between the two points
+                crossed.append(i)
+        return crossed
+
+    def intersects(self, p1, p2):
+        return len(self.crossed_cells(p1, p2)) > 0
+
+    def angle(self, p1, p2):
+        crossed = self.crossed_cells(p1, p2)
+        if not crossed:
+            return 0.0
+        d = p2 - p1
+        normal = self.mesh.normal[:, crossed[0]].astype(np.float64)
+        angle = np.arccos(np.clip(np.dot(d, normal) / (np.linalg.norm(d) * np.linalg.norm(normal)), -1.0, 1.0))
+        return np.rad2deg(min(angle, np.pi - angle))
+
+
+class VTKOBBTreeBackend(VTKBackend):
+    """
+    vtkOBBTree. It misses intersections on the flat, axis-aligned patches of marching-cubes surfaces (the oriented boxes
+    there have no thickness), so it is only in `COMPARISON_BACKENDS`, for `compare_backends` to report these
+    disagreements, and cannot be selected for planning.
+    """
+
+    name = "vtk_obbtree"
+    locator_class = vtk.vtkOBBTree
+
+    def intersect_with_line(self, p1, p2, points, cell_ids):
+        # vtkOBBTree only implements the variant without a tolerance argument, it uses its own
+        self.locator.IntersectWithLine(p1, p2, points, cell_ids)
+
+
+class VTKCellLocatorBackend(VTKBackend):
+    name = "vtk_cell_locator"
+    locator_class = vtk.vtkStaticCellLocator
+
+
+# the backends that answer like the numba kernels, which can be selected to evaluate the pairs
+BACKENDS = {i.name: i for i in (NumbaBackend, BVHBackend, VTKCellLocatorBackend)}
+# and the ones that are only compared with them
+COMPARISON_BACKENDS = {**BACKENDS, VTKOBBTreeBackend.name: VTKOBBTreeBackend}
+
+
+def make_backend(name: str, mesh: Mesh) -> IntersectionBackend:
+    """Build the backend called `name` (see `BACKENDS`) for a mesh."""
+    if name in COMPARISON_BACKENDS and name not in BACKENDS:
+        raise ValueError(f"The intersection backend {name!r} disagrees with the others, it is only built by compare_backends")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown intersection backend {name!r}, expected one of {list(BACKENDS)}")
+    return BACKENDS[name](mesh)
+
+
+def compare_backends(meshes: dict, pairs: list, names: list = None, reference: str = "numba") -> pandas.DataFrame:
+    """
+    Check that the backends agree with the reference backend and measure their throughput on the loaded meshes.
+
+    Args:
+        meshes: dict of name: Mesh.
+        pairs: list of (entry, target) tuples in numpy indices.
+        names: The backends to compare. Defaults to all the backends in `COMPARISON_BACKENDS`.
+        reference: The backend whose answers are taken as correct. Defaults to "numba".
+
+    Returns:
+        pandas.DataFrame: One row per mesh and backend with the build time, the queries per second and the number of
+        answers that disagree with the reference.
+    """
+    names = list(COMPARISON_BACKENDS) if names is None else names
+    rows = []
+    for mesh_name, mesh in meshes.items():
+        expected = None
+        for name in [reference] + [i for i in names if i != reference]:
+            start = perf_counter()
+            backend = COMPARISON_BACKENDS[name](mesh)
+            build_time = perf_counter() - start
+            backend.intersects(*pairs[0]), backend.angle(*pairs[0])  # compile before timing
+
+            start = perf_counter()
+            intersects = np.array([backend.intersects(p1, p2) for p1, p2 in pairs])
+            intersects_time = perf_counter() - start
+            start = perf_counter()
+            angles = np.array([backend.angle(p1, p2) for p1, p2 in pairs])
+            angle_time = perf_counter() - start
+
+            if expected is None:
+                expected = intersects, angles
+            rows.append(
+                {
+                    "mesh": mesh_name,
+                    "backend": name,
+                    "build (s)": build_time,
+                    "intersects (pairs/s)": len(pairs) / intersects_time,
+                    "angle (pairs/s)": len(pairs) / angle_time,
+                    "intersects disagree": int(np.sum(intersects != expected[0])),
+                    "angle disagree": int(np.sum(~np.isclose(angles, expected[1], atol=1e-6))),
+                }
+            )
+
+    report = pandas.DataFrame(rows)
+    print(report.to_string(index=False, float_format="{:.4g}".format))
+    return report
@@ -0,0 +1,160 @@
+import gzip
+import math
+import struct
+import numpy as np
+
+# the NIfTI-1 datatype codes of the voxel types that can be streamed
+NIFTI_DTYPES = {2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8", 256: "i1", 512: "u2", 768: "u4", 1024: "i8", 1280: "u8"}
+
+
+def nifti_header(path) -> dict:
+    """The fields of a single-file NIfTI-1 header (.nii or .nii.gz) needed to stream its voxels.
+
+    Raises:
+        ValueError: If the file is not a single-file NIfTI-1 image with a supported voxel type (e.g. NIfTI-2).
+    """
+    with (gzip.open if str(path).endswith(".gz") else open)(path, "rb") as reader:
+        raw = reader.read(348)
+    if len(raw) < 348:
+        raise ValueError(f"{path} is not a NIfTI-1 file")
+    for endian in "<>":
+        if struct.unpack(endian + "i", raw[:4])[0] == 348:
+            break
+    else:
+        raise ValueError(f"{path} is not a NIfTI-1 file")
+    if raw[344:348] != b"n+1\0":
+        raise ValueError(f"{path} is not a single-file NIfTI-1 image")
+    dim = struct.unpack(endian + "8h", raw[40:56])
+    datatype = struct.unpack(endian + "h", raw[70:72])[0]
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"{path} has the unsupported NIfTI datatype {datatype}")
+    slope, inter = struct.unpack(endian + "2f", raw[112:120])
+    return {
+        "size": tuple(max(int(i), 1) for i in dim[1:4]),  # x, y, z
+        "dtype": np.dtype(endian + NIFTI_DTYPES[datatype]),
+        "vox_offset": int(struct.unpack(endian + "f", raw[108:112])[0]),
+        "slope": slope if np.isfinite(slope) and slope != 0 else 1.0,  # 0 means no scaling
+        "inter": inter if np.isfinite(inter) else 0.0,
+    }
+
+
+def read_nifti_slabs(path, max_bytes: int):
+    """Read the voxels of a NIfTI-1 image slab by slab along z, decompressing the file once and sequentially.
+
+    Yields:
+        tuple: (z0, z1, slab), the (z1 - z0, y, x) array of the slices z0 to z1 (excluded), as stored in the file and as
+            returned by `sitk.GetArrayFromImage`, with the scaling of the header applied.
+    """
+    header = nifti_header(path)
+    nx, ny, nz = header["size"]
+    slice_bytes = nx * ny * header["dtype"].itemsize
+    thickness = max(1, max_bytes // slice_bytes)
+    with (gzip.open if str(path).endswith(".gz") else open)(path, "rb") as reader:
+        reader.seek(header["vox_offset"])
+        for z0 in range(0, nz, thickness):
+            z1 = min(z0 + thickness, nz)
+            raw = reader.read((z1 - z0) * slice_bytes)
+            slab = np.frombuffer(raw, dtype=header["dtype"]).reshape(z1 - z0, ny, nx)
+            if header["slope"] != 1.0 or header["inter"] != 0.0:
+                slab = slab * header["slope"] + header["inter"]
+            yield z0, z1, slab
+
+
+def rotated_slabs(path, max_bytes: int):
+    """The non-zero voxels of a NIfTI-1 image, slab by slab, in the orientation of the main scripts.
+
+    `np.rot90(array, 1, axes=(0, 2))` maps the voxel (z, y, x) of the file to the index (x_size - 1 - x, y, z), so the
+    z slabs of the file are slabs along the last axis of the rotated volume.
+
+    Yields:
+        tuple: (k0, k1, mask), the boolean (x, y, k1 - k0) array of the rotated volume [:, :, k0:k1].
+    """
+    for z0, z1, slab in read_nifti_slabs(path, max_bytes):
+        yield z0, z1, np.transpose(slab[:, :, ::-1] != 0, (2, 1, 0))
+
+
+def stream_mask(path, cache_path, memory_budget: int):
+    """Decode a NIfTI-1 mask into a cropped uint8 .npy file, without ever holding the full volume in memory.
+
+    The file is streamed twice in slabs of at most a quarter of `memory_budget` bytes: first to find the bounding box of
+    the non-zero voxels, then to write the voxels inside it straight into the memory-mapped .npy file.
+
+    Returns:
+        tuple: (array, offset, shape), the read-only memory-mapped cropped mask, the index of its first voxel and the
+            shape of the full (rotated) volume; the arguments of `CroppedMask`.
+    """
+    nx, ny, nz = nifti_header(path)["size"]
+    shape = (nx, ny, nz)
+    slab_bytes = max(1, memory_budget // 4)
+    nonzero = [np.zeros(nx, dtype=bool), np.zeros(ny, dtype=bool), np.zeros(nz, dtype=bool)]
+    for k0, k1, mask in rotated_slabs(path, slab_bytes):
+        nonzero[0] |= mask.any(axis=(1, 2))
+        nonzero[1] |= mask.any(axis=(0, 2))
+        nonzero[2][k0:k1] = mask.any(axis=(0, 1))
+
+    if not all(i.any() for i in nonzero):  # empty mask
+        np.save(cache_path, np.zeros((0, 0, 0), dtype=np.uint8))
+        return np.load(cache_path, mmap_mode="r"), (0, 0, 0), shape
+    lower = [int(np.argmax(i)) for i in nonzero]
+    upper = [len(i) - int(np.argmax(i[::-1])) for i in nonzero]
+
+    cropped = np.lib.format.open_memmap(cache_path, mode="w+", dtype=np.uint8, shape=tuple(u - l for l, u in zip(lower, upper)))
+    for k0, k1, mask in rotated_slabs(path, slab_bytes):
+        start, end = max(k0, lower[2]), min(k1, upper[2])
+        if start < end:
+            cropped[:, :, start - lower[2] : end - lower[2]] = mask[lower[0] : upper[0], lower[1] : upper[1], start - k0 : end - k0]
+    cropped.flush()
+    del cropped
+    return np.load(cache_path, mmap_mode="r"), tuple(lower), shape
+
+
+def brick_size(memory_budget: int, bytes_per_voxel: int, halo: int = 0) -> int:
+    """The side of the cubic bricks whose working set, grown by `halo` voxels on every side, fits in `memory_budget`.
+
+    Raises:
+        ValueError: If the budget does not fit a brick of at least 2 voxels.
+    """
+    side = int(math.floor((memory_budget / bytes_per_voxel) ** (1 / 3))) - 2 * halo
+    if side < 2:
+        raise ValueError(f"A memory budget of {memory_budget} bytes is too small for bricks with a halo of {halo} voxels")
+    return side
+
+
+def brick_ranges(shape, brick: int):
+    """Generate the (lower, upper) corners of the bricks of side `brick` covering an array of `shape`, in C order."""
+    for i in range(0, shape[0], brick):
+        for j in range(0, shape[1], brick):
+            for k in range(0, shape[2], brick):
+                lower = (i, j, k)
+                yield lower, tuple(min(l + brick, s) for l, s in zip(lower, shape))
+
+
+def brick_occupancy(array: np.ndarray, brick: int) -> np.ndarray:
+    """The occupancy index of an array: for each brick of side `brick`, whether it has a non-zero voxel. The array
+    (e.g. a memory-mapped mask) is read one brick at a time."""
+    occupancy = np.zeros([math.ceil(s / brick) for s in array.shape], dtype=bool)
+    for lower, upper in brick_ranges(array.shape, brick):
+        occupancy[tuple(l // brick for l in lower)] = array[tuple(slice(l, u) for l, u in zip(lower, upper))].any()
+    return occupancy
+
+
+def region_occupied(mask, occupancy: np.ndarray, brick: int, lower, upper) -> bool:
+    """Whether a bricked `CroppedMask` may have non-zero voxels in the region [lower, upper) of the full volume,
+    from the occupancy index of its array (conservative: True if a brick overlapping the region is occupied)."""
+    start = [max(l - o, 0) for l, o in zip(lower, mask.offset)]
+    end = [min(u - o, s) for u, o, s in zip(upper, mask.offset, mask.array.shape)]
+    if any(s >= e for s, e in zip(start, end)):
+        return False
+    return bool(occupancy[tuple(slice(s // brick, (e - 1) // brick + 1) for s, e in zip(start, end))].any())
+
+
+def read_region(mask, lower, upper) -> np.ndarray:
+    """The uint8 voxels of a `CroppedMask` in the region [lower, upper) of the full volume, zeros outside its array."""
+    region = np.zeros(np.subtract(upper, lower), dtype=np.uint8)
+    start = [max(l, o) for l, o in zip(lower, mask.offset)]
+    end = [min(u, o + s) for u, o, s in zip(upper, mask.offset, mask.array.shape)]
+    if all(s < e for s, e in zip(start, end)):
+        region[tuple(slice(s - l, e - l) for s, e, l in zip(start, end, lower))] = mask.array[
+            tuple(slice(s - o, e - o) for s, e, o in zip(start, end, mask.offset))
+        ]
+    return region
@@ -0,0 +1,751 @@
+import numpy as np
+from numba import njit
+
+from src.modules.mesh import Mesh
+from src.utils.marching_cubes import segment_triangle_t, segment_triangle_distance_sq
+
+LEAF_SIZE = 4  # maximum number of triangles in a leaf
+MAX_DEPTH = 60  # the traversal stack is sized from this
+PACKET_SIZE = 128  # maximum number of segments traversed together by the packet queries
+EMPTY_BOUNDS = -1e30  # both corners of the box of a node without triangles, which no segment in the volume reaches
+
+
+@njit(cache=True, nogil=True)
+def build_nodes(tri_lower, tri_upper, centroids, leaf_size, max_depth):
+    """
+    Build a bounding volume hierarchy over triangles by splitting at the middle of the longest axis of the centroids.
+
+    Args:
+    ----
+    tri_lower, tri_upper: np.ndarray
+        (n_faces, 3) arrays of the minimum and maximum corner of each triangle
+    centroids: np.ndarray
+        (n_faces, 3) array of the centroid of each triangle
+    leaf_size: int
+        maximum number of triangles in a leaf
+    max_depth: int
+        depth at which a node is made a leaf regardless of its size
+
+    Returns:
+    -------
+    tuple:
+        order: (n_faces,) the triangle indices in leaf order
+        node_bounds: (n_nodes, 2, 3) the bounding box of each node
+        node_children: (n_nodes, 2) the two children of each node, -1 for a leaf
+        node_ranges: (n_nodes, 2) the [start, end) range in `order` of the triangles under each node
+    """
+    n = centroids.shape[0]
+    order = np.arange(n).astype(np.int32)
+    capacity = max(2 * n, 1)
+    node_bounds = np.empty((capacity, 2, 3), dtype=np.float32)
+    node_children = np.full((capacity, 2), -1, dtype=np.int32)
+    node_ranges = np.zeros((capacity, 2), dtype=np.int32)
+
+    stack = np.empty((max_depth + 2, 2), dtype=np.int32)  # (node, depth)
+    n_nodes = 1
+    node_ranges[0, 1] = n
+    stack[0, 0], stack[0, 1] = 0, 0
+    top = 1
+
+    while top > 0:
+        top -= 1
+        node, depth = stack[top, 0], stack[top, 1]
+        start, end = node_ranges[node, 0], node_ranges[node, 1]
+
+        # bounds of the triangles and of their centroids
+        c_lower = np.full(3, np.inf)
+        c_upper = np.full(3, -np.inf)
+        for axis in range(3):
+            node_bounds[node, 0, axis] = np.inf
+            node_bounds[node, 1, axis] = -np.inf
+        for k in range(start, end):
+            i = order[k]
+            for axis in range(3):
+                node_bounds[node, 0, axis] = min(node_bounds[node, 0, axis], tri_lower[i, axis])
+                node_bounds[node, 1, axis] = max(node_bounds[node, 1, axis], tri_upper[i, axis])
+                c_lower[axis] = min(c_lower[axis], centroids[i, axis])
+                c_upper[axis] = max(c_upper[axis], centroids[i, axis])
+
+        if end - start <= leaf_size or depth >= max_depth:
+            continue
+
+        axis = np.argmax(c_upper - c_lower)
+        middle = 0.5 * (c_lower[axis] + c_upper[axis])
+
+        # partition the triangles of the node around the middle
+        left, right = start, end - 1
+        while left <= right:
+            if centroids[order[left], axis] < middle:
+                left += 1
+            else:
+                order[left], order[right] = order[right], order[left]
+                right -= 1
+        split = left
+        if split == start or split == end:  # all the centroids on one side; split the range in half instead
+            split = (start + end) // 2
+
+        node_children[node, 0], node_children[node, 1] = n_nodes, n_nodes + 1
+        node_ranges[n_nodes, 0], node_ranges[n_nodes, 1] = start, split
+        node_ranges[n_nodes + 1, 0], node_ranges[n_nodes + 1, 1] = split, end
+        stack[top, 0], stack[top, 1] = n_nodes, depth + 1
+        stack[top + 1, 0], stack[top + 1, 1] = n_nodes + 1, depth + 1
+        top += 2
+        n_nodes += 2
+
+    return order, node_bounds[:n_nodes].copy(), node_children[:n_nodes].copy(), node_ranges[:n_nodes].copy()
+
+
+@njit(cache=True, nogil=True)
+def refit_nodes(node_bounds, node_children, node_ranges, nodes):
+    """
+    Recompute the triangle range and the bounding box of inner nodes from those of their children, in place.
+
+    Args:
+    ----
+    node_bounds, node_children, node_ranges: np.ndarray
+        the arrays of a tree laid out like those of `build_nodes`
+    nodes: np.ndarray
+        the inner nodes to refit, each after its children (e.g. in decreasing order)
+
+    A node without triangles gets the box of `EMPTY_BOUNDS`, far from the volume, so that it is never traversed.
+    """
+    for node in nodes:
+        left, right = node_children[node, 0], node_children[node, 1]
+        node_ranges[node, 0], node_ranges[node, 1] = node_ranges[left, 0], node_ranges[right, 1]
+        left_empty = node_ranges[left, 0] == node_ranges[left, 1]
+        right_empty = node_ranges[right, 0] == node_ranges[right, 1]
+        for side in range(2):
+            for axis in range(3):
+                if left_empty and right_empty:
+                    node_bounds[node, side, axis] = EMPTY_BOUNDS
+                elif left_empty:
+                    node_bounds[node, side, axis] = node_bounds[right, side, axis]
+                elif right_empty:
+                    node_bounds[node, side, axis] = node_bounds[left, side, axis]
+                elif side == 0:
+                    node_bounds[node, side, axis] = min(node_bounds[left, side, axis], node_bounds[right, side, axis])
+                else:
+                    node_bounds[node, side, axis] = max(node_bounds[left, side, axis], node_bounds[right, side, axis])
+
+
+@njit(cache=True, nogil=True)
+def slab(p, inv, lower, upper, t_enter, t_exit):
+    """
+    Clip the parameter range [t_enter, t_exit] of a segment to one slab of a box (grown by 1e-6).
+    `inv` is the inverse of the direction along the axis, np.inf when the segment is parallel to the slab.
+    """
+    lower -= 1e-6
+    upper += 1e-6
+    if np.isinf(inv):
+        if p < lower or p > upper:
+            return 1.0, 0.0  # empty range
+        return t_enter, t_exit
+    t1 = (lower - p) * inv
+    t2 = (upper - p) * inv
+    if t1 > t2:
+        t1, t2 = t2, t1
+    return max(t_enter, t1), min(t_exit, t2)
+
+
+@njit(cache=True, nogil=True)
+def segment_node_intersect(px, py, pz, inv_x, inv_y, inv_z, node_bounds, node):
+    """
+    Slab test of the segment p1 -> p2 (given by p1 and the inverse of p2 - p1) against the box of a node.
+
+    Returns:
+        bool:
+            True if the segment passes through the box (grown by 1e-6), False otherwise
+    """
+    t_enter, t_exit = slab(px, inv_x, node_bounds[node, 0, 0], node_bounds[node, 1, 0], 0.0, 1.0)
+    if t_enter > t_exit:
+        return False
+    t_enter, t_exit = slab(py, inv_y, node_bounds[node, 0, 1], node_bounds[node, 1, 1], t_enter, t_exit)
+    if t_enter > t_exit:
+        return False
+    t_enter, t_exit = slab(pz, inv_z, node_bounds[node, 0, 2], node_bounds[node, 1, 2], t_enter, t_exit)
+    return t_enter <= t_exit
+
+
+@njit(cache=True, nogil=True)
+def inverse(d):
+    return 1.0 / d if d != 0 else np.inf
+
+
+@njit(cache=True, nogil=True)
+def leaf_hit(px, py, pz, dx, dy, dz, v0, edge1, edge2, i, radius, scale):
+    """
+    The test of a segment against the i-th triangle in a leaf: crossing it strictly between the two points, or for a
+    capsule (radius > 0), coming within `radius` of it once every axis is scaled by `scale`.
+    """
+    if radius > 0:
+        return segment_triangle_distance_sq(px, py, pz, dx, dy, dz, v0, edge1, edge2, i, scale) <= radius * radius
+    t = segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i)
+    return 1e-10 < t < 1  # between the two points
+
+
+@njit(cache=True, nogil=True)
+def bvh_segment_intersect(p1, p2, node_bounds, node_children, node_ranges, v0, edge1, edge2, radius, scale):
+    """
+    Check if the segment p1 -> p2 intersects with any triangle under the root of a `BVH`.
+    Same result as `segment_mesh_intersect`, but only the triangles of the leaves whose box the segment crosses are tested.
+    With radius > 0 the segment is a capsule (see `leaf_hit`) and `node_bounds` must be grown by radius / scale.
+
+    Returns:
+        bool:
+            True if the segment intersects with the surface, False otherwise
+    """
+    px, py, pz = p1[0], p1[1], p1[2]
+    dx, dy, dz = p2[0] - px, p2[1] - py, p2[2] - pz
+    inv_x, inv_y, inv_z = inverse(dx), inverse(dy), inverse(dz)
+
+    if node_bounds.shape[0] == 0:
+        return False
+
+    stack = np.empty(MAX_DEPTH + 2, dtype=np.int32)
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if not segment_node_intersect(px, py, pz, inv_x, inv_y, inv_z, node_bounds, node):
+            continue
+        if node_children[node, 0] < 0:  # leaf
+            for i in range(node_ranges[node, 0], node_ranges[node, 1]):
+                if leaf_hit(px, py, pz, dx, dy, dz, v0, edge1, edge2, i, radius, scale):
+                    return True
+        else:
+            stack[top] = node_children[node, 0]
+            stack[top + 1] = node_children[node, 1]
+            top += 2
+    return False
+
+
+@njit(cache=True, nogil=True)
+def bvh_segment_angle(p1, p2, node_bounds, node_children, node_ranges, v0, edge1, edge2, normal, face_index):
+    """
+    Angle between the segment p1 -> p2 and the normal of the first triangle (in the face order of the `Mesh`) it crosses.
+    Same result as `segment_mesh_angle`; all the crossed leaves are visited to find the triangle with the lowest index.
+
+    Returns:
+    -------
+    float:
+        The angle in degrees (between 0 and 90) or 0.0 if the segment does not intersect with the surface
+    """
+    px, py, pz = p1[0], p1[1], p1[2]
+    dx, dy, dz = p2[0] - px, p2[1] - py, p2[2] - pz
+    inv_x, inv_y, inv_z = inverse(dx), inverse(dy), inverse(dz)
+
+    if node_bounds.shape[0] == 0:
+        return 0.0
+
+    first = -1
+    stack = np.empty(MAX_DEPTH + 2, dtype=np.int32)
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if not segment_node_intersect(px, py, pz, inv_x, inv_y, inv_z, node_bounds, node):
+            continue
+        if node_children[node, 0] < 0:  # leaf
+            for i in range(node_ranges[node, 0], node_ranges[node, 1]):
+                if first >= 0 and face_index[i] >= face_index[first]:
+                    continue
+                t = segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i)
+                if 1e-10 < t < 1:  # between the two points
+                    first = i
+        else:
+            stack[top] = node_children[node, 0]
+            stack[top + 1] = node_children[node, 1]
+            top += 2
+
+    if first < 0:
+        return 0.0
+
+    nx, ny, nz = np.float64(normal[0, first]), np.float64(normal[1, first]), np.float64(normal[2, first])
+    cos = (dx * nx + dy * ny + dz * nz) / (np.sqrt(dx * dx + dy * dy + dz * dz) * np.sqrt(nx * nx + ny * ny + nz * nz))
+    angle = np.arccos(min(max(cos, -1.0), 1.0))
+    # Get the minimum of the angle and its complementary angle (90 - angle)
+    if angle > np.pi / 2:
+        angle = np.pi - angle
+    return np.rad2deg(angle)
+
+
+@njit(cache=True, nogil=True)
+def bvh_segments_intersect(p1s, p2s, node_bounds, node_children, node_ranges, v0, edge1, edge2, radius, scale):
+    """`bvh_segment_intersect` for each of the segments p1s[k] -> p2s[k], which need not share a start point."""
+    hits = np.zeros(p1s.shape[0], dtype=np.bool_)
+    for k in range(p1s.shape[0]):
+        hits[k] = bvh_segment_intersect(
+            p1s[k], p2s[k], node_bounds, node_children, node_ranges, v0, edge1, edge2, radius, scale
+        )
+    return hits
+
+
+@njit(cache=True, nogil=True)
+def bvh_segments_angle(p1s, p2s, node_bounds, node_children, node_ranges, v0, edge1, edge2, normal, face_index):
+    """`bvh_segment_angle` for each of the segments p1s[k] -> p2s[k], which need not share a start point."""
+    angles = np.zeros(p1s.shape[0])
+    for k in range(p1s.shape[0]):
+        angles[k] = bvh_segment_angle(
+            p1s[k], p2s[k], node_bounds, node_children, node_ranges, v0, edge1, edge2, normal, face_index
+        )
+    return angles
+
+
+@njit(cache=True, nogil=True)
+def packet_node_intersect(p1, d_lower, d_upper, node_bounds, node):
+    """
+    Slab test of a packet of segments p1 -> p1 + d, for every d in the box [d_lower, d_upper], against the box of a node.
+    Along each axis the points of the packet at parameter t span [p1 + t * d_lower, p1 + t * d_upper], so the packet
+    can reach the node only for the values of t where these ranges overlap the slabs of all the axes.
+
+    Returns:
+        bool:
+            False if no segment of the packet can pass through the box (grown by 1e-6), True otherwise
+    """
+    t_enter = 0.0
+    t_exit = 1.0
+    for axis in range(3):
+        origin = p1[axis]
+        lower = node_bounds[node, 0, axis] - 1e-6
+        upper = node_bounds[node, 1, axis] + 1e-6
+        d_min = d_lower[axis]
+        d_max = d_upper[axis]
+
+        # some point at t is below the upper side: origin + t * d_min <= upper
+        if d_min > 0:
+            t_exit = min(t_exit, (upper - origin) / d_min)
+        elif d_min < 0:
+            t_enter = max(t_enter, (upper - origin) / d_min)
+        elif origin > upper:
+            return False
+
+        # some point at t is above the lower side: origin + t * d_max >= lower
+        if d_max < 0:
+            t_exit = min(t_exit, (lower - origin) / d_max)
+        elif d_max > 0:
+            t_enter = max(t_enter, (lower - origin) / d_max)
+        elif origin < lower:
+            return False
+
+        if t_enter > t_exit:
+            return False
+    return True
+
+
+@njit(cache=True, nogil=True)
+def bvh_packet_traverse(p1, d, inv, first, node_bounds, node_children, node_ranges, v0, edge1, edge2, face_index, any_hit, radius, scale):
+    """
+    Traverse a `BVH` with the packet of segments p1 -> p1 + d[k] sharing the start point p1, filling `first` in place.
+
+    Every node is first tested against the whole packet (see `packet_node_intersect`), which culls it for all the
+    segments at once. Otherwise the segments still active in the parent are tested one by one against the box of the
+    node, and only those passing through it go down; in the leaves they are tested against the triangles.
+
+    Args:
+    ----
+    p1: np.ndarray
+        the start point shared by the segments
+    d: np.ndarray
+        (n, 3) array of the directions p2 - p1
+    inv: np.ndarray
+        (n, 3) array of their inverses (see `inverse`)
+    first: np.ndarray
+        (n,) int array, set to the position (in leaf order) of the triangle found for each segment, -1 if none
+    node_bounds, node_children, node_ranges, v0, edge1, edge2, face_index: np.ndarray
+        the arrays of the BVH
+    any_hit: bool
+        if True a segment retires at its first hit and the traversal stops once every segment has hit; otherwise the
+        crossed triangle with the lowest index in the `Mesh` is found for every segment
+    radius, scale:
+        the capsule test of `leaf_hit` when radius > 0, with `node_bounds` grown by radius / scale
+    """
+    n = d.shape[0]
+    px, py, pz = p1[0], p1[1], p1[2]
+    d_lower = np.full(3, np.inf)
+    d_upper = np.full(3, -np.inf)
+    for k in range(n):
+        first[k] = -1
+        for axis in range(3):
+            d_lower[axis] = min(d_lower[axis], d[k, axis])
+            d_upper[axis] = max(d_upper[axis], d[k, axis])
+
+    # the segments active in a node are kept in the row of its depth, until both its children are done
+    active = np.empty((MAX_DEPTH + 3, n), dtype=np.int32)
+    n_active = np.zeros(MAX_DEPTH + 3, dtype=np.int32)
+    for k in range(n):
+        active[0, k] = k
+    n_active[0] = n
+
+    remaining = n
+    stack = np.empty((MAX_DEPTH + 2, 2), dtype=np.int32)  # node, depth
+    stack[0, 0] = 0
+    stack[0, 1] = 1
+    top = 1
+    while top > 0 and remaining > 0:
+        top -= 1
+        node = stack[top, 0]
+        depth = stack[top, 1]
+        if not packet_node_intersect(p1, d_lower, d_upper, node_bounds, node):
+            continue
+
+        count = 0
+        for j in range(n_active[depth - 1]):
+            k = active[depth - 1, j]
+            if any_hit and first[k] >= 0:
+                continue
+            if segment_node_intersect(px, py, pz, inv[k, 0], inv[k, 1], inv[k, 2], node_bounds, node):
+                active[depth, count] = k
+                count += 1
+        if count == 0:
+            continue
+        n_active[depth] = count
+
+        if node_children[node, 0] >= 0:
+            stack[top, 0] = node_children[node, 0]
+            stack[top, 1] = depth + 1
+            stack[top + 1, 0] = node_children[node, 1]
+            stack[top + 1, 1] = depth + 1
+            top += 2
+            continue
+
+        for j in range(count):
+            k = active[depth, j]
+            for i in range(node_ranges[node, 0], node_ranges[node, 1]):
+                if first[k] >= 0 and face_index[i] >= face_index[first[k]]:
+                    continue
+                if leaf_hit(px, py, pz, d[k, 0], d[k, 1], d[k, 2], v0, edge1, edge2, i, radius, scale):
+                    first[k] = i
+                    if any_hit:
+                        remaining -= 1
+                        break
+
+
+@njit(cache=True, nogil=True)
+def bvh_packets(p1, p2s, packet_ranges, node_bounds, node_children, node_ranges, v0, edge1, edge2, face_index, any_hit, radius, scale):
+    """
+    Run `bvh_packet_traverse` for every packet p2s[start:end] of `packet_ranges`.
+
+    Returns:
+    -------
+    np.ndarray:
+        (n,) int array of the position (in leaf order) of the triangle found for each segment, -1 if none
+    """
+    n = p2s.shape[0]
+    first = np.full(n, -1, dtype=np.int64)
+    if node_bounds.shape[0] == 0:
+        return first
+    d = np.empty((n, 3))
+    inv = np.empty((n, 3))
+    for k in range(n):
+        for axis in range(3):
+            d[k, axis] = p2s[k, axis] - p1[axis]
+            inv[k, axis] = inverse(d[k, axis])
+    for packet in range(packet_ranges.shape[0]):
+        start, end = packet_ranges[packet, 0], packet_ranges[packet, 1]
+        bvh_packet_traverse(
+            p1,
+            d[start:end],
+            inv[start:end],
+            first[start:end],
+            node_bounds,
+            node_children,
+            node_ranges,
+            v0,
+            edge1,
+            edge2,
+            face_index,
+            any_hit,
+            radius,
+            scale,
+        )
+    return first
+
+
+@njit(cache=True, nogil=True)
+def packet_angles(p1, p2s, first, normal):
+    """The angles in degrees between the segments p1 -> p2s[k] and the normals of the triangles `first[k]`, 0.0 if -1."""
+    angles = np.zeros(p2s.shape[0])
+    for k in range(p2s.shape[0]):
+        i = first[k]
+        if i < 0:
+            continue
+        dx, dy, dz = p2s[k, 0] - p1[0], p2s[k, 1] - p1[1], p2s[k, 2] - p1[2]
+        nx, ny, nz = np.float64(normal[0, i]), np.float64(normal[1, i]), np.float64(normal[2, i])
+        cos = (dx * nx + dy * ny + dz * nz) / (np.sqrt(dx * dx + dy * dy + dz * dz) * np.sqrt(nx * nx + ny * ny + nz * nz))
+        angle = np.arccos(min(max(cos, -1.0), 1.0))
+        # Get the minimum of the angle and its complementary angle (90 - angle)
+        if angle > np.pi / 2:
+            angle = np.pi - angle
+        angles[k] = np.rad2deg(angle)
+    return angles
+
+
+def cluster_points(points: np.ndarray, size: int = PACKET_SIZE) -> list:
+    """Split points into spatially coherent clusters of at most `size` points, by median splits along the longest axis.
+
+    Args:
+        points: (n, 3) array of points.
+        size: The maximum number of points in a cluster. Defaults to PACKET_SIZE.
+
+    Returns:
+        list: The index arrays of the clusters.
+    """
+    clusters = []
+    stack = [np.arange(len(points))]
+    while stack:
+        indices = stack.pop()
+        if len(indices) <= size:
+            if len(indices):
+                clusters.append(indices)
+            continue
+        axis = np.ptp(points[indices], axis=0).argmax()
+        indices = indices[np.argsort(points[indices, axis], kind="stable")]
+        half = len(indices) // 2
+        stack += [indices[half:], indices[:half]]
+    return clusters
+
+
+class BVH:
+    """
+    BVH Class, a bounding volume hierarchy over the triangles of a `Mesh`.
+
+    The tree is stored as flat arrays (so that it can be passed to numba kernels) and the triangle data of the mesh is
+    copied in leaf order, so that the triangles of a leaf are contiguous in memory.
+
+    Attributes:
+        - node_bounds (np.ndarray): (n_nodes, 2, 3) float32 array of the bounding box of each node.
+        - node_children (np.ndarray): (n_nodes, 2) int32 array of the two children of each node, -1 for a leaf.
+        - node_ranges (np.ndarray): (n_nodes, 2) int32 array of the [start, end) triangle range of each node.
+        - face_index (np.ndarray): (n_faces,) int32 array of the index in the `Mesh` of each triangle in leaf order.
+        - v0, edge1, edge2, normal (np.ndarray): (3, n_faces) float32 triangle data of the `Mesh`, in leaf order.
+
+    Methods:
+        - intersects: Check if a segment intersects with the surface.
+        - angle: The angle between a segment and the normal of the first triangle it crosses.
+        - intersects_packet: `intersects` for many segments from one start point, traversed in packets.
+        - angle_packet: `angle` for many segments from one start point, traversed in packets.
+        - intersects_batch: `intersects` for many segments with their own start points, in one kernel call.
+        - angle_batch: `angle` for many segments with their own start points, in one kernel call.
+
+    The `intersects` queries also take a `radius` in mm and the voxel `spacing`: with radius > 0 the segment is a capsule
+    (an electrode of finite diameter) that collides with the surface when it comes within `radius` of a triangle. The
+    same tree is traversed with its boxes grown by radius / spacing, which are cached per radius.
+    """
+
+    __slots__ = ("node_bounds", "node_children", "node_ranges", "face_index", "v0", "edge1", "edge2", "normal", "_grown")
+
+    def __init__(self, mesh: Mesh, leaf_size: int = LEAF_SIZE):
+        triangles = mesh.verts[mesh.faces]  # (n_faces, 3 vertices, 3 coordinates)
+        order, self.node_bounds, self.node_children, self.node_ranges = build_nodes(
+            triangles.min(axis=1), triangles.max(axis=1), triangles.mean(axis=1), leaf_size, MAX_DEPTH
+        )
+        if len(mesh) == 0:  # no nodes at all rather than an empty root
+            self.node_bounds = self.node_bounds[:0]
+            self.node_children = self.node_children[:0]
+            self.node_ranges = self.node_ranges[:0]
+        self.face_index = order
+        self.v0 = np.ascontiguousarray(mesh.v0[:, order])
+        self.edge1 = np.ascontiguousarray(mesh.edge1[:, order])
+        self.edge2 = np.ascontiguousarray(mesh.edge2[:, order])
+        self.normal = np.ascontiguousarray(mesh.normal[:, order])
+        self._grown = {}
+
+    def __repr__(self):
+        return f"BVH(n_nodes={len(self.node_bounds)}, n_faces={len(self.face_index)})"
+
+    def _capsule(self, radius, spacing):
+        """The node bounds and the scale of the queries of a capsule of `radius` mm (a segment if radius <= 0)."""
+        scale = np.ones(3) if spacing is None else np.asarray(spacing, dtype=np.float64)
+        if radius <= 0:
+            return self.node_bounds, scale
+        key = (float(radius), tuple(scale))
+        if key not in self._grown:
+            margin = (radius / scale).astype(np.float32)
+            self._grown[key] = np.ascontiguousarray(np.stack([self.node_bounds[:, 0] - margin, self.node_bounds[:, 1] + margin], axis=1))
+        return self._grown[key], scale
+
+    def intersects(self, p1, p2, radius: float = 0.0, spacing=None):
+        node_bounds, scale = self._capsule(radius, spacing)
+        return bvh_segment_intersect(
+            p1, p2, node_bounds, self.node_children, self.node_ranges, self.v0, self.edge1, self.edge2, radius, scale
+        )
+
+    def angle(self, p1, p2):
+        return bvh_segment_angle(
+            p1,
+            p2,
+            self.node_bounds,
+            self.node_children,
+            self.node_ranges,
+            self.v0,
+            self.edge1,
+            self.edge2,
+            self.normal,
+            self.face_index,
+        )
+
+    def _packets(self, p1, p2s, any_hit, packet_size, radius=0.0, spacing=None):
+        node_bounds, scale = self._capsule(radius, spacing)
+        p2s = np.asarray(p2s, dtype=np.float64).reshape(-1, 3)
+        clusters = cluster_points(p2s, packet_size)
+        order = np.concatenate(clusters) if clusters else np.zeros(0, dtype=np.int64)
+        ends = np.cumsum([len(i) for i in clusters], dtype=np.int64)
+        packet_ranges = np.stack([ends - [len(i) for i in clusters], ends], axis=1).reshape(-1, 2)
+        p2s = np.ascontiguousarray(p2s[order])
+        first = bvh_packets(
+            np.asarray(p1, dtype=np.float64),
+            p2s,
+            packet_ranges,
+            node_bounds,
+            self.node_children,
+            self.node_ranges,
+            self.v0,
+            self.edge1,
+            self.edge2,
+            self.face_index,
+            any_hit,
+            radius,
+            scale,
+        )
+        result = np.empty_like(first)
+        result[order] = first
+        return p2s, first, order, result
+
+    def intersects_packet(self, p1, p2s, packet_size: int = PACKET_SIZE, radius: float = 0.0, spacing=None):
+        *_, first = self._packets(p1, p2s, True, packet_size, radius, spacing)
+        return first >= 0
+
+    def angle_packet(self, p1, p2s, packet_size: int = PACKET_SIZE):
+        p2s, first, order, _ = self._packets(p1, p2s, False, packet_size)
+        angles = np.empty(len(first))
+        angles[order] = packet_angles(np.asarray(p1, dtype=np.float64), p2s, first, self.normal)
+        return angles
+
+    def intersects_batch(self, p1s, p2s, radius: float = 0.0, spacing=None):
+        node_bounds, scale = self._capsule(radius, spacing)
+        return bvh_segments_intersect(
+            np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3),
+            np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3),
+            node_bounds,
+            self.node_children,
+            self.node_ranges,
+            self.v0,
+            self.edge1,
+            self.edge2,
+            radius,
+            scale,
+        )
+
+    def angle_batch(self, p1s, p2s):
+        return bvh_segments_angle(
+            np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3),
+            np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3),
+            self.node_bounds,
+            self.node_children,
+            self.node_ranges,
+            self.v0,
+            self.edge1,
+            self.edge2,
+            self.normal,
+            self.face_index,
+        )
+
+
+class BrickedBVH(BVH):
+    """
+    BrickedBVH Class, a `BVH` over a surface meshed brick by brick, that is updated in place when some bricks change.
+
+    The top levels are a tree over all the bricks of the volume, built once from their boxes, and the triangles of
+    each brick have their own subtree, which hangs in place of the leaf of the brick. `update` builds the subtrees of
+    the changed bricks only, reuses the others as they are, lays them out again and refits the boxes of the top levels
+    from their children; a brick without triangles keeps an empty leaf. The queries are those of `BVH`.
+
+    Attributes:
+        - top_children (np.ndarray): (n_top, 2) int32 array of the children of the nodes of the tree over the bricks.
+        - brick_order (np.ndarray): (n_bricks,) int32 array of the bricks in the order of their leaves.
+        - brick_leaf (np.ndarray): (n_bricks,) int32 array of the node of the leaf of each brick.
+        - max_depth (int): The depth left to the subtrees of the bricks.
+
+    Methods:
+        - update: Build the subtrees of the changed bricks again and refit the top levels.
+    """
+
+    __slots__ = ("top_children", "brick_order", "brick_leaf", "max_depth", "leaf_size", "_inner", "_subtrees")
+
+    def __init__(self, brick_lower: np.ndarray, brick_upper: np.ndarray, leaf_size: int = LEAF_SIZE):
+        """
+        Args:
+            brick_lower, brick_upper: (n_bricks, 3) arrays of the minimum and maximum corner of each brick.
+            leaf_size: The maximum number of triangles in a leaf of the subtrees. Defaults to `LEAF_SIZE`.
+        """
+        centres = 0.5 * (brick_lower + brick_upper)
+        order, _, self.top_children, ranges = build_nodes(brick_lower, brick_upper, centres, 1, MAX_DEPTH)
+        leaves = np.flatnonzero(self.top_children[:, 0] < 0)
+        self.brick_order = order
+        self.brick_leaf = np.empty(len(order), dtype=np.int32)
+        self.brick_leaf[order[ranges[leaves, 0]]] = leaves
+        self._inner = np.flatnonzero(self.top_children[:, 0] >= 0)[::-1].astype(np.int32)  # children after parents
+
+        depth = np.zeros(len(self.top_children), dtype=np.int64)
+        for node in self._inner[::-1]:
+            depth[self.top_children[node]] = depth[node] + 1
+        self.max_depth = MAX_DEPTH - int(depth.max())
+        self.leaf_size = leaf_size
+        self._subtrees = {}
+        self.update(Mesh(np.zeros((0, 3)), np.zeros((0, 3))), np.zeros(0, dtype=np.int32), [])
+
+    def __repr__(self):
+        return f"BrickedBVH(n_bricks={len(self.brick_order)}, n_nodes={len(self.node_bounds)}, n_faces={len(self.face_index)})"
+
+    def update(self, mesh: Mesh, face_brick: np.ndarray, bricks):
+        """Take the triangles of `mesh`, where those of the `bricks` changed, and rebuild the subtrees of these bricks.
+
+        Args:
+            mesh: The new surface.
+            face_brick: (n_faces,) array of the brick of each face of `mesh`.
+            bricks: The bricks whose triangles changed; the subtrees of the others must still match their triangles,
+                in the same relative order in the mesh.
+        """
+        positions = np.argsort(face_brick, kind="stable")  # the faces of each brick, in the order of the mesh
+        counts = np.bincount(face_brick, minlength=len(self.brick_order))
+        starts = np.cumsum(counts) - counts
+        for brick in bricks:
+            faces = positions[starts[brick] : starts[brick] + counts[brick]]
+            if not len(faces):
+                self._subtrees.pop(brick, None)
+                continue
+            triangles = mesh.verts[mesh.faces[faces]]
+            self._subtrees[brick] = build_nodes(triangles.min(axis=1), triangles.max(axis=1), triangles.mean(axis=1), self.leaf_size, self.max_depth)
+
+        # the leaf of each brick becomes the root of its subtree, the other nodes of the subtrees come after the top levels
+        n_top = len(self.top_children)
+        n_nodes = n_top + sum(len(i[1]) - 1 for i in self._subtrees.values())
+        self.node_bounds = np.full((n_nodes, 2, 3), EMPTY_BOUNDS, dtype=np.float32)
+        self.node_children = np.full((n_nodes, 2), -1, dtype=np.int32)
+        self.node_children[:n_top] = self.top_children
+        self.node_ranges = np.zeros((n_nodes, 2), dtype=np.int32)
+        self.face_index = np.empty(len(face_brick), dtype=np.int32)
+        next_node, next_face = n_top, 0
+        for brick in self.brick_order:
+            leaf = self.brick_leaf[brick]
+            if brick not in self._subtrees:
+                self.node_ranges[leaf] = next_face
+                continue
+            order, bounds, children, ranges = self._subtrees[brick]
+            nodes = np.empty(len(bounds), dtype=np.int32)
+            nodes[0], nodes[1:] = leaf, np.arange(next_node, next_node + len(bounds) - 1)
+            self.node_bounds[nodes] = bounds
+            self.node_children[nodes] = np.where(children >= 0, nodes[children], -1)
+            self.node_ranges[nodes] = ranges + next_face
+            self.face_index[next_face : next_face + len(order)] = positions[starts[brick] + order]
+            next_node += len(bounds) - 1
+            next_face += len(order)
+        refit_nodes(self.node_bounds, self.node_children, self.node_ranges, self._inner)
+
+        self.v0 = np.ascontiguousarray(mesh.v0[:, self.face_index])
+        self.edge1 = np.ascontiguousarray(mesh.edge1[:, self.face_index])
+        self.edge2 = np.ascontiguousarray(mesh.edge2[:, self.face_index])
+        self.normal = np.ascontiguousarray(mesh.normal[:, self.face_index])
+        self._grown = {}
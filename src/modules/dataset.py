@@ -0,0 +1,337 @@
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+import numpy as np
+
+from src.config import SETS, CRITICAL_STRUCTURES
+from src.config import MAX_LENGTH, INTERSECTION_BACKEND, QUERY_MODE, ELECTRODE_RADIUS, MEMORY_BUDGET_MB, SWEEP_CULLING, CORTEX_ANGLE_MODE, NORMAL_SMOOTHING
+from src.modules.fcsv import FCSV
+from src.modules.volumes import VolumeStore, union_masks
+from src.modules.backends import make_backend
+from src.modules.sweep import SweepBackend
+from src.modules.normal_field import NormalField
+from src.utils.marching_cubes import mesh_structure, warm_up
+from src.utils.linear import point_to_numpy_idx
+from src.utils.prefilter import prefilter
+from src.utils.exclusion import NOT_IN_TARGET, CRITICAL, CORTEX_ANGLE, prefilter_reasons, constraint_reasons, save_reasons, load_reasons
+from src.utils.task_graph import TaskGraph
+from src.utils.scheduler import run_chunked
+from src.utils.candidates import PairGrid
+
+# the fiducials, shared by the data sets
+ENTRIES_PATH = Path("week-2", "practicals", "entries.fcsv")
+TARGETS_PATH = Path("week-2", "practicals", "targets.fcsv")
+
+
+class DataSet:
+    """
+    DataSet Class, the fiducials and the structures of one of the data sets of `SETS`, and the evaluation of their pairs.
+
+    Creating it only reads the fiducials and the geometry of the volumes. `start` builds the startup: a graph of tasks
+    run on a thread pool, where each structure is read, meshed and indexed as soon as its inputs are ready, independently
+    of the others; `add_evaluation` adds the evaluation of each constraint to the same graph so that it starts as soon as
+    its structure is ready, and `finish` waits for the structures. `load` does all of it.
+
+    The images are loaded lazily: only the structures referenced here are decompressed (or memory-mapped from the cache
+    of a previous run), as uint8 masks cropped to their bounding box; with a memory budget they are streamed into
+    memory-mapped files and meshed brick by brick instead of being held in memory.
+
+    Attributes:
+        - name (str): The key of the data set in `SETS`.
+        - target, cortex (str): The file names of the target structure and of the cortex.
+        - critical (tuple): The file names of the ventricles and of the vessels, combined into "ventricles_vessels".
+        - entries, targets (FCSV): The fiducials; entries_coords and targets_coords are their world coordinates, and
+          entries_idx and targets_idx their (unrounded) numpy indices.
+        - pairs (PairGrid): All the entry x target pairs, in the order of `product(entries, targets)`.
+        - reference_image: The geometry shared by all the volumes; spacing is its voxel spacing, for the lengths in mm.
+        - reasons_path (Path): The .npz file of the (N entries, M targets) uint8 array of the reasons of exclusion of every
+          pair, with the ids of the entries and targets (see `src.utils.exclusion.save_reasons`).
+        - masks, meshes, backends (dict): The structures by name, set by `finish`.
+        - cortex_angles: The `angle` queries of constraint (d), the backend of the cortex or its `NormalField`.
+        - times (dict): (start, end) of each startup task in seconds since the start of the startup, set by `finish`.
+
+    Methods:
+        - start: Build and start the startup graph.
+        - finish: Wait for the structures of the startup.
+        - add_evaluation: Add the packet evaluation of the constraints to the startup graph.
+        - evaluate_pairs: The reasons of exclusion of every pair.
+        - save_reasons, saved_reasons: Save the reasons of exclusion of every pair to `reasons_path`, read them from it.
+        - check_exclusion_reasons, check_validity: The reasons of exclusion and the validity of one pair.
+    """
+
+    def __init__(self, name: str, memory_budget: int = None):
+        directory, self.target, self.cortex = SETS[name]
+        self.name = name
+        self.critical = CRITICAL_STRUCTURES[name]
+        self.memory_budget = memory_budget
+
+        self.entries = FCSV(ENTRIES_PATH)
+        self.targets = FCSV(TARGETS_PATH)
+        self.entries_coords = self.entries.content_df[["x", "y", "z"]].to_numpy()
+        self.targets_coords = self.targets.content_df[["x", "y", "z"]].to_numpy()
+
+        self.volumes = VolumeStore(directory, memory_budget=memory_budget)
+        self.reference_image = self.volumes.info(self.target)
+        self.spacing = self.reference_image.GetSpacing()
+        self.entries_idx = np.array([point_to_numpy_idx(i, self.reference_image) for i in self.entries_coords])
+        self.targets_idx = np.array([point_to_numpy_idx(i, self.reference_image) for i in self.targets_coords])
+        self.pairs = PairGrid(self.entries_idx, self.targets_idx)
+        self.reasons_path = Path(f"exclusion_reasons_{name}.npz")
+
+        self.graph = None
+        self.mesh_pool = None
+        self.masks, self.meshes, self.backends, self.cortex_angles, self.times = {}, {}, {}, None, {}
+
+    def __repr__(self):
+        return f"DataSet({self.name}, {len(self.entries_idx)} entries, {len(self.targets_idx)} targets)"
+
+    @property
+    def structures(self) -> list:
+        """The names of all the structures: the volumes, then their union "ventricles_vessels"."""
+        return [self.target, *self.critical, self.cortex, "ventricles_vessels"]
+
+    @property
+    def queried(self) -> list:
+        """The names of the structures of the three surface constraints."""
+        return [self.target, "ventricles_vessels", self.cortex]
+
+    def _mesh(self, name, mask):
+        # the critical structures are split into connected components, e.g. one per vessel
+        split = name in (*self.critical, "ventricles_vessels")
+        if self.mesh_pool is None:
+            return mesh_structure(name, mask, 0.5, split, self.memory_budget)[1]
+        return self.mesh_pool.submit(mesh_structure, name, mask, 0.5, split).result()[1]
+
+    def _backend(self, name, mesh, _):
+        # every segment of the pairs lies in the convex hull of the entries and targets, so with SWEEP_CULLING the backend is
+        # built on the triangles in that hull only (grown by the radius of the electrode for the critical structures); it
+        # culls the mesh again by itself if it is asked about other points, e.g. after the fiducials moved
+        if not SWEEP_CULLING:
+            return make_backend(INTERSECTION_BACKEND, mesh)
+        points = np.concatenate([self.entries_idx, self.targets_idx])
+        return SweepBackend(INTERSECTION_BACKEND, mesh, points, ELECTRODE_RADIUS if name == "ventricles_vessels" else 0.0, self.spacing)
+
+    @property
+    def cortex_angles_task(self) -> str:
+        """The task of the angles of constraint (d), from the normal of the triangles of the cortex, or with
+        CORTEX_ANGLE_MODE "field" from the normal field of its mask, which needs neither its mesh nor its backend."""
+        return f"normal field {self.cortex}" if CORTEX_ANGLE_MODE == "field" else f"{INTERSECTION_BACKEND} backend {self.cortex}"
+
+    def start(self) -> "DataSet":
+        """Build the startup graph and start it in the background."""
+        self.graph = TaskGraph(max_workers=max(4, os.cpu_count() or 1))
+
+        # skimage's marching cubes holds the GIL, so with several CPUs the structures are meshed in worker processes; they
+        # are forked from a server that imported this module (and the meshing code) once, never from this process and its
+        # running threads, so that importing the main script in each of them is immediate;
+        # with a memory budget they are meshed brick by brick in this process, as sending the memory-mapped masks to the
+        # workers would copy them whole
+        if (os.cpu_count() or 1) > 1 and self.memory_budget is None:
+            context = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+            if context.get_start_method() == "forkserver":
+                context.set_forkserver_preload([__name__])
+            self.mesh_pool = ProcessPoolExecutor(os.cpu_count(), mp_context=context)
+
+        for i in [self.target, *self.critical, self.cortex]:
+            self.graph.add(f"read {i}", partial(self.volumes.mask, i))
+        # combine the ventricles and vessels into one so that we can check for intersection with them
+        self.graph.add(
+            "read ventricles_vessels",
+            partial(union_masks, path=self.volumes.cache_dir / "ventricles_vessels.npy", memory_budget=self.memory_budget),
+            *(f"read {i}" for i in self.critical),
+        )
+        for i in self.structures:
+            # float32 / int32 with the triangle data precomputed for the kernels, meshed within the bounding box of the structure
+            self.graph.add(f"mesh {i}", partial(self._mesh, i), f"read {i}")
+        # compile the kernels (or load them from the numba cache) before they are used
+        self.graph.add("jit warm-up", warm_up)
+        # the "segment vs surface" queries of the constraints, answered by the backend selected in src/config.py
+        for i in self.queried:
+            self.graph.add(f"{INTERSECTION_BACKEND} backend {i}", partial(self._backend, i), f"mesh {i}", "jit warm-up")
+        if CORTEX_ANGLE_MODE == "field":
+            self.graph.add(
+                f"normal field {self.cortex}",
+                partial(NormalField, spacing=self.spacing, sigma=NORMAL_SMOOTHING, memory_budget=self.memory_budget),
+                f"read {self.cortex}",
+            )
+        # cheap analytic prefilter (length and bounding boxes) over all the combinations at once
+        self.graph.add(
+            "prefilter",
+            lambda target_mesh, critical_mesh: prefilter(
+                self.entries_idx, self.targets_idx, self.spacing, target_mesh, critical_mesh, MAX_LENGTH, ELECTRODE_RADIUS
+            ),
+            f"mesh {self.target}",
+            "mesh ventricles_vessels",
+        )
+        self.graph.start()
+        return self
+
+    def finish(self) -> "DataSet":
+        """Wait for the structures of the startup graph and set `masks`, `meshes`, `backends` and `cortex_angles`."""
+        self.masks = {i: self.graph.result(f"read {i}") for i in self.structures}
+        self.meshes = {i: self.graph.result(f"mesh {i}") for i in self.structures}
+        self.backends = {i: self.graph.result(f"{INTERSECTION_BACKEND} backend {i}") for i in self.queried}
+        self.cortex_angles = self.graph.result(self.cortex_angles_task)
+        self.graph.result("prefilter")
+        if self.mesh_pool is not None:
+            self.mesh_pool.shutdown()
+            self.mesh_pool = None
+
+        # (start, end) of each task in seconds since the start of the graph, printed in the run report
+        self.times = {i: j for i, j in sorted(self.graph.times.items(), key=lambda i: i[1]) if not i.startswith("reasons")}
+        return self
+
+    def check_exclusion_reasons(self, entry_target_tuple) -> int:
+        """
+        Check the reasons of exclusion of an entry and target tuple.
+
+        Every constraint is evaluated (there is no short-circuit), and each one that the pair violates sets its bit of `src.utils.exclusion`: NOT_IN_TARGET if the segment does not intersect with the target structure, CRITICAL if it intersects with the ventricles or vessels (or comes within ELECTRODE_RADIUS mm of them), and CORTEX_ANGLE if its angle with the cortex is greater than (90 - 55) degrees.
+        The length constraint and the bounding box checks are done beforehand for all the pairs at once by `prefilter`.
+
+        Parameters:
+        - entry_target_tuple (tuple): A tuple of entry and target, optionally followed by two bools that are False when the prefilter found that the segment misses the bounding box of the target structure and of the ventricles and vessels respectively.
+
+        Returns:
+        - int: The reason bits, 0 if the entry and target tuple is valid.
+        """
+
+        entry, target = entry_target_tuple[:2]
+        target_box, test_critical = entry_target_tuple[2:] if len(entry_target_tuple) > 2 else (True, True)
+
+        reasons = 0
+        if not (target_box and self.backends[self.target].intersects(entry, target)):
+            reasons |= NOT_IN_TARGET
+
+        if test_critical and (
+            self.backends["ventricles_vessels"].capsule_packet(entry, target[None], ELECTRODE_RADIUS, self.spacing)[0]
+            if ELECTRODE_RADIUS > 0
+            else self.backends["ventricles_vessels"].intersects(entry, target)
+        ):
+            reasons |= CRITICAL
+
+        # since i am taking the normal we want it to be smaller
+        if self.cortex_angles.angle(entry, target) > (90 - 55):
+            reasons |= CORTEX_ANGLE
+
+        return int(reasons)
+
+    def check_validity(self, entry_target_tuple) -> bool:
+        """
+        Check the validity of an entry and target tuple, i.e. that `check_exclusion_reasons` finds no reason to exclude it.
+
+        Parameters:
+        - entry_target_tuple (tuple): See `check_exclusion_reasons`.
+
+        Returns:
+        - bool: The validity of the entry and target tuple.
+        """
+        return self.check_exclusion_reasons(entry_target_tuple) == 0
+
+    def check_exclusion_reasons_range(self, start, end) -> np.ndarray:
+        """
+        The reasons of exclusion of `check_exclusion_reasons` for the pairs start to end (excluded) of `pairs`, with the batch queries of the backends: each constraint queries only the pairs that the bounding box checks of the prefilter left.
+
+        Returns:
+        - np.ndarray: The (end - start,) uint8 array of the reason bits.
+        """
+
+        prefilter_masks = self.graph.result("prefilter")
+        entry_idx, target_idx = self.pairs.indices(start, end)
+        entries, targets = self.pairs.entries[entry_idx], self.pairs.targets[target_idx]
+        target_box = prefilter_masks["target_box"][entry_idx, target_idx]
+        test_critical = prefilter_masks["test_critical"][entry_idx, target_idx]
+
+        reasons = np.zeros(end - start, dtype=np.uint8)
+        hits = np.zeros(end - start, dtype=bool)
+        hits[target_box] = self.backends[self.target].intersects_batch(entries[target_box], targets[target_box])
+        reasons[~hits] |= NOT_IN_TARGET
+        critical = self.backends["ventricles_vessels"].capsule_batch(entries[test_critical], targets[test_critical], ELECTRODE_RADIUS, self.spacing)
+        reasons[np.flatnonzero(test_critical)[critical]] |= CRITICAL
+        # since i am taking the normal we want it to be smaller
+        reasons[self.cortex_angles.angle_batch(entries, targets) > (90 - 55)] |= CORTEX_ANGLE
+        return reasons
+
+    def add_evaluation(self, chunks: int = None):
+        """
+        Add the evaluation of the constraints with the packet queries to the startup graph, in chunks of entries, and the task "reasons" combining them.
+
+        Each constraint depends only on its own structure, so its evaluation starts as soon as that structure is meshed and indexed, while the other structures may still be loading.
+
+        Parameters:
+        - chunks (int): The number of chunks of entries per constraint. Defaults to four per thread.
+        """
+
+        chunks = chunks or 4 * self.graph.max_workers
+        constraints = [
+            (NOT_IN_TARGET, f"{INTERSECTION_BACKEND} backend {self.target}", "target_box", None),
+            (CRITICAL, f"{INTERSECTION_BACKEND} backend ventricles_vessels", "test_critical", None),
+            # since i am taking the normal we want it to be smaller
+            (CORTEX_ANGLE, self.cortex_angles_task, None, 90 - 55),
+        ]
+
+        def task(bit, rows, tested, max_angle, backend, prefilter_masks):
+            tested = prefilter_masks[tested][rows] if tested else np.ones((len(rows), len(self.targets_idx)), dtype=bool)
+            return constraint_reasons(bit, backend, self.entries_idx[rows], self.targets_idx, tested, max_angle, ELECTRODE_RADIUS, self.spacing)
+
+        names = []
+        for bit, queries, tested, max_angle in constraints:
+            for k, rows in enumerate(np.array_split(np.arange(len(self.entries_idx)), chunks)):
+                names.append(f"reasons {bit} {k}")
+                self.graph.add(names[-1], partial(task, bit, rows, tested, max_angle), queries, "prefilter")
+
+        def combine(prefilter_masks, *parts):
+            reasons = prefilter_reasons(prefilter_masks, MAX_LENGTH)
+            for bit in range(len(constraints)):
+                reasons |= np.concatenate(parts[bit * chunks : (bit + 1) * chunks])
+            return reasons
+
+        self.graph.add("reasons", combine, "prefilter", *names)
+
+    def evaluate_pairs(self) -> np.ndarray:
+        """
+        Evaluate every entry and target pair in one pass: the prefilter first, then the surface queries of the intersection backend, in the startup graph (QUERY_MODE "packet") or in chunks of pairs on a thread pool.
+
+        Returns:
+        - np.ndarray: The (N entries, M targets) uint8 array of the reason bits of every pair (see `src.utils.exclusion`), 0 where the pair is valid.
+        """
+
+        prefilter_masks = self.graph.result("prefilter")
+        print(f"Number of combinations left after the prefilter: {prefilter_masks['candidate'].sum()} / {len(self.pairs)}")
+
+        if QUERY_MODE == "packet":
+            if "reasons" not in self.graph:
+                self.add_evaluation()
+            return self.graph.result("reasons")
+
+        # the kernels release the GIL, so the threads share the backends; they get ranges of pair indices, sized from
+        # the measured throughput
+        workers = os.cpu_count() or 1
+        with ThreadPoolExecutor(workers) as executor:
+            results = run_chunked(self.check_exclusion_reasons_range, len(self.pairs), executor, workers)
+
+        reasons = prefilter_reasons(prefilter_masks, MAX_LENGTH)
+        reasons |= np.array(results, dtype=np.uint8).reshape(reasons.shape)
+        return reasons
+
+    def save_reasons(self, reasons: np.ndarray):
+        """Save the reasons of exclusion of every pair to `reasons_path`, with the ids of the entries and targets."""
+        save_reasons(self.reasons_path, reasons, self.entries.content_df["id"].to_numpy(), self.targets.content_df["id"].to_numpy())
+
+    def saved_reasons(self) -> np.ndarray:
+        """The reasons of exclusion of every pair saved in `reasons_path` by the main script, or if they are missing or
+        were saved for other fiducials, those of `evaluate_pairs`, saved there."""
+        reasons = load_reasons(self.reasons_path, self.entries.content_df["id"].to_numpy(), self.targets.content_df["id"].to_numpy())
+        if reasons is None:
+            reasons = self.evaluate_pairs()
+            self.save_reasons(reasons)
+        return reasons
+
+
+def load(name: str, finish: bool = True) -> DataSet:
+    """The data set `name` of `SETS` with the memory budget of src/config.py, started, and with its structures loaded
+    unless `finish` is False (e.g. to add the evaluation to the startup first, see `DataSet`)."""
+    memory_budget = int(MEMORY_BUDGET_MB * 2**20) if MEMORY_BUDGET_MB is not None else None
+    data = DataSet(name, memory_budget).start()
+    return data.finish() if finish else data
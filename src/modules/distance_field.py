@@ -0,0 +1,146 @@
+import math
+import tempfile
+import numpy as np
+from numba import njit
+from scipy.ndimage import distance_transform_edt
+
+from src.modules.volumes import CroppedMask
+from src.modules.bricks import brick_size, brick_ranges, brick_occupancy, region_occupied, read_region
+
+
+@njit(cache=True, nogil=True)
+def trilinear(field, x, y, z, outside):
+    """The trilinear interpolation of `field` at the (fractional) index (x, y, z), `outside` beyond its last samples."""
+    if not (0 <= x <= field.shape[0] - 1 and 0 <= y <= field.shape[1] - 1 and 0 <= z <= field.shape[2] - 1):
+        return outside
+    i, j, k = min(int(x), field.shape[0] - 2), min(int(y), field.shape[1] - 2), min(int(z), field.shape[2] - 2)
+    if i < 0 or j < 0 or k < 0:  # a single sample along an axis
+        return np.float64(field[int(x), int(y), int(z)])
+    fx, fy, fz = x - i, y - j, z - k
+    value = 0.0
+    for a in range(2):
+        wx = fx if a else 1 - fx
+        for b in range(2):
+            wy = fy if b else 1 - fy
+            for c in range(2):
+                wz = fz if c else 1 - fz
+                value += wx * wy * wz * field[i + a, j + b, k + c]
+    return value
+
+
+@njit(cache=True, nogil=True)
+def segments_min_value(p1s, p2s, field, offset, step, outside):
+    """
+    The minimum of `field` sampled every `step` (at most) along each of the segments p1s[k] -> p2s[k], both ends included.
+
+    Args:
+    ----
+    p1s, p2s: np.ndarray
+        (n, 3) arrays of the points of the segments in numpy indices of the full volume
+    field: np.ndarray
+        3D array of values covering the full volume from `offset`
+    offset: np.ndarray
+        (3,) index in the full volume of field[0, 0, 0]
+    step: float
+        maximum distance between two samples, in voxels
+    outside: float
+        value of the field outside of the array
+
+    Returns:
+    -------
+    np.ndarray:
+        (n,) array of the minimum of each segment
+    """
+    result = np.empty(p1s.shape[0])
+    for n in range(p1s.shape[0]):
+        px, py, pz = p1s[n, 0] - offset[0], p1s[n, 1] - offset[1], p1s[n, 2] - offset[2]
+        dx, dy, dz = p2s[n, 0] - p1s[n, 0], p2s[n, 1] - p1s[n, 1], p2s[n, 2] - p1s[n, 2]
+        samples = max(1, int(np.ceil(np.sqrt(dx * dx + dy * dy + dz * dz) / step)))
+        best = outside
+        for s in range(samples + 1):
+            t = s / samples
+            best = min(best, trilinear(field, px + t * dx, py + t * dy, pz + t * dz, outside))
+        result[n] = best
+    return result
+
+
+class DistanceField:
+    """
+    DistanceField Class, the distance in mm from every voxel to the nearest voxel of a structure.
+
+    The Euclidean distance transform is computed once, with the voxel spacing, on the bounding box of the structure grown
+    by `max_distance` on every side, and clipped at `max_distance`: farther voxels only need to be known to be far. The
+    field is then sampled with trilinear interpolation, e.g. along trajectories to score their clearance.
+
+    With a `memory_budget` in bytes, the transform is computed brick by brick into a temporary memory-mapped file. Each
+    brick reads the mask grown by `max_distance` on every side (its halo): the nearest voxel of the structure of any
+    voxel closer than `max_distance` is inside it, so the clipped distances are the same as those of the whole box.
+
+    Attributes:
+        - array (np.ndarray): The float32 distances in mm, clipped at `max_distance`.
+        - offset (np.ndarray): The index of array[0, 0, 0] in the full volume.
+        - max_distance (float): The distance given outside of `array` and the upper bound of the field.
+
+    Methods:
+        - sample: The distance at points.
+        - segment_clearance: The minimum distance along segments.
+    """
+
+    __slots__ = ("array", "offset", "max_distance")
+
+    def __init__(self, mask: CroppedMask, spacing, max_distance: float = 10.0, memory_budget: int = None):
+        self.max_distance = float(max_distance)
+        spacing = np.asarray(spacing, dtype=np.float64)
+        margin = np.array([math.ceil(self.max_distance / i) + 1 for i in spacing])
+        self.offset = np.asarray(mask.offset, dtype=np.int64) - margin
+        if not mask.array.any():  # nothing to be close to
+            self.array = np.zeros((0, 0, 0), dtype=np.float32)
+            return
+        if memory_budget is not None:
+            self.array = self._bricked(mask, spacing, margin, memory_budget)
+            return
+        padded = np.ones(np.add(mask.array.shape, 2 * margin), dtype=bool)
+        padded[tuple(slice(m, m + s) for m, s in zip(margin, mask.array.shape))] = mask.array == 0
+        distances = distance_transform_edt(padded, sampling=spacing)
+        self.array = np.minimum(distances, self.max_distance).astype(np.float32)
+
+    def _bricked(self, mask: CroppedMask, spacing, margin, memory_budget: int) -> np.ndarray:
+        # the transform works on the bool input, its float64 output and the int32 indices of its features
+        brick = brick_size(memory_budget, 22, halo=int(margin.max()))
+        occupancy = brick_occupancy(mask.array, brick)
+        shape = tuple(int(i) for i in np.add(mask.array.shape, 2 * margin))
+        array = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=shape)
+        for start, end in brick_ranges(shape, brick):
+            lower, upper = self.offset + start - margin, self.offset + end + margin  # the brick and its halo
+            target = tuple(slice(s, e) for s, e in zip(start, end))
+            if not region_occupied(mask, occupancy, brick, lower, upper):
+                array[target] = self.max_distance
+                continue
+            region = read_region(mask, lower, upper)
+            if not region.any():
+                array[target] = self.max_distance
+                continue
+            distances = distance_transform_edt(region == 0, sampling=spacing)
+            array[target] = np.minimum(distances[tuple(slice(m, m + e - s) for m, s, e in zip(margin, start, end))], self.max_distance)
+        array.flush()
+        return np.asarray(array)  # a plain view of the mapped file for the kernels
+
+    def __repr__(self):
+        return f"DistanceField(offset={tuple(self.offset)}, shape={self.array.shape}, max_distance={self.max_distance})"
+
+    def sample(self, points) -> np.ndarray:
+        """The distance in mm at each of the (n, 3) points in numpy indices."""
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        return segments_min_value(points, points, self.array, self.offset.astype(np.float64), 1.0, self.max_distance)
+
+    def segment_clearance(self, p1s, p2s, step: float = 0.5) -> np.ndarray:
+        """The minimum distance in mm to the structure along each of the segments p1s[k] -> p2s[k] in numpy indices,
+        sampled at most every `step` voxels; 0 where a segment passes through a voxel of the structure."""
+        return segments_min_value(
+            np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3),
+            np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3),
+            self.array,
+            self.offset.astype(np.float64),
+            step,
+            self.max_distance,
+        )
@@ -0,0 +1,213 @@
+import hashlib
+import math
+import tempfile
+import numpy as np
+from skimage import measure
+
+from src.modules.mesh import Mesh
+from src.modules.bvh import BrickedBVH
+from src.modules.backends import BVHBackend
+from src.modules.volumes import CroppedMask
+from src.modules.bricks import brick_occupancy, region_occupied, read_region
+from src.utils.marching_cubes import vertex_keys, face_keys
+
+
+def region_hash(region: np.ndarray) -> int:
+    """A 64-bit hash of the voxels of a region, 0 if they are all zero (e.g. a brick outside of the structure)."""
+    if not region.any():
+        return 0
+    return int.from_bytes(hashlib.blake2b(np.ascontiguousarray(region).tobytes(), digest_size=8).digest(), "little") or 1
+
+
+class IncrementalSurface:
+    """
+    IncrementalSurface Class, the mesh and the `BrickedBVH` of a binary mask, updated in place after local edits.
+
+    The cubes of marching cubes are split into bricks of `brick` cubes a side, meshed separately like in
+    `marching_cubes_bricked`. When voxels of the mask change, only the bricks with a cube that has one of them as a
+    corner (the dirty bricks) are meshed again: their faces replace the old ones in the mesh, which stays sorted by
+    `face_keys`, the seam vertices are welded by `vertex_keys`, and the BVH builds the subtrees of the dirty bricks
+    again and refits its top levels. The mesh is always the one `marching_cubes_bricked` gives for the current mask, so
+    the queries answer exactly as after a full rebuild, and the faces of the clean bricks keep their relative order.
+
+    The mask is kept cropped (e.g. memory-mapped from the cache of `VolumeStore`) and never expanded to the full volume:
+    the voxels of each brick are read when it is meshed, and a hash of them is kept, so that a new mask is compared with
+    the current one brick by brick, reading only the bricks that are occupied in either of them. Edits are written into
+    a copy of the mask grown to cover them, in a temporary memory-mapped file with a `memory_budget`.
+
+    Attributes:
+        - mask (CroppedMask): The current mask.
+        - brick (int): The side of the bricks, in cubes.
+        - mesh (Mesh): The current surface (not split into components).
+        - bvh (BrickedBVH): The hierarchy over the current surface.
+        - backend (BVHBackend): The queries of the current surface; the same object is updated in place.
+
+    Methods:
+        - update: Replace the mask by a new one and return the dirty regions.
+        - edit: Write a block of voxels into the mask and return the dirty regions.
+    """
+
+    def __init__(self, mask: CroppedMask, level: float = 0.5, brick: int = 16, memory_budget: int = None):
+        self.mask = mask
+        self.level = level
+        self.brick = brick
+        self.memory_budget = memory_budget
+        self.cubes = tuple(s - 1 for s in mask.shape)
+        self.grid = tuple(math.ceil(c / brick) for c in self.cubes)
+        self._occupancy = brick_occupancy(mask.array, brick)
+        self._owned = False  # whether `mask.array` is a copy that the edits can be written into
+
+        # the boxes of the bricks: the cubes [lower, upper) span the voxels [lower, upper]
+        index = np.indices(self.grid).reshape(3, -1).T
+        self.brick_lower = index * brick
+        self.brick_upper = np.minimum(self.brick_lower + brick, self.cubes)
+        self.bvh = BrickedBVH(self.brick_lower.astype(np.float32), self.brick_upper.astype(np.float32))
+
+        # the hash of the voxels of each brick, then the faces of the mesh in the order of their keys, with their brick,
+        # the keys of their vertices and their corners
+        self._hashes = np.zeros(len(index), dtype=np.uint64)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._bricks = np.zeros(0, dtype=np.int32)
+        self._vertex_keys = np.zeros((0, 3), dtype=np.int64)
+        self._triangles = np.zeros((0, 3, 3), dtype=np.float32)
+        self.mesh = None
+        self.backend = None
+        self._remesh(np.arange(len(index)))
+
+    def __repr__(self):
+        return f"IncrementalSurface(brick={self.brick}, grid={self.grid}, mesh={self.mesh})"
+
+    def update(self, mask: CroppedMask) -> np.ndarray:
+        """Replace the mask by `mask` (e.g. the segmentation saved again after a touch-up), of the same volume.
+
+        Returns:
+            (k, 2, 3) array of boxes in numpy indices, the lower and upper corner of the changed part of each dirty
+            brick; every triangle that was removed or added is inside one of them.
+        """
+        if mask.shape != self.mask.shape:
+            raise ValueError(f"The mask of shape {mask.shape} is not of the volume of shape {self.mask.shape}")
+        occupancy = brick_occupancy(mask.array, self.brick)
+        changed = [np.zeros((0, 3), dtype=np.int64)]
+        for brick, (lower, upper) in enumerate(zip(self.brick_lower, self.brick_upper + 1)):
+            if not self._hashes[brick] and not region_occupied(mask, occupancy, self.brick, lower, upper):
+                continue  # empty before and after
+            region = read_region(mask, lower, upper)
+            if region_hash(region) != self._hashes[brick]:
+                changed.append(np.argwhere(read_region(self.mask, lower, upper) != region) + lower)
+        self.mask, self._occupancy, self._owned = mask, occupancy, False
+        return self._changed(np.unique(np.concatenate(changed), axis=0))
+
+    def edit(self, lower, values: np.ndarray) -> np.ndarray:
+        """Write the block `values` into the mask from the voxel `lower`, e.g. a few retouched slices.
+
+        Returns:
+            The boxes of the dirty regions, see `update`.
+
+        Raises:
+            ValueError: If `values` is not a 3D block inside the volume from `lower`.
+        """
+        values = np.asarray(values, dtype=np.uint8)
+        lower = np.asarray(lower, dtype=np.int64)
+        if values.ndim != 3 or lower.shape != (3,):
+            raise ValueError(f"The edit of shape {values.shape} from {lower.tolist()} is not a 3D block of voxels")
+        upper = lower + values.shape
+        if (lower < 0).any() or (upper > self.mask.shape).any():
+            raise ValueError(f"The edit [{lower.tolist()}, {upper.tolist()}) is not inside the volume of shape {self.mask.shape}")
+        changed = np.argwhere(read_region(self.mask, lower, upper) != values) + lower
+        self._grow(lower, upper)
+        start = lower - self.mask.offset
+        self.mask.array[tuple(slice(s, s + n) for s, n in zip(start, values.shape))] = values
+        if values.any():  # the occupancy stays conservative where voxels were cleared
+            self._occupancy[tuple(slice(s // self.brick, (s + n - 1) // self.brick + 1) for s, n in zip(start, values.shape))] = True
+        return self._changed(changed)
+
+    def _grow(self, lower, upper):
+        """Make `mask` a copy owned by the surface that covers the voxels [lower, upper), if it is not already."""
+        offset = np.asarray(self.mask.offset)
+        end = offset + self.mask.array.shape
+        if self.mask.array.size:
+            lower, upper = np.minimum(offset, lower), np.maximum(end, upper)
+        if self._owned and (lower == offset).all() and (upper == end).all():
+            return
+        shape = tuple(int(i) for i in upper - lower)
+        if self.memory_budget is None:
+            array = read_region(self.mask, lower, upper)
+        else:
+            # copied slab by slab along the first axis, like `union_masks`
+            array = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=shape)
+            thickness = max(1, self.memory_budget // (2 * max(int(np.prod(shape[1:])), 1)))
+            for i in range(0, shape[0], thickness):
+                j = min(i + thickness, shape[0])
+                array[i:j] = read_region(self.mask, (lower[0] + i, *lower[1:]), (lower[0] + j, *upper[1:]))
+        self.mask = CroppedMask(array, lower, self.mask.shape)
+        self._occupancy = brick_occupancy(array, self.brick)
+        self._owned = True
+
+    def _changed(self, voxels: np.ndarray) -> np.ndarray:
+        if not len(voxels):
+            return np.zeros((0, 2, 3))
+        # a voxel is a corner of the cubes from voxel - 1 to voxel along each axis
+        corners = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        cubes = np.clip(voxels[:, None] - corners, 0, np.subtract(self.cubes, 1)).reshape(-1, 3)
+        bricks = np.unique(np.ravel_multi_index(tuple((cubes // self.brick).T), self.grid))
+        self._remesh(bricks)
+
+        lower = np.maximum(self.brick_lower[bricks], voxels.min(axis=0) - 1)
+        upper = np.minimum(self.brick_upper[bricks], voxels.max(axis=0) + 1)
+        return np.stack([lower, upper], axis=1).astype(np.float64)
+
+    def _mesh_brick(self, brick: int, region: np.ndarray):
+        """The keys, vertex keys and corners of the faces of one brick of voxels `region`, in the order of their keys,
+        or None."""
+        if region.min() == region.max():  # no surface inside
+            return None
+        verts, faces, _, _ = measure.marching_cubes(region, level=self.level)
+        triangles = (verts + self.brick_lower[brick].astype(verts.dtype))[faces]
+        keys = face_keys(triangles, self.mask.shape)
+        order = np.argsort(keys, kind="stable")
+        return keys[order], vertex_keys(triangles[order].reshape(-1, 3), self.mask.shape).reshape(-1, 3), triangles[order]
+
+    def _remesh(self, bricks: np.ndarray):
+        """Mesh the `bricks` again and splice their faces into the mesh, then update the BVH."""
+        pieces = []
+        for brick in bricks:
+            lower, upper = self.brick_lower[brick], self.brick_upper[brick] + 1
+            if not region_occupied(self.mask, self._occupancy, self.brick, lower, upper):
+                self._hashes[brick] = 0
+                continue
+            region = read_region(self.mask, lower, upper)
+            self._hashes[brick] = region_hash(region)
+            pieces.append((brick, self._mesh_brick(brick, region)))
+        pieces = [(brick, piece) for brick, piece in pieces if piece is not None]
+        keep = ~np.isin(self._bricks, bricks)
+        if pieces:
+            keys = np.concatenate([piece[0] for _, piece in pieces])
+            order = np.argsort(keys, kind="stable")
+            new_bricks = np.concatenate([np.full(len(piece[0]), brick, dtype=np.int32) for brick, piece in pieces])[order]
+            new_vertex_keys = np.concatenate([piece[1] for _, piece in pieces])[order]
+            new_triangles = np.concatenate([piece[2] for _, piece in pieces])[order]
+            keys = keys[order]
+        else:
+            keys = np.zeros(0, dtype=np.int64)
+            new_bricks, new_vertex_keys, new_triangles = np.zeros(0, np.int32), np.zeros((0, 3), np.int64), np.zeros((0, 3, 3), np.float32)
+
+        # merge the new faces into the kept ones, both sorted by key
+        kept_keys = self._keys[keep]
+        positions = np.searchsorted(kept_keys, keys)
+        self._keys = np.insert(kept_keys, positions, keys)
+        self._bricks = np.insert(self._bricks[keep], positions, new_bricks)
+        self._vertex_keys = np.insert(self._vertex_keys[keep], positions, new_vertex_keys, axis=0)
+        self._triangles = np.insert(self._triangles[keep], positions, new_triangles, axis=0)
+
+        # number the vertices by first use, like `marching_cubes_bricked`
+        _, first, inverse = np.unique(self._vertex_keys.reshape(-1), return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        renumber = np.empty(len(first), dtype=np.int32)
+        renumber[order] = np.arange(len(first), dtype=np.int32)
+        verts = self._triangles.reshape(-1, 3)[first[order]]
+        self.mesh = Mesh(verts, renumber[inverse].reshape(-1, 3))
+
+        self.bvh.update(self.mesh, self._bricks, bricks)
+        if self.backend is None:
+            self.backend = BVHBackend(self.mesh, self.bvh)
+        self.backend.mesh = self.mesh
@@ -0,0 +1,234 @@
+import math
+import tempfile
+import numpy as np
+from numba import njit
+from scipy.ndimage import gaussian_filter
+
+from src.modules.volumes import CroppedMask
+from src.modules.bricks import brick_size, brick_ranges, brick_occupancy, region_occupied, read_region
+from src.modules.distance_field import trilinear
+
+# the value of the smoothed mask on its surface, that of the marching cubes of the masks
+LEVEL = 0.5
+# the crossing is found on pieces of at most a quarter of a voxel, then refined by bisection to this fraction of a voxel
+SUBDIVISIONS = 4
+TOLERANCE = 1e-4
+
+
+@njit(cache=True, nogil=True)
+def first_crossing(p, d, field, level):
+    """
+    The first point of the segment p -> p + d where the trilinear interpolation of `field` crosses `level`, found by a
+    voxel traversal (Amanatides & Woo) of the cells between its samples.
+
+    The value of a cell is bounded by those of its 8 corners, so the cells entirely on the side of p are skipped; in the
+    others, the piece of the segment is sampled `SUBDIVISIONS` times and the first change of side is refined by bisection.
+
+    Args:
+    ----
+    p, d: np.ndarray
+        (3,) start point and direction of the segment, in indices of `field`
+    field: np.ndarray
+        3D array of values, 0 outside of it
+    level: float
+        the value of the surface
+
+    Returns:
+    -------
+    float:
+        t in (0, 1) of the crossing, -1.0 if the segment does not cross the surface
+    """
+    inside = trilinear(field, p[0], p[1], p[2], 0.0) >= level
+    t0, t1 = 0.0, 1.0  # clip the segment to the samples of the field
+    for a in range(3):
+        upper = field.shape[a] - 1
+        if abs(d[a]) < 1e-12:
+            if p[a] < 0 or p[a] > upper:
+                return -1.0
+            continue
+        ta, tb = -p[a] / d[a], (upper - p[a]) / d[a]
+        t0, t1 = max(t0, min(ta, tb)), min(t1, max(ta, tb))
+    if t0 >= t1:
+        return -1.0
+
+    cell = np.empty(3, dtype=np.int64)
+    step = np.empty(3, dtype=np.int64)
+    t_max = np.empty(3)
+    t_delta = np.empty(3)
+    for a in range(3):
+        x = p[a] + t0 * d[a]
+        cell[a] = min(max(int(math.floor(x)), 0), field.shape[a] - 2)
+        if d[a] > 1e-12:
+            step[a], t_max[a], t_delta[a] = 1, (cell[a] + 1 - p[a]) / d[a], 1 / d[a]
+        elif d[a] < -1e-12:
+            step[a], t_max[a], t_delta[a] = -1, (cell[a] - p[a]) / d[a], -1 / d[a]
+        else:
+            step[a], t_max[a], t_delta[a] = 0, np.inf, np.inf
+
+    t_enter = t0
+    while t_enter < t1:
+        a = 0 if t_max[0] <= t_max[1] and t_max[0] <= t_max[2] else (1 if t_max[1] <= t_max[2] else 2)
+        t_exit = min(t_max[a], t1)
+        lowest, highest = np.inf, -np.inf
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    value = field[cell[0] + i, cell[1] + j, cell[2] + k]
+                    lowest, highest = min(lowest, value), max(highest, value)
+        if (lowest < level) if inside else (highest >= level):
+            previous = t_enter
+            for s in range(1, SUBDIVISIONS + 1):
+                t = t_enter + (t_exit - t_enter) * s / SUBDIVISIONS
+                if (trilinear(field, p[0] + t * d[0], p[1] + t * d[1], p[2] + t * d[2], 0.0) >= level) != inside:
+                    low, high = previous, t
+                    while (high - low) * math.sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2]) > TOLERANCE:
+                        middle = 0.5 * (low + high)
+                        if (trilinear(field, p[0] + middle * d[0], p[1] + middle * d[1], p[2] + middle * d[2], 0.0) >= level) != inside:
+                            high = middle
+                        else:
+                            low = middle
+                    return high if high < 1 else -1.0
+                previous = t
+        t_enter = t_exit
+        cell[a] += step[a]
+        if cell[a] < 0 or cell[a] > field.shape[a] - 2:
+            break
+        t_max[a] += t_delta[a]
+    return -1.0
+
+
+@njit(cache=True, nogil=True)
+def crossing_angle(p1, p2, field, gradient, offset, spacing, level):
+    """The angle in degrees between the segment p1 -> p2 (numpy indices of the full volume) and the normal of the
+    surface `level` of `field` where the segment first crosses it, in mm; 0.0 if it does not cross it (see
+    `first_crossing`). The normal is the trilinear interpolation of the precomputed `gradient` of the field."""
+    p = np.empty(3)
+    d = np.empty(3)
+    for a in range(3):
+        p[a], d[a] = p1[a] - offset[a], p2[a] - p1[a]
+    t = first_crossing(p, d, field, level)
+    if t < 0:
+        return 0.0
+    x, y, z = p[0] + t * d[0], p[1] + t * d[1], p[2] + t * d[2]
+    dot, d_norm, n_norm = 0.0, 0.0, 0.0
+    for a in range(3):
+        n = trilinear(gradient[a], x, y, z, 0.0) / spacing[a]  # per mm
+        dot += d[a] * spacing[a] * n
+        d_norm += (d[a] * spacing[a]) ** 2
+        n_norm += n * n
+    if d_norm == 0 or n_norm == 0:
+        return 0.0
+    # the smaller of the angle and its complementary angle (180 - angle), as for the triangles of the mesh
+    return math.degrees(math.acos(min(abs(dot) / math.sqrt(d_norm * n_norm), 1.0)))
+
+
+@njit(cache=True, nogil=True)
+def crossing_angles(p1s, p2s, field, gradient, offset, spacing, level):
+    """`crossing_angle` for each of the segments p1s[k] -> p2s[k]."""
+    angles = np.empty(p1s.shape[0])
+    for n in range(p1s.shape[0]):
+        angles[n] = crossing_angle(p1s[n], p2s[n], field, gradient, offset, spacing, level)
+    return angles
+
+
+class NormalField:
+    """
+    NormalField Class, a smoothed mask of a structure (the cortex) and its gradient, to measure the angle of trajectories
+    to the normal of its surface without its mesh.
+
+    The normal of a single triangle of the marching cubes is that of the staircase of the voxels, so the angle of a
+    trajectory may change by tens of degrees between neighbouring entries. Here the mask is smoothed once by a gaussian
+    of `sigma` voxels and the derivatives of that gaussian give its gradient, the normal of the smoothed surface. The angle
+    is then read from the gradient where the segment first crosses the surface (the value 0.5 of the smoothed mask,
+    found by a voxel traversal), with no loop over triangles. Both are computed on the bounding box of the structure,
+    grown by the radius of the gaussian.
+
+    With a `memory_budget` in bytes, they are computed brick by brick into a temporary memory-mapped file, each brick
+    reading the mask grown by the radius of the gaussian (its halo), which gives the values of the whole box.
+
+    Unlike `IntersectionBackend.angle`, the angle is taken at the first crossing along the segment, and in mm.
+
+    Attributes:
+        - array (np.ndarray): The float32 smoothed mask.
+        - gradient (np.ndarray): The (3, ...) float32 gradient of `array`, per voxel.
+        - offset (np.ndarray): The index of array[0, 0, 0] in the full volume.
+        - spacing (np.ndarray): The voxel spacing, in mm.
+        - sigma (float): The standard deviation of the gaussian, in voxels.
+
+    Methods:
+        - crossings: The first point where segments cross the surface.
+        - angle, angle_packet, angle_batch: The angles of segments, as those of `IntersectionBackend`.
+    """
+
+    __slots__ = ("array", "gradient", "offset", "spacing", "sigma")
+
+    def __init__(self, mask: CroppedMask, spacing, sigma: float = 1.0, memory_budget: int = None):
+        self.sigma = float(sigma)
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        margin = int(4 * self.sigma + 0.5) + 1  # the radius of the gaussian of `gaussian_filter`, and one voxel of zeros
+        self.offset = np.asarray(mask.offset, dtype=np.int64) - margin
+        shape = tuple(int(i) + 2 * margin for i in mask.array.shape) if mask.array.size else (0, 0, 0)
+        if memory_budget is not None and mask.array.size:
+            fields = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=(4,) + shape)
+            self._bricked(mask, margin, fields, memory_budget)
+        else:
+            padded = np.zeros(shape, dtype=np.float32)
+            padded[tuple(slice(margin, margin + s) for s in mask.array.shape)] = mask.array
+            fields = self._smooth(padded)
+        self.array, self.gradient = np.asarray(fields[0]), np.asarray(fields[1:])
+
+    def _smooth(self, region: np.ndarray) -> np.ndarray:
+        """The smoothed region and its gradient, as a (4, ...) float32 array."""
+        fields = np.empty((4,) + region.shape, dtype=np.float32)
+        gaussian_filter(region, self.sigma, output=fields[0], mode="constant")
+        for a in range(3):
+            gaussian_filter(region, self.sigma, order=[int(a == b) for b in range(3)], output=fields[1 + a], mode="constant")
+        return fields
+
+    def _bricked(self, mask: CroppedMask, margin: int, fields: np.ndarray, memory_budget: int):
+        # the filters work on the float32 region, a float64 line buffer and the four float32 outputs
+        brick = brick_size(memory_budget, 24, halo=margin)
+        occupancy = brick_occupancy(mask.array, brick)
+        for start, end in brick_ranges(fields.shape[1:], brick):
+            lower, upper = self.offset + start - margin, self.offset + end + margin  # the brick and its halo
+            target = (slice(None),) + tuple(slice(s, e) for s, e in zip(start, end))
+            if not region_occupied(mask, occupancy, brick, lower, upper):
+                fields[target] = 0
+                continue
+            smoothed = self._smooth(read_region(mask, lower, upper).astype(np.float32))
+            fields[target] = smoothed[(slice(None),) + tuple(slice(margin, margin + e - s) for s, e in zip(start, end))]
+        fields.flush()
+
+    def __repr__(self):
+        return f"NormalField(offset={tuple(self.offset)}, shape={self.array.shape}, sigma={self.sigma})"
+
+    def crossings(self, p1s, p2s) -> np.ndarray:
+        """The (n, 3) points in numpy indices where the segments p1s[k] -> p2s[k] first cross the surface, nan where
+        they do not."""
+        p1s = np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3)
+        p2s = np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3)
+        points = np.full(p1s.shape, np.nan)
+        for n, (p1, p2) in enumerate(zip(p1s, p2s)):
+            t = first_crossing(p1 - self.offset, p2 - p1, self.array, LEVEL)
+            if t >= 0:
+                points[n] = p1 + t * (p2 - p1)
+        return points
+
+    def angle(self, p1, p2) -> float:
+        """The angle in degrees between the segment p1 -> p2 and the normal of the surface where it first crosses it,
+        0.0 if it does not cross it."""
+        return float(self.angle_batch(np.reshape(p1, (1, 3)), np.reshape(p2, (1, 3)))[0])
+
+    def angle_packet(self, p1, p2s) -> np.ndarray:
+        return self.angle_batch(np.broadcast_to(np.asarray(p1, dtype=np.float64), np.shape(p2s)), p2s)
+
+    def angle_batch(self, p1s, p2s) -> np.ndarray:
+        return crossing_angles(
+            np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3),
+            np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3),
+            self.array,
+            self.gradient,
+            self.offset.astype(np.float64),
+            self.spacing,
+            LEVEL,
+        )
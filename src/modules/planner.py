@@ -0,0 +1,264 @@
+from collections import deque
+from time import perf_counter
+import numpy as np
+from src.modules.backends import IntersectionBackend
+from src.modules.incremental import IncrementalSurface
+from src.modules.volumes import CroppedMask
+from src.utils.exclusion import NOT_IN_TARGET, CRITICAL, CORTEX_ANGLE, TOO_LONG, REASONS
+from src.utils.linear import points_to_numpy_idx
+from src.utils.prefilter import trajectory_lengths
+
+
+class LatencyHistogram:
+    """
+    LatencyHistogram Class counting the latencies of a kind of request in buckets of doubling width.
+
+    Attributes:
+        - edges (np.ndarray): The upper edges of the buckets in ms, from 0.01 ms to about 10 s; slower requests go in a
+          last, open bucket.
+        - counts (np.ndarray): The number of requests in each bucket.
+        - recent (deque): The latest latencies in ms, for the percentiles.
+
+    Methods:
+        - record: Add a latency in seconds.
+        - summary: The count, mean, percentiles and non-empty buckets, as a dict that can be dumped to JSON.
+    """
+
+    edges = 0.01 * 2.0 ** np.arange(21)
+
+    def __init__(self, recent: int = 10000):
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.recent = deque(maxlen=recent)
+        self.total_ms = 0.0
+
+    def record(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[np.searchsorted(self.edges, ms)] += 1
+        self.recent.append(ms)
+        self.total_ms += ms
+
+    def summary(self) -> dict:
+        count = int(self.counts.sum())
+        if not count:
+            return {"count": 0}
+        p50, p90, p99 = np.percentile(self.recent, [50, 90, 99])
+        labels = [f"<={i:g}ms" for i in self.edges] + [f">{self.edges[-1]:g}ms"]
+        return {
+            "count": count,
+            "mean_ms": self.total_ms / count,
+            "p50_ms": float(p50),
+            "p90_ms": float(p90),
+            "p99_ms": float(p99),
+            "max_ms": float(max(self.recent)),
+            "buckets": {label: int(n) for label, n in zip(labels, self.counts) if n},
+        }
+
+
+class Planner:
+    """
+    Planner Class answering trajectory queries against structures that are loaded once and kept in memory.
+
+    The points of the requests and of the responses are in world coordinates, like the .fcsv files of 3D Slicer. A
+    trajectory is valid when it intersects with the target structure, does not intersect with the critical structures,
+    crosses the cortex at an angle of at most `max_angle` degrees to its normal and is at most `max_length` mm long. The
+    best of several valid trajectories is the shortest.
+
+    Attributes:
+        - target (IntersectionBackend): The queries of the target structure (the hippocampus).
+        - critical (IntersectionBackend): The queries of the critical structures (the ventricles and vessels).
+        - cortex (IntersectionBackend): The angle queries of the cortex (its backend or its `NormalField`).
+        - reference_image: The geometry of the volumes (a SimpleITK image or `VolumeStore.info`).
+        - targets (np.ndarray): (M, 3) array of the default targets, in world coordinates.
+        - target_ids (list): The ids of the default targets.
+        - max_length (float): The maximum trajectory length in mm, None for no constraint.
+        - max_angle (float): The maximum angle in degrees to the normal of the cortex.
+        - radius (float): The radius of the electrode in mm; 0 checks the critical structures against the line only.
+        - surface (IncrementalSurface): The surface of the critical structures whose backend is `critical`, None if
+          they cannot be edited.
+        - latency (dict): A `LatencyHistogram` per kind of request.
+        - operations (dict): The function answering each kind of request, by "op".
+
+    Methods:
+        - evaluate: Evaluate one trajectory.
+        - best_target: The best target for an entry.
+        - rescore: Evaluate trajectories again and keep the best k.
+        - edit, update: Change the mask of the critical structures, and their surface and BVH in place.
+        - handle: Answer a request dict, e.g. parsed from a line of JSON, and time it.
+    """
+
+    def __init__(
+        self,
+        target: IntersectionBackend,
+        critical: IntersectionBackend,
+        cortex: IntersectionBackend,
+        reference_image,
+        targets=None,
+        target_ids=None,
+        max_length: float = None,
+        max_angle: float = 90 - 55,
+        radius: float = 0.0,
+        surface: IncrementalSurface = None,
+    ):
+        self.target = target
+        self.critical = critical
+        self.surface = surface
+        self.cortex = cortex
+        self.reference_image = reference_image
+        self.spacing = reference_image.GetSpacing()
+        self.targets = np.zeros((0, 3)) if targets is None else np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        self.target_ids = list(range(len(self.targets))) if target_ids is None else list(target_ids)
+        self.targets_idx = self.to_index(self.targets)
+        self.max_length = max_length
+        self.max_angle = max_angle
+        self.radius = radius
+        self.latency = {}
+        self.operations = {
+            "evaluate": self._evaluate_request,
+            "best_target": self._best_target_request,
+            "rescore": self._rescore_request,
+            "edit": self._edit_request,
+            "stats": lambda request: self.stats(),
+            "ping": lambda request: "pong",
+        }
+
+    def to_index(self, points) -> np.ndarray:
+        """Convert world coordinates to numpy indices, like the main scripts."""
+        return points_to_numpy_idx(points, self.reference_image)
+
+    def _check(self, entry_idx: np.ndarray, targets_idx: np.ndarray):
+        """The reason bits, cortex angles and lengths of one entry with several targets, all in numpy indices."""
+        reasons = np.zeros(len(targets_idx), dtype=np.uint8)
+        reasons[~self.target.intersects_packet(entry_idx, targets_idx)] |= NOT_IN_TARGET
+        reasons[self.critical.capsule_packet(entry_idx, targets_idx, self.radius, self.spacing)] |= CRITICAL
+        angles = self.cortex.angle_packet(entry_idx, targets_idx)
+        reasons[angles > self.max_angle] |= CORTEX_ANGLE
+        lengths = trajectory_lengths(entry_idx[None], targets_idx, self.spacing)[0]
+        if self.max_length is not None:
+            reasons[lengths > self.max_length] |= TOO_LONG
+        return reasons, angles, lengths
+
+    @staticmethod
+    def _result(reasons, angle, length) -> dict:
+        return {
+            "valid": bool(reasons == 0),
+            "reasons": [label for bit, label in REASONS.items() if reasons & bit],
+            "length_mm": float(length),
+            "cortex_angle": float(angle),
+        }
+
+    def evaluate(self, entry, target) -> dict:
+        """Evaluate the trajectory from `entry` to `target`.
+
+        Returns:
+            dict: "valid", the labels of the violated constraints ("reasons"), "length_mm" and "cortex_angle".
+        """
+        reasons, angles, lengths = self._check(self.to_index(entry)[0], self.to_index(target))
+        return self._result(reasons[0], angles[0], lengths[0])
+
+    def best_target(self, entry, targets=None, target_ids=None) -> dict:
+        """The shortest valid trajectory from `entry` to one of `targets` (the default targets if None).
+
+        Returns:
+            dict: The evaluation of the best trajectory with its "target" and "target_id", and the number of valid
+                targets ("n_valid"); "target" is None if no target is valid.
+        """
+        if targets is None:
+            targets, target_ids, targets_idx = self.targets, self.target_ids, self.targets_idx
+        else:
+            targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+            target_ids = list(range(len(targets))) if target_ids is None else list(target_ids)
+            targets_idx = self.to_index(targets)
+
+        reasons, angles, lengths = self._check(self.to_index(entry)[0], targets_idx)
+        valid = np.flatnonzero(reasons == 0)
+        if not len(valid):
+            return {"target": None, "target_id": None, "n_valid": 0}
+        best = valid[np.argmin(lengths[valid])]
+        result = {"target": targets[best].tolist(), "target_id": target_ids[best], "n_valid": len(valid)}
+        result.update(self._result(reasons[best], angles[best], lengths[best]))
+        return result
+
+    def rescore(self, trajectories, k: int = 10) -> list:
+        """Evaluate (entry, target) trajectories again, e.g. after a structure or a fiducial changed.
+
+        Returns:
+            list: The evaluations of the k shortest valid trajectories with their "entry", "target" and "rank" (the
+                position in `trajectories`), shortest first.
+        """
+        points = np.asarray(trajectories, dtype=np.float64).reshape(-1, 2, 3)
+        entries_idx, targets_idx = self.to_index(points[:, 0]), self.to_index(points[:, 1])
+
+        # the trajectories of the same entry are checked together
+        results = []
+        unique_entries, inverse = np.unique(entries_idx, axis=0, return_inverse=True)
+        for i, entry_idx in enumerate(unique_entries):
+            ranks = np.flatnonzero(inverse.ravel() == i)
+            for rank, *check in zip(ranks, *self._check(entry_idx, targets_idx[ranks])):
+                result = self._result(*check)
+                if result["valid"]:
+                    results.append({"entry": points[rank, 0].tolist(), "target": points[rank, 1].tolist(), "rank": int(rank), **result})
+        return sorted(results, key=lambda i: (i["length_mm"], i["rank"]))[:k]
+
+    def edit(self, lower, values) -> np.ndarray:
+        """Write the block of voxels `values` into the mask of the critical structures from the voxel `lower`, in numpy
+        indices, e.g. a few slices touched up; only the bricks of `surface` around the changed voxels are meshed again
+        and the BVH of `critical` is refit (see `IncrementalSurface.edit`).
+
+        Returns:
+            np.ndarray: The (k, 2, 3) boxes of the dirty regions, in numpy indices.
+        """
+        if self.surface is None:
+            raise ValueError("The critical structures of this planner cannot be edited, it has no incremental surface")
+        return self.surface.edit(lower, np.asarray(values, dtype=np.uint8))
+
+    def update(self, mask: CroppedMask) -> np.ndarray:
+        """Replace the mask of the critical structures by `mask`, e.g. a segmentation saved again, like `edit`.
+
+        Returns:
+            np.ndarray: The boxes of the dirty regions, see `edit`.
+        """
+        if self.surface is None:
+            raise ValueError("The critical structures of this planner cannot be edited, it has no incremental surface")
+        return self.surface.update(mask)
+
+    def stats(self) -> dict:
+        return {op: histogram.summary() for op, histogram in self.latency.items()}
+
+    def _evaluate_request(self, request):
+        return self.evaluate(request["entry"], request["target"])
+
+    def _best_target_request(self, request):
+        return self.best_target(request["entry"], request.get("targets"), request.get("target_ids"))
+
+    def _rescore_request(self, request):
+        return self.rescore(request["trajectories"], request.get("k", 10))
+
+    def _edit_request(self, request):
+        boxes = self.edit(request["lower"], request["values"])
+        return {"dirty_regions": len(boxes), "faces": len(self.surface.mesh.faces)}
+
+    def handle(self, request: dict) -> dict:
+        """Answer a request {"op": ..., ...}, where "op" is one of "evaluate" (with "entry" and "target"),
+        "best_target" (with "entry" and optionally "targets" and "target_ids"), "rescore" (with "trajectories", a list
+        of [entry, target], and optionally "k"), "edit" (with "lower", a voxel in numpy indices, and "values", a 3D
+        block of 0 and 1), "stats", "ping", or another op added to `operations`.
+
+        Returns:
+            dict: {"ok": True, "result": ...} or {"ok": False, "error": ...}, with "latency_ms" and the "id" of the
+                request if it has one. The latency is also recorded in the histogram of the op.
+        """
+        start = perf_counter()
+        op = request.get("op") if isinstance(request, dict) else None
+        try:
+            if op not in self.operations:
+                raise ValueError(f"Unknown op {op!r}, expected one of {list(self.operations)}")
+            response = {"ok": True, "result": self.operations[op](request)}
+        except Exception as error:  # a malformed request must not stop the daemon that serves the others
+            response = {"ok": False, "error": f"{type(error).__name__}: {error}"}
+        elapsed = perf_counter() - start
+
+        self.latency.setdefault(str(op), LatencyHistogram()).record(elapsed)
+        response["latency_ms"] = elapsed * 1000
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        return response
@@ -0,0 +1,180 @@
+import threading
+import numpy as np
+from numba import njit
+from scipy.spatial import ConvexHull, QhullError
+
+from src.modules.mesh import Mesh
+from src.modules.backends import IntersectionBackend, make_backend
+
+# index units by which the hull is always grown, so that the rounding of its planes never culls a triangle touching it
+HULL_MARGIN = 1e-3
+
+
+def sweep_hull(points: np.ndarray):
+    """The convex hull of points, e.g. of all the entries and targets: every segment between two of them is inside it.
+
+    Falls back to the bounding box of the points when they are too few or flat for a hull (e.g. a single trajectory).
+
+    Returns:
+        tuple: (planes, vertices), the (k, 4) array of the planes (n, d) of the hull, with unit normals n and n . x + d
+            <= 0 inside, and the points on the hull, enough to compute it again.
+    """
+    points = np.unique(np.asarray(points, dtype=np.float64).reshape(-1, 3), axis=0)
+    try:
+        hull = ConvexHull(points)
+        return np.ascontiguousarray(hull.equations), points[hull.vertices]
+    except (QhullError, ValueError):
+        lower, upper = points.min(axis=0), points.max(axis=0)
+        planes = np.zeros((6, 4))
+        planes[:3, :3], planes[:3, 3] = -np.eye(3), lower
+        planes[3:, :3], planes[3:, 3] = np.eye(3), -upper
+        return planes, points
+
+
+@njit(cache=True, nogil=True)
+def faces_in_hull(v0, edge1, edge2, planes, margin):
+    """
+    Which triangles of a `Mesh` may intersect with a convex hull grown by `margin`: a triangle is culled when its three
+    vertices are outside of the same plane of the hull. Conservative, some triangles near the edges of the hull are kept.
+
+    Args:
+    ----
+    v0, edge1, edge2: np.ndarray
+        (3, n_faces) arrays of the first vertex and the two edges of the triangles (see `Mesh`)
+    planes: np.ndarray
+        (k, 4) array of the planes of the hull (see `sweep_hull`)
+    margin: float
+        distance by which every plane is moved outwards
+
+    Returns:
+    -------
+    np.ndarray:
+        (n_faces,) bool array, True for the triangles to keep
+    """
+    keep = np.ones(v0.shape[1], dtype=np.bool_)
+    for i in range(v0.shape[1]):
+        for k in range(planes.shape[0]):
+            nx, ny, nz = planes[k, 0], planes[k, 1], planes[k, 2]
+            a = nx * v0[0, i] + ny * v0[1, i] + nz * v0[2, i] + planes[k, 3] - margin
+            if a <= 0:
+                continue
+            if a + nx * edge1[0, i] + ny * edge1[1, i] + nz * edge1[2, i] > 0 and a + nx * edge2[0, i] + ny * edge2[1, i] + nz * edge2[2, i] > 0:
+                keep[i] = False
+                break
+    return keep
+
+
+@njit(cache=True, nogil=True)
+def points_in_hull(points, planes, margin):
+    """Whether all the (n, 3) points are inside the convex hull (see `sweep_hull`) grown by `margin`."""
+    for j in range(points.shape[0]):
+        for k in range(planes.shape[0]):
+            if planes[k, 0] * points[j, 0] + planes[k, 1] * points[j, 1] + planes[k, 2] * points[j, 2] + planes[k, 3] > margin:
+                return False
+    return True
+
+
+def cull_mesh(mesh: Mesh, planes: np.ndarray, margin: float = HULL_MARGIN) -> Mesh:
+    """The triangles of `mesh` that may intersect with the convex hull (see `faces_in_hull`), as a compact mesh with
+    only the vertices they use, in the same face order, so that the first crossed triangle stays the same (the mesh
+    is not split into components again, which would reorder its faces)."""
+    keep = faces_in_hull(mesh.v0, mesh.edge1, mesh.edge2, planes, margin)
+    used, faces = np.unique(mesh.faces[keep], return_inverse=True)
+    return Mesh(mesh.verts[used], faces.reshape(-1, 3))
+
+
+class SweepBackend(IntersectionBackend):
+    """
+    SweepBackend Class, a backend built on the triangles of a mesh inside the sweep volume of the segments it is asked
+    about, instead of the whole mesh.
+
+    All the segments between the entries and the targets lie in the convex hull of these points, which covers a
+    fraction of the brain: the mesh is culled to the triangles that may intersect with the hull (grown by the largest
+    capsule radius asked for) and the backend `name` is built on that compact sub-mesh. The answers are those of the
+    whole mesh. Every query first checks that its points are inside the hull; when they are not (e.g. a fiducial was
+    moved, or perturbed trajectories), the mesh is culled again to the hull of the old one and the new points.
+
+    Attributes:
+        - mesh (Mesh): The whole surface.
+        - culled (Mesh): The triangles kept for the current hull.
+        - culls (int): The number of times the mesh was culled.
+
+    Methods:
+        - cover: Cull the mesh for segments between some points beforehand.
+        - The queries of `IntersectionBackend`, answered by the backend of the sub-mesh.
+    """
+
+    def __init__(self, name: str, mesh: Mesh, points: np.ndarray = None, radius: float = 0.0, spacing=None):
+        """
+        Args:
+            name: The backend of the sub-mesh, one of `BACKENDS`.
+            mesh: The whole surface.
+            points: The points the segments will be between (e.g. all the entries and targets), in numpy indices.
+                Defaults to none, the mesh is then culled at the first query.
+            radius, spacing: The capsule radius in mm that will be asked for and the voxel spacing.
+        """
+        super().__init__(mesh)
+        self.name = name
+        self.culls = 0
+        self._lock = threading.Lock()
+        self._hull = None  # (planes, vertices, margin, backend)
+        if points is not None and len(points):
+            self.cover(points, radius, spacing)
+
+    def __repr__(self):
+        kept = 0 if self._hull is None else len(self.culled)
+        return f"SweepBackend({self.name}, {kept} / {len(self.mesh)} faces, {self.culls} culls)"
+
+    @property
+    def culled(self) -> Mesh:
+        return None if self._hull is None else self._hull[3].mesh
+
+    @staticmethod
+    def _margin(radius, spacing) -> float:
+        return HULL_MARGIN + (radius / min(spacing) if radius > 0 else 0.0)
+
+    def cover(self, points, radius: float = 0.0, spacing=None) -> IntersectionBackend:
+        """Make sure that the sub-mesh has every triangle near the segments between `points`, culling the mesh again to
+        a larger hull if needed.
+
+        Returns:
+            IntersectionBackend: The backend of the sub-mesh that answers these segments.
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        margin = self._margin(radius, spacing)
+        hull = self._hull
+        if hull is not None and margin <= hull[2] and points_in_hull(points, hull[0], HULL_MARGIN):
+            return hull[3]
+        with self._lock:  # the queries of other threads keep using the previous sub-mesh meanwhile
+            hull = self._hull
+            if hull is None or margin > hull[2] or not points_in_hull(points, hull[0], HULL_MARGIN):
+                if hull is not None:
+                    points, margin = np.concatenate([hull[1], points]), max(margin, hull[2])
+                planes, vertices = sweep_hull(points)
+                self._hull = hull = (planes, vertices, margin, make_backend(self.name, cull_mesh(self.mesh, planes, margin)))
+                self.culls += 1
+            return hull[3]
+
+    def intersects(self, p1, p2):
+        return self.cover(np.stack([p1, p2])).intersects(p1, p2)
+
+    def angle(self, p1, p2):
+        return self.cover(np.stack([p1, p2])).angle(p1, p2)
+
+    def intersects_packet(self, p1, p2s):
+        return self.cover(np.vstack([p1, p2s])).intersects_packet(p1, p2s)
+
+    def angle_packet(self, p1, p2s):
+        return self.cover(np.vstack([p1, p2s])).angle_packet(p1, p2s)
+
+    def intersects_batch(self, p1s, p2s):
+        return self.cover(np.vstack([p1s, p2s])).intersects_batch(p1s, p2s)
+
+    def angle_batch(self, p1s, p2s):
+        return self.cover(np.vstack([p1s, p2s])).angle_batch(p1s, p2s)
+
+    def capsule_packet(self, p1, p2s, radius, spacing):
+        return self.cover(np.vstack([p1, p2s]), radius, spacing).capsule_packet(p1, p2s, radius, spacing)
+
+    def capsule_batch(self, p1s, p2s, radius, spacing):
+        return self.cover(np.vstack([p1s, p2s]), radius, spacing).capsule_batch(p1s, p2s, radius, spacing)
@@ -0,0 +1,159 @@
+import json
+import os
+import numpy as np
+import SimpleITK as sitk
+from pathlib import Path
+from src.modules.bricks import stream_mask, read_region
+
+
+class CroppedMask:
+    """
+    CroppedMask Class, a binary mask stored as uint8 and cropped to the bounding box of its non-zero voxels.
+
+    Attributes:
+        - array (np.ndarray): The cropped uint8 mask (a read-only np.memmap when loaded from the cache).
+        - offset (tuple): The index of the first voxel of `array` in the full volume.
+        - shape (tuple): The shape of the full volume.
+
+    Methods:
+        - full: The mask as a full-size uint8 array.
+    """
+
+    __slots__ = ("array", "offset", "shape")
+
+    def __init__(self, array: np.ndarray, offset, shape):
+        self.array = array
+        self.offset = tuple(int(i) for i in offset)
+        self.shape = tuple(int(i) for i in shape)
+
+    def __repr__(self):
+        return f"CroppedMask(offset={self.offset}, cropped_shape={self.array.shape}, shape={self.shape})"
+
+    @property
+    def slices(self):
+        return tuple(slice(o, o + s) for o, s in zip(self.offset, self.array.shape))
+
+    def full(self) -> np.ndarray:
+        full = np.zeros(self.shape, dtype=np.uint8)
+        full[self.slices] = self.array
+        return full
+
+
+def crop_mask(mask: np.ndarray) -> CroppedMask:
+    """Crop a binary mask to the bounding box of its non-zero voxels and store it as uint8."""
+    nonzero = [np.flatnonzero(mask.any(axis=tuple(j for j in range(3) if j != i))) for i in range(3)]
+    if any(len(i) == 0 for i in nonzero):  # empty mask
+        return CroppedMask(np.zeros((0, 0, 0), dtype=np.uint8), (0, 0, 0), mask.shape)
+    offset = [i[0] for i in nonzero]
+    end = [i[-1] + 1 for i in nonzero]
+    array = np.ascontiguousarray(mask[offset[0] : end[0], offset[1] : end[1], offset[2] : end[2]] != 0, dtype=np.uint8)
+    return CroppedMask(array, offset, mask.shape)
+
+
+def union_masks(*masks: CroppedMask, path=None, memory_budget: int = None) -> CroppedMask:
+    """The logical or of cropped masks of the same volume, cropped to the union of their bounding boxes.
+
+    With a `path` and a `memory_budget` in bytes, the union is written to a memory-mapped .npy file at `path`, slab by
+    slab along the first axis, so that neither it nor the masks (e.g. memory-mapped too) are ever read as a whole.
+    """
+    shape = masks[0].shape
+    masks = [i for i in masks if i.array.size]
+    if not masks:
+        return CroppedMask(np.zeros((0, 0, 0), dtype=np.uint8), (0, 0, 0), shape)
+    lower = np.min([i.offset for i in masks], axis=0)
+    upper = np.max([np.add(i.offset, i.array.shape) for i in masks], axis=0)
+    if path is None or memory_budget is None:
+        union = np.zeros(upper - lower, dtype=np.uint8)
+        for mask in masks:
+            union[tuple(slice(o - l, o - l + s) for o, l, s in zip(mask.offset, lower, mask.array.shape))] |= mask.array
+        return CroppedMask(union, lower, shape)
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    union = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=tuple(int(i) for i in upper - lower))
+    thickness = max(1, memory_budget // (2 * int(np.prod(upper[1:] - lower[1:]))))
+    for i in range(lower[0], upper[0], thickness):
+        slab = (i, *lower[1:]), (min(i + thickness, upper[0]), *upper[1:])
+        union[i - lower[0] : slab[1][0] - lower[0]] = np.bitwise_or.reduce([read_region(mask, *slab) for mask in masks])
+    union.flush()
+    del union
+    return CroppedMask(np.load(path, mmap_mode="r"), lower, shape)
+
+
+class VolumeStore:
+    """
+    VolumeStore Class for loading the NIfTI volumes of a folder lazily.
+
+    Nothing is decompressed until a structure is referenced. `info` only reads the header (size, origin, spacing,
+    direction). `mask` decodes the volume once, rotates it like the main scripts always did
+    (`np.rot90(array, 1, axes=(0, 2))`), crops it to its bounding box as uint8 and caches it as a `.npy` file.
+    Later runs memory-map that file instead of decoding the gzip again. A cache file is reused only while the size and
+    modification time of the source file are unchanged. With a `memory_budget` in bytes, the volume is never decoded as
+    a whole: it is streamed slab by slab straight into the memory-mapped cache file (see `src.modules.bricks`).
+
+    Attributes:
+        - directory (Path): The folder of the .nii.gz files.
+        - cache_dir (Path): The folder of the cached masks.
+        - names (list): The file names in `directory`.
+        - memory_budget (int): The memory available to decode a volume, in bytes; None decodes it in memory.
+
+    Methods:
+        - info: The header of a volume, usable wherever a SimpleITK image is only asked for its geometry.
+        - image: The full SimpleITK image (e.g. for visualisation).
+        - mask: The binary mask of a structure as a `CroppedMask`.
+    """
+
+    def __init__(self, directory, cache_dir=None, memory_budget: int = None):
+        self.directory = Path(directory)
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else Path(".cache", "volumes", self.directory.name)
+        self.memory_budget = memory_budget
+        self.names = sorted(i for i in os.listdir(self.directory) if i.endswith((".nii", ".nii.gz")))
+        self._info = {}
+        self._masks = {}
+
+    def info(self, name: str) -> sitk.ImageFileReader:
+        if name not in self._info:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(str(self.directory / name))
+            reader.ReadImageInformation()
+            self._info[name] = reader
+        return self._info[name]
+
+    def image(self, name: str) -> sitk.Image:
+        return sitk.ReadImage(str(self.directory / name))
+
+    def mask(self, name: str) -> CroppedMask:
+        if name not in self._masks:
+            self._masks[name] = self._load_cached(name)
+        return self._masks[name]
+
+    def _cache_path(self, name: str) -> Path:
+        stat = os.stat(self.directory / name)
+        return self.cache_dir / f"{name}.{stat.st_size}.{stat.st_mtime_ns}.npy"
+
+    def _load_cached(self, name: str) -> CroppedMask:
+        path = self._cache_path(name)
+        header = path.with_suffix(".json")
+        if path.exists() and header.exists():
+            with open(header, "r") as reader:
+                geometry = json.load(reader)
+            return CroppedMask(np.load(path, mmap_mode="r"), geometry["offset"], geometry["shape"])
+
+        # replace the cache of older versions of the file
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for old in self.cache_dir.glob(f"{name}.*"):
+            old.unlink()
+
+        mask = None
+        if self.memory_budget is not None:
+            try:
+                mask = CroppedMask(*stream_mask(self.directory / name, path, self.memory_budget))
+            except ValueError:  # not a NIfTI-1 file that can be streamed, decoded by SimpleITK below
+                mask = None
+        if mask is None:
+            image = sitk.ReadImage(str(self.directory / name))
+            mask = crop_mask(np.rot90(sitk.GetArrayViewFromImage(image), 1, axes=(0, 2)))
+            del image
+            np.save(path, mask.array)
+        with open(header, "w") as writer:
+            json.dump({"offset": mask.offset, "shape": mask.shape}, writer)
+        return mask
@@ -0,0 +1,141 @@
+import operator
+import numpy as np
+from scipy.ndimage import map_coordinates
+from src.modules.mesh import Mesh
+from src.modules.volumes import CroppedMask
+
+
+class PairGrid:
+    """
+    PairGrid Class representing all the entry x target pairs implicitly, in the order of `product(entries, targets)`.
+
+    Pair k is (entries[k // M], targets[k % M]). Nothing is stored per pair: the pairs are generated on demand, one at a
+    time or as blocks of int32 (entry index, target index) arrays, so the memory does not grow with the number of pairs.
+
+    Attributes:
+        - entries (np.ndarray): (N, 3) array of entry points.
+        - targets (np.ndarray): (M, 3) array of target points.
+
+    Methods:
+        - indices: The entry and target indices of the pairs start to end.
+        - blocks: Generate the pairs in blocks of consecutive pairs.
+    """
+
+    def __init__(self, entries: np.ndarray, targets: np.ndarray):
+        self.entries = entries
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.entries) * len(self.targets)
+
+    def __repr__(self):
+        return f"PairGrid(n_entries={len(self.entries)}, n_targets={len(self.targets)})"
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        k = operator.index(key)
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"pair index {key} out of range for {len(self)} pairs")
+        return self.entries[k // len(self.targets)], self.targets[k % len(self.targets)]
+
+    def __iter__(self):
+        for entry in self.entries:
+            for target in self.targets:
+                yield entry, target
+
+    def indices(self, start: int, end: int):
+        """The (end - start,) int32 arrays of the entry and target indices of the pairs start to end (excluded)."""
+        k = np.arange(start, end, dtype=np.int64)
+        return (k // len(self.targets)).astype(np.int32), (k % len(self.targets)).astype(np.int32)
+
+    def blocks(self, block_size: int = 1 << 20):
+        """Generate (start, end, entry indices, target indices) for consecutive blocks of at most `block_size` pairs."""
+        for start in range(0, len(self), block_size):
+            end = min(start + block_size, len(self))
+            yield (start, end, *self.indices(start, end))
+
+
+def surface_area(mesh: Mesh, spacing) -> float:
+    """The area of a mesh in mm², with its vertices in numpy indices of an image of voxel size `spacing`."""
+    spacing = np.asarray(spacing, dtype=np.float64)[:, None]
+    return float(np.linalg.norm(np.cross(mesh.edge1 * spacing, mesh.edge2 * spacing, axis=0), axis=0).sum() / 2)
+
+
+def mask_volume(mask: CroppedMask, spacing) -> float:
+    """The volume of a mask in mm³."""
+    return float(np.count_nonzero(mask.array) * np.prod(spacing))
+
+
+def sample_surface(mesh: Mesh, n: int, rng: np.random.Generator = None, offset: float = 0.0, mask: CroppedMask = None, max_rounds: int = 100) -> np.ndarray:
+    """Sample points uniformly on the surface of a mesh (e.g. entry points on the cortex).
+
+    The triangles are drawn with probabilities proportional to their area, then a point is drawn uniformly inside each
+    of them and moved `offset` off the surface, out of the structure. The faces of marching cubes are wound so that
+    edge1 x edge2 points into the structure, so the points move against it. With the `mask` of the structure, the
+    points that may still be inside it after the move, in a cell of voxels of which one is in the mask (e.g. in a sulcus
+    narrower than `offset`, where they reach the opposite bank), are drawn again.
+
+    A segment starting exactly on the surface crosses it at t = 0, which the kernels do not count as an intersection
+    (they need 1e-10 < t < 1): an entry on the cortex would get the angle 0 and pass constraint (d) unchecked. Entries
+    are therefore moved at least one voxel out, outside of the mask.
+
+    Args:
+        mesh: The `Mesh`.
+        n: The number of points.
+        rng: The random generator. Defaults to a new unseeded one.
+        offset: The distance from the surface, in the coordinates of the mesh (voxels). Defaults to 0.
+        mask: The `CroppedMask` of the structure, in the same coordinates. Defaults to None (no check).
+        max_rounds: The number of draws of the rejected points before giving up.
+
+    Returns:
+        (n, 3) array of points, in the coordinates of the mesh.
+
+    Raises:
+        ValueError: If points are still next to the mask after `max_rounds` draws.
+    """
+    rng = rng or np.random.default_rng()
+    normal = mesh.normal.astype(np.float64)
+    areas = np.linalg.norm(normal, axis=0)
+    points = np.zeros((n, 3))
+    missing = np.arange(n)
+    for _ in range(max_rounds):
+        faces = rng.choice(len(areas), size=len(missing), p=areas / areas.sum())
+        u, v = rng.random(len(missing)), rng.random(len(missing))
+        outside = u + v > 1  # fold the points of the parallelogram back into the triangle
+        u[outside], v[outside] = 1 - u[outside], 1 - v[outside]
+        drawn = mesh.v0[:, faces] + mesh.edge1[:, faces] * u + mesh.edge2[:, faces] * v
+        points[missing] = (drawn - offset * normal[:, faces] / areas[faces]).T
+        if mask is None or not mask.array.size:
+            return points
+        # outside for sure in the cells whose 8 voxels are all out of the mask, where marching cubes has no surface
+        local = (points[missing] - np.asarray(mask.offset)).T
+        missing = missing[map_coordinates(mask.array, local, order=1, mode="constant", cval=0.0, output=np.float64) > 0]
+        if not len(missing):
+            return points
+    raise ValueError(f"{len(missing)} of {n} points are still next to the mask after {max_rounds} draws")
+
+
+def sample_mask(mask: CroppedMask, n: int, rng: np.random.Generator = None, jitter: float = 0.25) -> np.ndarray:
+    """Sample points uniformly inside a mask (e.g. target points in the hippocampus).
+
+    Voxels of the mask are drawn uniformly (without replacement when the mask has enough of them) and each point is
+    moved from the centre of its voxel by up to `jitter` voxels along every axis, which keeps it inside the marching
+    cubes surface of the mask.
+
+    Args:
+        mask: The `CroppedMask`.
+        n: The number of points.
+        rng: The random generator. Defaults to a new unseeded one.
+        jitter: The maximum offset from the centre of the voxel, in voxels. Defaults to 0.25.
+
+    Returns:
+        (n, 3) array of points, in numpy indices of the full volume.
+    """
+    rng = rng or np.random.default_rng()
+    voxels = np.flatnonzero(mask.array)
+    chosen = rng.choice(voxels, size=n, replace=n > len(voxels))
+    points = np.stack(np.unravel_index(chosen, mask.array.shape), axis=1) + np.asarray(mask.offset)
+    return points + rng.uniform(-jitter, jitter, size=(n, 3))
@@ -0,0 +1,183 @@
+import numpy as np
+from src.utils.prefilter import prefilter, segments_hit_box
+
+# one bit per constraint, set where the pair violates it; a pair is valid when no bit is set
+NOT_IN_TARGET = np.uint8(1 << 0)  # (b) does not intersect with the hippocampus
+CRITICAL = np.uint8(1 << 1)  # (a) intersects with the ventricles or vessels
+CORTEX_ANGLE = np.uint8(1 << 2)  # (d) too shear to the cortex
+TOO_LONG = np.uint8(1 << 3)  # (c) longer than the maximum length
+
+REASONS = {
+    NOT_IN_TARGET: "not intersect with hippo campus",
+    CORTEX_ANGLE: "too shear cortex",
+    CRITICAL: "in vessels or ventricles",
+    TOO_LONG: "too long",
+}
+
+
+def prefilter_reasons(prefilter_masks: dict, max_length: float = None) -> np.ndarray:
+    """The reason bits decided by the prefilter alone.
+
+    A segment that misses the bounding box of the target structure cannot intersect with it, so `NOT_IN_TARGET` is
+    exact there; `TOO_LONG` is exact everywhere.
+
+    Args:
+        prefilter_masks: The dict returned by `prefilter`.
+        max_length: The maximum trajectory length in mm. Defaults to None (no length constraint).
+
+    Returns:
+        (N, M) uint8 array of reason bits.
+    """
+    reasons = np.where(prefilter_masks["target_box"], np.uint8(0), NOT_IN_TARGET)
+    if max_length is not None:
+        reasons[prefilter_masks["length"] > max_length] |= TOO_LONG
+    return reasons
+
+
+def reason_counts(reasons: np.ndarray) -> dict:
+    """The number of pairs excluded by each constraint (a pair can be counted for several of them)."""
+    return {label: int(np.count_nonzero(reasons & bit)) for bit, label in REASONS.items()}
+
+
+def combination_counts(reasons: np.ndarray = None, counts: np.ndarray = None) -> dict:
+    """The number of pairs excluded by exactly each combination of constraints, i.e. the sizes of the regions of the
+    Venn diagram; the combination is the tuple of labels, () for the valid pairs. Instead of the reasons, the histogram
+    `np.bincount(reasons.ravel(), minlength=256)` can be given, e.g. summed over the blocks of a streamed evaluation."""
+    if counts is None:
+        counts = np.bincount(reasons.ravel(), minlength=256)
+    return {
+        tuple(label for bit, label in REASONS.items() if combination & bit): int(counts[combination])
+        for combination in np.flatnonzero(counts)
+    }
+
+
+def reason_sets(reasons: np.ndarray) -> dict:
+    """The flat indices (in the order of `product(entries, targets)`) of the pairs excluded by each constraint, as sets
+    for supervenn; constraints that exclude no pair are left out."""
+    flat = reasons.ravel()
+    sets = {label: set(np.flatnonzero(flat & bit).tolist()) for bit, label in REASONS.items()}
+    return {label: indices for label, indices in sets.items() if indices}
+
+
+def save_reasons(path, reasons: np.ndarray, entry_ids: np.ndarray, target_ids: np.ndarray):
+    """Save the (N, M) reason bits of every pair to the .npz file `path`, with the ids of the N entries and M targets
+    (e.g. those of the .fcsv files) that its rows and columns stand for, as strings."""
+    np.savez(path, reasons=reasons, entry_ids=np.asarray(entry_ids, dtype=str), target_ids=np.asarray(target_ids, dtype=str))
+
+
+def load_reasons(path, entry_ids: np.ndarray, target_ids: np.ndarray):
+    """The reason bits saved by `save_reasons` in `path`, or None if there are none or if they were saved for other
+    entries or targets than `entry_ids` and `target_ids` (e.g. after the fiducials were edited)."""
+    try:
+        with np.load(path) as saved:
+            if np.array_equal(saved["entry_ids"], np.asarray(entry_ids, dtype=str)) and np.array_equal(
+                saved["target_ids"], np.asarray(target_ids, dtype=str)
+            ):
+                return saved["reasons"]
+    except (FileNotFoundError, KeyError, ValueError):  # no file, no ids, or ids saved as objects by an older version
+        pass
+    return None
+
+
+def constraint_reasons(bit, backend, entries: np.ndarray, targets: np.ndarray, tested: np.ndarray, max_angle: float = None, radius: float = 0.0, spacing=None) -> np.ndarray:
+    """The bit of one surface constraint for every entry x target pair, with the packet queries of an intersection backend.
+
+    - `NOT_IN_TARGET` where the segment does not intersect with the surface (the target structure).
+    - `CRITICAL` where it intersects with the surface (the critical structures), or comes within `radius` mm of it.
+    - `CORTEX_ANGLE` where its angle to the normal of the surface (the cortex) is greater than `max_angle` degrees.
+
+    Args:
+        bit: One of the three bits above.
+        backend: The `IntersectionBackend` of the surface, or for `CORTEX_ANGLE` anything with its `angle_packet` (e.g. a
+            `NormalField`).
+        entries: (n, 3) array of entry points in numpy indices.
+        targets: (M, 3) array of target points in numpy indices.
+        tested: (n, M) boolean array of the pairs to query, e.g. those whose segment passes through the bounding box of
+            the surface; the others cannot intersect with it.
+        max_angle: The maximum angle in degrees, for `CORTEX_ANGLE`.
+        radius: The radius of the electrode in mm, for `CRITICAL` (see `IntersectionBackend.capsule_packet`).
+        spacing: The voxel spacing of the image, in mm, for `CRITICAL` with radius > 0.
+
+    Returns:
+        (n, M) uint8 array of the bit.
+    """
+    reasons = np.zeros(tested.shape, dtype=np.uint8)
+    for i, entry in enumerate(entries):
+        columns = np.flatnonzero(tested[i])
+        if bit == CORTEX_ANGLE:
+            violated = backend.angle_packet(entry, targets[columns]) > max_angle
+        elif bit == CRITICAL and radius > 0:
+            violated = backend.capsule_packet(entry, targets[columns], radius, spacing)
+        else:
+            hits = backend.intersects_packet(entry, targets[columns])
+            violated = ~hits if bit == NOT_IN_TARGET else hits
+        reasons[i, columns[violated]] = bit
+    if bit == NOT_IN_TARGET:
+        reasons[~tested] = bit
+    return reasons
+
+
+def pair_reasons(entries: np.ndarray, targets: np.ndarray, spacing, target, critical, cortex, max_length: float = None, max_angle: float = 90 - 55, radius: float = 0.0) -> np.ndarray:
+    """All the reason bits of every entry x target pair: the prefilter, then the packet queries of the three surfaces.
+
+    Only (n, M) arrays are allocated, so the pairs can be evaluated in blocks of entries of any size with bounded memory.
+
+    Args:
+        entries: (n, 3) array of entry points in numpy indices.
+        targets: (M, 3) array of target points in numpy indices.
+        spacing: The voxel spacing of the image, in mm.
+        target: The `IntersectionBackend` of the target structure.
+        critical: The `IntersectionBackend` of the critical structures.
+        cortex: The `IntersectionBackend` of the cortex.
+        max_length: The maximum trajectory length in mm. Defaults to None (no length constraint).
+        max_angle: The maximum angle in degrees to the normal of the cortex. Defaults to 35.
+        radius: The radius of the electrode in mm. Defaults to 0.0 (a line).
+
+    Returns:
+        (n, M) uint8 array of reason bits.
+    """
+    masks = prefilter(entries, targets, spacing, target.mesh, critical.mesh, max_length, radius)
+    reasons = prefilter_reasons(masks, max_length)
+    reasons |= constraint_reasons(NOT_IN_TARGET, target, entries, targets, masks["target_box"])
+    reasons |= constraint_reasons(CRITICAL, critical, entries, targets, masks["test_critical"], radius=radius, spacing=spacing)
+    reasons |= constraint_reasons(CORTEX_ANGLE, cortex, entries, targets, np.ones(reasons.shape, dtype=bool), max_angle)
+    return reasons
+
+
+def update_reasons(reasons: np.ndarray, bit, backend, entries: np.ndarray, targets: np.ndarray, boxes: np.ndarray, max_angle: float = None, radius: float = 0.0, spacing=None) -> np.ndarray:
+    """Evaluate one surface constraint again, in place, after its surface changed inside some boxes only (e.g. the
+    dirty regions returned by `IncrementalSurface.update`).
+
+    A segment that misses all the boxes crosses the same triangles as before, so only the pairs whose segment passes
+    through one of them (grown by `radius` for `CRITICAL`) are queried again, first against the box around all of them.
+
+    Args:
+        reasons: (N, M) uint8 array of the reason bits of every entry x target pair, updated in place.
+        bit: The bit of the constraint, see `constraint_reasons`.
+        backend: The `IntersectionBackend` of the new surface.
+        entries: (N, 3) array of entry points in numpy indices.
+        targets: (M, 3) array of target points in numpy indices.
+        boxes: (k, 2, 3) array of the lower and upper corners of the boxes where the surface changed.
+        max_angle: The maximum angle in degrees, for `CORTEX_ANGLE`.
+        radius: The radius of the electrode in mm, for `CRITICAL`.
+        spacing: The voxel spacing of the image, in mm, for `CRITICAL` with radius > 0.
+
+    Returns:
+        (N, M) boolean array of the pairs that were evaluated again.
+    """
+    margin = 1e-6
+    if bit == CRITICAL and radius > 0:
+        margin = margin + radius / np.asarray(spacing, dtype=np.float64)
+    if not len(boxes):
+        return np.zeros(reasons.shape, dtype=bool)
+    affected = segments_hit_box(entries, targets, np.stack([boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)]), margin)
+    rows = np.flatnonzero(affected.any(axis=1))
+    if len(boxes) > 1:
+        exact = np.zeros((len(rows), len(targets)), dtype=bool)
+        for box in boxes:
+            exact |= segments_hit_box(entries[rows], targets, box, margin)
+        affected[rows] &= exact
+
+    new = constraint_reasons(bit, backend, entries[rows], targets, affected[rows], max_angle, radius, spacing)
+    reasons[rows] = np.where(affected[rows], (reasons[rows] & ~np.uint8(bit)) | new, reasons[rows])
+    return affected
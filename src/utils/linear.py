@@ -42,6 +42,24 @@ def point_to_numpy_idx(coord: tuple, itk_image, round: bool = False):
     return idx
 
 
+def points_to_numpy_idx(coords, itk_image) -> np.ndarray:
+    """Convert point coordinates to numpy indices at once; the same as `point_to_numpy_idx` for every point.
+    Args:
+        coords: (n, 3) array of 3D point coordinates.
+        itk_image: ITK image object.
+
+    Returns:
+        (n, 3) array of the numpy indices corresponding to the input point coordinates.
+    """
+    shape = np.array(itk_image.GetSize())
+    direction = np.reshape(itk_image.GetDirection(), (3, 3))
+    spacing = np.reshape(itk_image.GetSpacing(), (3, 1))
+    product = np.linalg.inv(direction * spacing)  # the rows of the direction matrix scaled by the spacing, inverted
+
+    idx = (np.asarray(coords, dtype=np.float64).reshape(-1, 3) - itk_image.GetOrigin()) @ product.T
+    return np.where(idx < 0, idx + shape, idx)  # reverse negative indices
+
+
 # def points_to_linear(point_1, point_2):
 #     """
 #     Calculate the linear equation of the line that passes through two points
@@ -4,6 +4,11 @@ from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
 from skimage import measure
 from numba import njit
+from time import perf_counter
+import os
+
+from src.modules.mesh import Mesh
+from src.modules.bricks import brick_size, brick_ranges, brick_occupancy, region_occupied, read_region
 
 import warnings
 
@@ -66,7 +71,128 @@ def marching_cubes(volume: np.ndarray, level: float = 0.5, visualize=False, line
     return verts, faces, normals, values
 
 
-@njit()
+def marching_cubes_cropped(mask, level: float = 0.5, margin: int = 1):
+    """Marching cubes on a `CroppedMask`, returning vertices in the index space of the full volume.
+
+    The cropped mask is padded with `margin` voxels of zeros, except where it already touches the edge of the volume,
+    so the surface is the same as that of `marching_cubes` on the full volume, at the cost of the bounding box only.
+
+    Args:
+        mask (CroppedMask): The binary mask cropped to its bounding box (see `src.modules.volumes`).
+        level (float, optional): The isosurface level to be extracted. Defaults to 0.5.
+        margin (int, optional): The number of voxels of zeros around the bounding box. Defaults to 1.
+
+    Returns:
+        tuple: A tuple containing the vertices, faces, normals, and values of the mesh.
+    """
+    if not mask.array.size:  # empty structure
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int32), np.zeros((0, 3), np.float32), np.zeros(0, np.float32)
+
+    lower = [min(margin, o) for o in mask.offset]
+    upper = [min(margin, s - o - c) for s, o, c in zip(mask.shape, mask.offset, mask.array.shape)]
+    volume = np.pad(mask.array, list(zip(lower, upper)))
+
+    verts, faces, normals, values = measure.marching_cubes(volume, level=level)
+    verts += np.subtract(mask.offset, lower).astype(verts.dtype)  # back to the index space of the full volume
+    return verts, faces, normals, values
+
+
+def vertex_edges(verts: np.ndarray):
+    """The element of the voxel grid that each vertex of marching cubes on a binary mask lies on: the voxel below it
+    and the axis of the edge from that voxel, or 3 for the centre of the cube (added by Lewiner's algorithm in the
+    ambiguous cases)."""
+    lower = np.floor(verts).astype(np.int64)
+    fraction = verts - lower
+    return lower, np.where((fraction > 0).all(axis=1), 3, np.argmax(fraction, axis=1))
+
+
+def vertex_keys(verts: np.ndarray, shape) -> np.ndarray:
+    """A key of each vertex of marching cubes on a binary mask of `shape`, equal for the copies of a vertex computed by
+    different bricks (see `vertex_edges`)."""
+    lower, axis = vertex_edges(verts)
+    return np.ravel_multi_index(tuple(lower.T), shape) * 4 + axis
+
+
+def face_keys(triangles: np.ndarray, shape) -> np.ndarray:
+    """A sort key of each (n_faces, 3, 3) triangle of marching cubes on a binary mask of `shape`: its cube (the voxel
+    below its centroid) in C order, then its three vertices relative to that cube (see `vertex_edges`), so that the
+    order of the faces only depends on the triangles themselves."""
+    cube = np.clip(np.floor(triangles.mean(axis=1)).astype(np.int64), 0, np.subtract(shape, 2))
+    lower, axis = vertex_edges(triangles.reshape(-1, 3))
+    offset = lower.reshape(-1, 3, 3) - cube[:, None] + 1  # in {0, 1, 2} along each axis
+    codes = np.sort((offset[..., 0] * 9 + offset[..., 1] * 3 + offset[..., 2]) * 4 + axis.reshape(-1, 3), axis=1)
+    return (np.ravel_multi_index(tuple(cube.T), shape) << 21) | (codes[:, 0] << 14) | (codes[:, 1] << 7) | codes[:, 2]
+
+
+def marching_cubes_bricked(mask, level: float = 0.5, memory_budget: int = 64 << 20, margin: int = 1):
+    """Marching cubes on a `CroppedMask` brick by brick, with a peak memory bounded by `memory_budget` bytes (plus the
+    mesh itself) instead of the size of the bounding box, e.g. for a memory-mapped mask.
+
+    The cubes of the padded domain of `marching_cubes_cropped` are split into bricks, and each brick reads its voxels
+    and those of the next layer on its upper sides, so that neighbouring bricks share the voxels of their seam. Bricks
+    without a voxel of the structure (from the occupancy index of the mask) or entirely inside it have no surface and
+    are skipped. A vertex on a seam is interpolated from the same two voxels by both bricks, so the copies are equal
+    and are welded into one; the faces are then sorted by `face_keys`, so the mesh does not depend on the size of the
+    bricks.
+
+    Args:
+        mask (CroppedMask): The binary mask cropped to its bounding box (see `src.modules.volumes`).
+        level (float, optional): The isosurface level to be extracted. Defaults to 0.5.
+        memory_budget (int, optional): The memory available to a brick, in bytes. Defaults to 64 MiB.
+        margin (int, optional): The number of voxels of zeros around the bounding box. Defaults to 1.
+
+    Returns:
+        tuple: A tuple containing the vertices and faces of the mesh, in the index space of the full volume.
+    """
+    if not mask.array.size:  # empty structure
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int32)
+
+    # the padded domain of `marching_cubes_cropped`, and its cubes (indexed by their lower voxel)
+    lower = np.subtract(mask.offset, [min(margin, o) for o in mask.offset])
+    upper = np.add(mask.offset, mask.array.shape) + [min(margin, s - o - c) for s, o, c in zip(mask.shape, mask.offset, mask.array.shape)]
+    cubes = tuple(int(i) for i in upper - lower - 1)
+
+    # skimage works on a float64 copy of the brick, plus the intermediate arrays of its cubes
+    brick = brick_size(memory_budget, 24, halo=1)
+    occupancy = brick_occupancy(mask.array, brick)
+    verts, faces, n_verts = [], [], 0
+    for start, end in brick_ranges(cubes, brick):
+        start, end = lower + start, lower + np.asarray(end) + 1  # the voxels of the cubes of the brick
+        if not region_occupied(mask, occupancy, brick, start, end):
+            continue
+        region = read_region(mask, start, end)
+        if region.min() == region.max():  # no surface inside
+            continue
+        brick_verts, brick_faces, _, _ = measure.marching_cubes(region, level=level)
+        verts.append(brick_verts + start.astype(brick_verts.dtype))
+        faces.append(brick_faces + n_verts)
+        n_verts += len(brick_verts)
+    if not verts:
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int32)
+
+    # weld the copies of the seam vertices (on the same edge), then order the faces and the vertices by first use
+    verts = np.concatenate(verts)
+    _, index, inverse = np.unique(vertex_keys(verts, mask.shape), return_index=True, return_inverse=True)
+    verts, faces = verts[index], inverse.reshape(-1)[np.concatenate(faces)]
+    faces = faces[np.argsort(face_keys(verts[faces], mask.shape), kind="stable")]
+    used, first = np.unique(faces.reshape(-1), return_index=True)
+    order = used[np.argsort(first)]
+    renumber = np.empty(len(verts), dtype=np.int32)
+    renumber[order] = np.arange(len(order), dtype=np.int32)
+    return verts[order], renumber[faces]
+
+
+def mesh_structure(name, mask, level: float = 0.5, split_components: bool = False, memory_budget: int = None):
+    """Build the `Mesh` of one cropped mask; returns (name, Mesh) so that it can be used with `Executor.map`.
+    With a `memory_budget` in bytes, the mask is meshed brick by brick (see `marching_cubes_bricked`)."""
+    if memory_budget is not None:
+        verts, faces = marching_cubes_bricked(mask, level, memory_budget)
+        return name, Mesh(verts, faces, split_components=split_components)
+    verts, faces, _, _ = marching_cubes_cropped(mask, level)
+    return name, Mesh(verts, faces, split_components=split_components)
+
+
+@njit(cache=True)
 def ray_triangle_intersection(origin, direction, vertices, triangle, distance=False):
     """
     Check if a ray intersects with a triangle and optionally return the distance.
@@ -120,7 +246,7 @@ def ray_triangle_intersection(origin, direction, vertices, triangle, distance=Fa
         return False
 
 
-@njit()
+@njit(cache=True)
 def check_angle_of_intersection(p1, p2, verts, faces):
     """
     Calculates the minimum angle between the ray and the normal vector of the triangle surface.
@@ -178,6 +304,56 @@ def check_angle_of_intersection(p1, p2, verts, faces):
     return False
 
 
+@njit(cache=True)
+def check_distance_intersection(p1, p2, verts, faces):
+    """
+    Calculates the distance from the start of a line to the closest point where it meets a triangle surface.
+    Used for constraint (c), e.g. how deep the tool goes before reaching the target structure.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the line
+    p2: np.ndarray
+        end point of the line
+    verts: np.ndarray
+        an array of vertices of the triangle surface
+    faces: np.ndarray
+        an array of faces of the triangle surface
+
+    Returns:
+    -------
+    float:
+        The distance in numpy indices (multiply by the spacing for mm), np.inf if the line does not meet the surface
+    """
+    d = p2 - p1
+    nearest = np.inf
+
+    for face in faces:
+        e1 = verts[face[1]] - verts[face[0]].astype(np.float64)
+        e2 = verts[face[2]] - verts[face[0]].astype(np.float64)
+
+        h = np.cross(d, e2).astype(np.float64)
+        a = np.dot(e1, h)
+
+        if a > -1e-10 and a < 1e-10:
+            continue
+        f = 1.0 / a
+        s = p1 - verts[face[0]]
+        u = f * np.dot(s, h)
+        if u < 0.0 or u > 1.0:
+            continue
+        q = np.cross(s, e1)
+        v = f * np.dot(d, q)
+        if v < 0.0 or u + v > 1.0:
+            continue
+        t = f * np.dot(e2, q)
+        if 0.0 <= t <= 1.0 and t < nearest:  # between the two points, the start point included
+            nearest = t
+
+    return nearest * np.linalg.norm(d)
+
+
 # @njit()
 def check_intersect(p1, p2, verts, faces):
     """
@@ -212,6 +388,422 @@ def check_intersect(p1, p2, verts, faces):
         return False
 
 
+@njit(cache=True, nogil=True)
+def segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i):
+    """
+    Moller-Trumbore intersection of a ray with the i-th triangle of a `Mesh`.
+    Works on scalars and the precomputed structure-of-arrays triangle data so that nothing is allocated.
+
+    Args:
+    ----
+    px, py, pz: float
+        origin of the ray
+    dx, dy, dz: float
+        direction of the ray (p2 - p1, not normalised)
+    v0, edge1, edge2: np.ndarray
+        (3, n_faces) arrays of the first vertex and the two edges of the triangles (see `Mesh`)
+    i: int
+        index of the triangle
+
+    Returns:
+    -------
+    float:
+        The ray parameter t of the intersection, or -1.0 if the ray misses the triangle (or is parallel to it)
+    """
+    e1x, e1y, e1z = np.float64(edge1[0, i]), np.float64(edge1[1, i]), np.float64(edge1[2, i])
+    e2x, e2y, e2z = np.float64(edge2[0, i]), np.float64(edge2[1, i]), np.float64(edge2[2, i])
+
+    # h = d x e2
+    hx = dy * e2z - dz * e2y
+    hy = dz * e2x - dx * e2z
+    hz = dx * e2y - dy * e2x
+    a = e1x * hx + e1y * hy + e1z * hz
+
+    if -1e-10 < a < 1e-10:
+        return -1.0
+
+    f = 1.0 / a
+    sx = px - v0[0, i]
+    sy = py - v0[1, i]
+    sz = pz - v0[2, i]
+    u = f * (sx * hx + sy * hy + sz * hz)
+
+    if u < 0.0 or u > 1.0:
+        return -1.0
+
+    # q = s x e1
+    qx = sy * e1z - sz * e1y
+    qy = sz * e1x - sx * e1z
+    qz = sx * e1y - sy * e1x
+    v = f * (dx * qx + dy * qy + dz * qz)
+
+    if v < 0.0 or u + v > 1.0:
+        return -1.0
+
+    return f * (e2x * qx + e2y * qy + e2z * qz)
+
+
+@njit(cache=True, nogil=True)
+def segment_mesh_intersect(p1, p2, v0, edge1, edge2):
+    """
+    Check if the segment p1 -> p2 intersects with any triangle of a `Mesh`.
+    Same result as `check_intersect` but reads the precomputed triangle data and allocates nothing.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the segment
+    p2: np.ndarray
+        end point of the segment
+    v0, edge1, edge2: np.ndarray
+        (3, n_faces) arrays of the first vertex and the two edges of the triangles (see `Mesh`)
+
+    Returns:
+        bool:
+            True if the segment intersects with the surface, False otherwise
+    """
+    px, py, pz = p1[0], p1[1], p1[2]
+    dx, dy, dz = p2[0] - px, p2[1] - py, p2[2] - pz
+
+    for i in range(v0.shape[1]):
+        t = segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i)
+        if 1e-10 < t < 1:  # between the two points
+            return True
+    return False
+
+
+@njit(cache=True, nogil=True)
+def segment_segment_distance_sq(ax, ay, az, ux, uy, uz, bx, by, bz, vx, vy, vz):
+    """
+    Squared distance between the segments a -> a + u and b -> b + v (Ericson, Real-Time Collision Detection, 5.1.9).
+    """
+    rx, ry, rz = ax - bx, ay - by, az - bz
+    uu = ux * ux + uy * uy + uz * uz
+    vv = vx * vx + vy * vy + vz * vz
+    vr = vx * rx + vy * ry + vz * rz
+    if uu <= 1e-20 and vv <= 1e-20:  # two points
+        s, t = 0.0, 0.0
+    elif uu <= 1e-20:
+        s, t = 0.0, min(max(vr / vv, 0.0), 1.0)
+    else:
+        ur = ux * rx + uy * ry + uz * rz
+        if vv <= 1e-20:
+            s, t = min(max(-ur / uu, 0.0), 1.0), 0.0
+        else:
+            uv = ux * vx + uy * vy + uz * vz
+            denominator = uu * vv - uv * uv
+            s = min(max((uv * vr - ur * vv) / denominator, 0.0), 1.0) if denominator > 1e-20 else 0.0
+            t = (uv * s + vr) / vv
+            if t < 0.0:
+                s, t = min(max(-ur / uu, 0.0), 1.0), 0.0
+            elif t > 1.0:
+                s, t = min(max((uv - ur) / uu, 0.0), 1.0), 1.0
+    dx = ax + s * ux - bx - t * vx
+    dy = ay + s * uy - by - t * vy
+    dz = az + s * uz - bz - t * vz
+    return dx * dx + dy * dy + dz * dz
+
+
+@njit(cache=True, nogil=True)
+def point_triangle_distance_sq(px, py, pz, ax, ay, az, e1x, e1y, e1z, e2x, e2y, e2z):
+    """
+    Squared distance between the point p and the triangle (a, a + e1, a + e2), from the Voronoi region of the triangle
+    the point is in (Ericson, Real-Time Collision Detection, 5.1.5).
+    """
+    # p - a, p - b, p - c
+    apx, apy, apz = px - ax, py - ay, pz - az
+    bpx, bpy, bpz = apx - e1x, apy - e1y, apz - e1z
+    cpx, cpy, cpz = apx - e2x, apy - e2y, apz - e2z
+    d1 = e1x * apx + e1y * apy + e1z * apz
+    d2 = e2x * apx + e2y * apy + e2z * apz
+    d3 = e1x * bpx + e1y * bpy + e1z * bpz
+    d4 = e2x * bpx + e2y * bpy + e2z * bpz
+    d5 = e1x * cpx + e1y * cpy + e1z * cpz
+    d6 = e2x * cpx + e2y * cpy + e2z * cpz
+    vc = d1 * d4 - d3 * d2
+    vb = d5 * d2 - d1 * d6
+    va = d3 * d6 - d5 * d4
+
+    if d1 <= 0.0 and d2 <= 0.0:  # vertex a
+        v, w = 0.0, 0.0
+    elif d3 >= 0.0 and d4 <= d3:  # vertex b
+        v, w = 1.0, 0.0
+    elif d6 >= 0.0 and d5 <= d6:  # vertex c
+        v, w = 0.0, 1.0
+    elif vc <= 0.0 and d1 >= 0.0 and d3 <= 0.0:  # edge ab
+        v, w = d1 / (d1 - d3), 0.0
+    elif vb <= 0.0 and d2 >= 0.0 and d6 <= 0.0:  # edge ac
+        v, w = 0.0, d2 / (d2 - d6)
+    elif va <= 0.0 and d4 - d3 >= 0.0 and d5 - d6 >= 0.0:  # edge bc
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        v = 1.0 - w
+    else:  # inside the face
+        v, w = vb / (va + vb + vc), vc / (va + vb + vc)
+    dx = apx - v * e1x - w * e2x
+    dy = apy - v * e1y - w * e2y
+    dz = apz - v * e1z - w * e2z
+    return dx * dx + dy * dy + dz * dz
+
+
+@njit(cache=True, nogil=True)
+def segment_triangle_distance_sq(px, py, pz, dx, dy, dz, v0, edge1, edge2, i, scale):
+    """
+    Squared distance between the segment p -> p + d and the i-th triangle of a `Mesh`, after scaling every axis by
+    `scale` (e.g. the voxel spacing, for a distance in mm between shapes given in numpy indices).
+
+    The distance is 0 if the segment crosses the triangle; otherwise the closest points are on an end point of the
+    segment and the face, or on the segment and an edge of the triangle.
+
+    Returns:
+    -------
+    float:
+        The squared distance
+    """
+    t = segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i)  # crossing does not depend on the scale
+    if 0.0 <= t <= 1.0:
+        return 0.0
+
+    sx, sy, sz = scale[0], scale[1], scale[2]
+    qx, qy, qz = px * sx, py * sy, pz * sz
+    ux, uy, uz = dx * sx, dy * sy, dz * sz
+    ax, ay, az = v0[0, i] * sx, v0[1, i] * sy, v0[2, i] * sz
+    e1x, e1y, e1z = edge1[0, i] * sx, edge1[1, i] * sy, edge1[2, i] * sz
+    e2x, e2y, e2z = edge2[0, i] * sx, edge2[1, i] * sy, edge2[2, i] * sz
+
+    best = point_triangle_distance_sq(qx, qy, qz, ax, ay, az, e1x, e1y, e1z, e2x, e2y, e2z)
+    best = min(best, point_triangle_distance_sq(qx + ux, qy + uy, qz + uz, ax, ay, az, e1x, e1y, e1z, e2x, e2y, e2z))
+    best = min(best, segment_segment_distance_sq(qx, qy, qz, ux, uy, uz, ax, ay, az, e1x, e1y, e1z))
+    best = min(best, segment_segment_distance_sq(qx, qy, qz, ux, uy, uz, ax, ay, az, e2x, e2y, e2z))
+    best = min(
+        best, segment_segment_distance_sq(qx, qy, qz, ux, uy, uz, ax + e1x, ay + e1y, az + e1z, e2x - e1x, e2y - e1y, e2z - e1z)
+    )
+    return best
+
+
+@njit(cache=True, nogil=True)
+def segment_mesh_distance(p1, p2, v0, edge1, edge2, scale):
+    """
+    Distance between the segment p1 -> p2 and the closest triangle of a `Mesh`, every axis scaled by `scale`.
+    The brute-force reference of the capsule queries (a capsule of radius r collides with the surface when this
+    distance is at most r).
+
+    Returns:
+    -------
+    float:
+        The distance, np.inf if the mesh has no triangle
+    """
+    px, py, pz = p1[0], p1[1], p1[2]
+    dx, dy, dz = p2[0] - px, p2[1] - py, p2[2] - pz
+    best = np.inf
+    for i in range(v0.shape[1]):
+        best = min(best, segment_triangle_distance_sq(px, py, pz, dx, dy, dz, v0, edge1, edge2, i, scale))
+        if best == 0.0:
+            break
+    return np.sqrt(best)
+
+
+@njit(cache=True, nogil=True)
+def segment_box_intersect(px, py, pz, dx, dy, dz, bounds):
+    """
+    Slab test of the segment p1 -> p1 + d against an axis-aligned box, grown by 1e-6 so that touching counts as a hit.
+
+    Args:
+    ----
+    px, py, pz: float
+        start point of the segment
+    dx, dy, dz: float
+        p2 - p1
+    bounds: np.ndarray
+        (2, 3) array of the minimum and maximum corner of the box
+
+    Returns:
+        bool:
+            True if the segment passes through the box, False otherwise
+    """
+    t_enter = 0.0
+    t_exit = 1.0
+    origin = (px, py, pz)
+    direction = (dx, dy, dz)
+
+    for axis in range(3):
+        lower = bounds[0, axis] - 1e-6
+        upper = bounds[1, axis] + 1e-6
+        if direction[axis] == 0:
+            if origin[axis] < lower or origin[axis] > upper:
+                return False
+            continue
+        t1 = (lower - origin[axis]) / direction[axis]
+        t2 = (upper - origin[axis]) / direction[axis]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        t_enter = max(t_enter, t1)
+        t_exit = min(t_exit, t2)
+        if t_enter > t_exit:
+            return False
+    return True
+
+
+@njit(cache=True, nogil=True)
+def segment_components_intersect(p1, p2, v0, edge1, edge2, component_ranges, component_bounds):
+    """
+    Find the first connected component of a `Mesh` that the segment p1 -> p2 intersects with.
+    Components whose bounding box the segment misses are skipped without looking at their triangles.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the segment
+    p2: np.ndarray
+        end point of the segment
+    v0, edge1, edge2: np.ndarray
+        (3, n_faces) arrays of the first vertex and the two edges of the triangles (see `Mesh`)
+    component_ranges, component_bounds: np.ndarray
+        the face range and the bounding box of each component (see `Mesh`)
+
+    Returns:
+        int:
+            The index of the component, or -1 if the segment does not intersect with the surface
+    """
+    px, py, pz = p1[0], p1[1], p1[2]
+    dx, dy, dz = p2[0] - px, p2[1] - py, p2[2] - pz
+
+    for c in range(component_ranges.shape[0]):
+        if not segment_box_intersect(px, py, pz, dx, dy, dz, component_bounds[c]):
+            continue
+        for i in range(component_ranges[c, 0], component_ranges[c, 1]):
+            t = segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i)
+            if 1e-10 < t < 1:  # between the two points
+                return c
+    return -1
+
+
+@njit(cache=True, nogil=True)
+def segment_mesh_angle(p1, p2, v0, edge1, edge2, normal):
+    """
+    Angle between the segment p1 -> p2 and the normal of the first triangle (in face order) of a `Mesh` it crosses.
+    Same result as `check_angle_of_intersection` but reads the precomputed triangle data and allocates nothing.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the segment
+    p2: np.ndarray
+        end point of the segment
+    v0, edge1, edge2, normal: np.ndarray
+        (3, n_faces) arrays of the first vertex, the two edges and the normal of the triangles (see `Mesh`)
+
+    Returns:
+    -------
+    float:
+        The angle in degrees (between 0 and 90) or 0.0 if the segment does not intersect with the surface
+    """
+    px, py, pz = p1[0], p1[1], p1[2]
+    dx, dy, dz = p2[0] - px, p2[1] - py, p2[2] - pz
+
+    for i in range(v0.shape[1]):
+        t = segment_triangle_t(px, py, pz, dx, dy, dz, v0, edge1, edge2, i)
+        if 1e-10 < t < 1:  # between the two points
+            nx, ny, nz = np.float64(normal[0, i]), np.float64(normal[1, i]), np.float64(normal[2, i])
+            cos = (dx * nx + dy * ny + dz * nz) / (np.sqrt(dx * dx + dy * dy + dz * dz) * np.sqrt(nx * nx + ny * ny + nz * nz))
+            angle = np.arccos(min(max(cos, -1.0), 1.0))
+            # Get the minimum of the angle and its complementary angle (90 - angle)
+            if angle > np.pi / 2:
+                angle = np.pi - angle
+            return np.rad2deg(angle)
+    return 0.0
+
+
+def check_intersect_mesh(p1, p2, mesh):
+    """
+    Check if a line intersects with a `Mesh`.
+    A wrapper function for segment_components_intersect.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the line
+    p2: np.ndarray
+        end point of the line
+    mesh: Mesh
+        the triangle surface
+
+    Returns:
+        bool:
+            True if the line intersects with the triangle surface, False otherwise
+    """
+    return intersected_component(p1, p2, mesh) >= 0
+
+
+def intersected_component(p1, p2, mesh):
+    """
+    Find which connected component of a `Mesh` a line intersects with, e.g. which vessel excludes a trajectory.
+    A wrapper function for segment_components_intersect.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the line
+    p2: np.ndarray
+        end point of the line
+    mesh: Mesh
+        the triangle surface
+
+    Returns:
+        int:
+            The index of the first component (in `mesh.component_ranges`) the line intersects with, -1 if none
+    """
+    return segment_components_intersect(
+        p1, p2, mesh.v0, mesh.edge1, mesh.edge2, mesh.component_ranges, mesh.component_bounds
+    )
+
+
+def check_angle_of_intersection_mesh(p1, p2, mesh):
+    """
+    Calculates the angle between a line and the normal of the first triangle of a `Mesh` it crosses.
+    A wrapper function for segment_mesh_angle.
+
+    Args:
+    ----
+    p1: np.ndarray
+        start point of the line
+    p2: np.ndarray
+        end point of the line
+    mesh: Mesh
+        the triangle surface
+
+    Returns:
+    -------
+    float:
+        The angle in degrees, 0.0 if the line does not intersect with the surface
+    """
+    return segment_mesh_angle(p1, p2, mesh.v0, mesh.edge1, mesh.edge2, mesh.normal)
+
+
+def warm_up():
+    """
+    Compile the kernels used by the planner (including those of the BVH), or load them from the on-disk numba cache (`cache=True`), with the
+    argument types of real calls (float64 points, float32 mesh arrays). Call it once in the parent process before
+    starting a Pool so that forked workers inherit the compiled code instead of each compiling it again.
+
+    Returns:
+        float: The time taken in seconds
+    """
+    from src.modules.bvh import BVH  # imports this module
+
+    start = perf_counter()
+    mesh = Mesh(np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]]), np.array([[0, 1, 2]]))
+    p1 = np.array([0.2, 0.2, -1.0])
+    p2 = np.array([0.2, 0.2, 1.0])
+    check_intersect_mesh(p1, p2, mesh)
+    check_angle_of_intersection_mesh(p1, p2, mesh)
+    bvh = BVH(mesh)
+    bvh.intersects(p1, p2)
+    bvh.angle(p1, p2)
+    bvh.intersects_packet(p1, p2[None])
+    bvh.angle_packet(p1, p2[None])
+    return perf_counter() - start
+
+
 if __name__ == "__main__":
     import os
     from pathlib import Path
@@ -254,3 +846,9 @@ if __name__ == "__main__":
     # time the function
     print(timeit(lambda: check_intersect(p1, p2, verts_hippo, faces_hippo), number=1000))  # 5.8907715419999995
     print(timeit(lambda: check_intersect(p1, p2, verts_ventricles, faces_ventricles), number=1000))  # 21.919658
+
+    # the same checks on the compact Mesh type
+    mesh_hippo = Mesh(verts_hippo, faces_hippo)
+    mesh_ventricles = Mesh(verts_ventricles, faces_ventricles)
+    print(timeit(lambda: check_intersect_mesh(p1, p2, mesh_hippo), number=1000))
+    print(timeit(lambda: check_intersect_mesh(p1, p2, mesh_ventricles), number=1000))
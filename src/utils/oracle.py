@@ -0,0 +1,387 @@
+import numpy as np
+import pandas
+from numba import njit
+from src.modules.mesh import Mesh
+from src.modules.bvh import BVH, BrickedBVH
+from src.modules.backends import COMPARISON_BACKENDS, make_backend
+from src.modules.sweep import SweepBackend
+from src.utils.marching_cubes import marching_cubes, check_intersect, check_angle_of_intersection, check_intersect_mesh
+from src.utils.prefilter import segments_hit_box
+
+# the vertices and the segments of the generated cases are on this dyadic grid, so that every product and sum of the
+# intersection tests is exact in float32 and float64 alike and any disagreement is a bug rather than rounding
+GRID = 1 / 64
+# the angles may differ by rounding: the reference normalises the normal of each face, the kernels read it precomputed
+ANGLE_TOLERANCE = 1e-6
+# the kinds of segments of `edge_case_segments`
+SEGMENT_KINDS = ("random", "vertex", "edge", "axis", "coplanar", "endpoint", "degenerate")
+PHANTOM_KINDS = ("blob", "staircase", "soup")
+
+
+def reference_answers(mesh: Mesh, p1s, p2s):
+    """The brute-force answers for the segments p1s[k] -> p2s[k]: `check_intersect` and `check_angle_of_intersection`
+    over every face of `mesh`, in face order.
+
+    Returns:
+        tuple: (hits, angles), (n,) bool and float64 arrays; the angle is 0 without intersection.
+    """
+    verts, faces = mesh.verts.astype(np.float64), mesh.faces
+    hits = np.array([check_intersect(p1, p2, verts, faces) for p1, p2 in zip(p1s, p2s)], dtype=bool).reshape(-1)
+    angles = np.array([float(check_angle_of_intersection(p1, p2, verts, faces)) for p1, p2 in zip(p1s, p2s)]).reshape(-1)
+    return hits, angles
+
+
+def _by_start(query, p1s, p2s, dtype):
+    """Answer the segments grouped by their start point, with query(p1, p2s) of one group at a time."""
+    result = np.empty(len(p1s), dtype=dtype)
+    if not len(p1s):
+        return result
+    _, inverse = np.unique(p1s, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for k in range(inverse.max() + 1):
+        rows = np.flatnonzero(inverse == k)
+        result[rows] = query(p1s[rows[0]], p2s[rows])
+    return result
+
+
+def _single(backend):
+    return (
+        lambda p1s, p2s: np.array([backend.intersects(p1, p2) for p1, p2 in zip(p1s, p2s)], dtype=bool).reshape(-1),
+        lambda p1s, p2s: np.array([backend.angle(p1, p2) for p1, p2 in zip(p1s, p2s)], dtype=np.float64).reshape(-1),
+    )
+
+
+def _components(mesh):
+    # the faces are reordered by component, so only the hits are comparable (the angle is that of the first face)
+    split = Mesh(mesh.verts, mesh.faces, split_components=True)
+    return lambda p1s, p2s: np.array([check_intersect_mesh(p1, p2, split) for p1, p2 in zip(p1s, p2s)], dtype=bool).reshape(-1), None
+
+
+def _box_prefilter(mesh):
+    backend = make_backend("numba", mesh)
+    box = mesh.bounds
+
+    def intersects(p1s, p2s):
+        kept = _by_start(lambda p1, p2s: segments_hit_box(p1[None], p2s, box)[0], p1s, p2s, bool)
+        return np.array([kept[k] and backend.intersects(p1s[k], p2s[k]) for k in range(len(p1s))], dtype=bool)
+
+    return intersects, None
+
+
+def _packets(mesh, packet_size=7):
+    bvh = BVH(mesh)
+    return (
+        lambda p1s, p2s: _by_start(lambda p1, p2s: bvh.intersects_packet(p1, p2s, packet_size), p1s, p2s, bool),
+        lambda p1s, p2s: _by_start(lambda p1, p2s: bvh.angle_packet(p1, p2s, packet_size), p1s, p2s, np.float64),
+    )
+
+
+def _batch(mesh):
+    bvh = BVH(mesh)
+    return bvh.intersects_batch, bvh.angle_batch
+
+
+def _bricked(mesh, n=2):
+    # the faces are split into n x n x n bricks by their centroid, each with its own subtree
+    lower, upper = mesh.verts.min(axis=0), mesh.verts.max(axis=0)
+    size = np.where(upper > lower, (upper - lower) / n, 1.0)
+    index = np.indices((n, n, n)).reshape(3, -1).T
+    bvh = BrickedBVH((lower + index * size).astype(np.float32), (lower + (index + 1) * size).astype(np.float32))
+    centroids = mesh.verts[mesh.faces].mean(axis=1)
+    cells = np.clip(((centroids - lower) / size).astype(np.int64), 0, n - 1)
+    bvh.update(mesh, np.ravel_multi_index(tuple(cells.T), (n, n, n)).astype(np.int32), np.arange(n**3))
+    return bvh.intersects_batch, bvh.angle_batch
+
+
+# the engines checked against the brute force: each builds, for a mesh, a function answering whether the segments
+# p1s[k] -> p2s[k] intersect with it and one answering their angle (None if the engine does not compute angles)
+ENGINES = {
+    **{name: (lambda mesh, name=name: _single(COMPARISON_BACKENDS[name](mesh))) for name in COMPARISON_BACKENDS},
+    "components": _components,
+    "box_prefilter": _box_prefilter,
+    "bvh_packet": _packets,
+    "bvh_batch": _batch,
+    "bvh_bricked": _bricked,
+    # culled to the hull of the segments seen so far, so that most single queries cull it again to a larger hull
+    "sweep": lambda mesh: _single(SweepBackend("bvh", mesh)),
+}
+# the engines that are expected to disagree: vtkOBBTree misses the crossings of flat patches (see VTKOBBTreeBackend)
+APPROXIMATE_ENGINES = ("vtk_obbtree",)
+
+
+@njit(cache=True, nogil=True)
+def near_boundary(p1s, p2s, verts, faces, eps):
+    """
+    Whether each segment p1s[k] -> p2s[k] is within `eps` of the decision of the brute-force test for some face: the
+    barycentric coordinates u, v, u + v or the segment parameter t of a crossing it almost has or barely has are within
+    `eps` of the limits, so rounding alone can change the answer. Used to tell such ties from disagreements on meshes
+    and points that are not on the dyadic grid.
+
+    Returns:
+    -------
+    np.ndarray:
+        (n,) bool array
+    """
+    result = np.zeros(len(p1s), dtype=np.bool_)
+    for k in range(len(p1s)):
+        d = p2s[k] - p1s[k]
+        for face in faces:
+            e1 = verts[face[1]] - verts[face[0]]
+            e2 = verts[face[2]] - verts[face[0]]
+            h = np.cross(d, e2)
+            a = np.dot(e1, h)
+            if -1e-10 < a < 1e-10:
+                continue
+            f = 1.0 / a
+            s = p1s[k] - verts[face[0]]
+            u = f * np.dot(s, h)
+            v = f * np.dot(d, np.cross(s, e1))
+            t = f * np.dot(e2, np.cross(s, e1))
+            loose = u >= -eps and v >= -eps and u + v <= 1 + eps and 1e-10 - eps < t < 1 + eps
+            strict = u >= eps and v >= eps and u + v <= 1 - eps and 1e-10 + eps < t < 1 - eps
+            if loose and not strict:
+                result[k] = True
+                break
+    return result
+
+
+def differences(mesh: Mesh, p1s, p2s, names=None, reference=None) -> dict:
+    """Run the engines on the segments p1s[k] -> p2s[k] and compare them with the brute force.
+
+    Args:
+        mesh: The surface.
+        p1s, p2s: (n, 3) arrays of the end points, in numpy indices.
+        names: The engines (keys of `ENGINES`). Defaults to all of them.
+        reference: The answers of `reference_answers`, if already known.
+
+    Returns:
+        dict: name: (n,) bool array of the segments on which the engine disagrees with the brute force.
+    """
+    p1s = np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3)
+    p2s = np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3)
+    hits, angles = reference_answers(mesh, p1s, p2s) if reference is None else reference
+    result = {}
+    for name in ENGINES if names is None else names:
+        intersects, angle = ENGINES[name](mesh)
+        wrong = intersects(p1s, p2s) != hits
+        if angle is not None:
+            wrong |= ~np.isclose(angle(p1s, p2s), angles, rtol=0, atol=ANGLE_TOLERANCE)
+        result[name] = wrong
+    return result
+
+
+def _compact(verts, faces):
+    """The vertices used by the faces, and the faces numbering them."""
+    used, faces = np.unique(faces, return_inverse=True)
+    return verts[used], faces.reshape(-1, 3)
+
+
+def shrink(verts, faces, p1, p2, fails):
+    """Shrink a failing case to a minimal reproducer.
+
+    The faces are removed in chunks, halving the chunks while no chunk can go (keeping the order of the others, since
+    the angle is that of the first crossed face) and dropping the vertices no face uses (some engines depend on them),
+    then the coordinates of the vertices and of the end points are rounded to ever coarser grids, as long as `fails`
+    still holds.
+
+    Args:
+        verts, faces: The mesh of the failing case.
+        p1, p2: The failing segment.
+        fails: fails(verts, faces, p1, p2) -> bool, whether the case still fails.
+
+    Returns:
+        tuple: (verts, faces, p1, p2) of the smaller case.
+    """
+    verts, faces = np.array(verts, dtype=np.float64), np.array(faces, dtype=np.int64)
+    p1, p2 = np.array(p1, dtype=np.float64), np.array(p2, dtype=np.float64)
+    chunk = max(len(faces) // 2, 1)
+    while len(faces) > 1:
+        removed = False
+        for start in range(0, len(faces), chunk):
+            kept = _compact(verts, np.delete(faces, np.s_[start : start + chunk], axis=0))
+            if len(kept[1]) and fails(*kept, p1, p2):
+                (verts, faces), removed = kept, True
+                break
+        if not removed:
+            if chunk == 1:
+                break
+            chunk = max(chunk // 2, 1)
+
+    for step in (8.0, 4.0, 2.0, 1.0, 0.5, 0.25, 0.125):
+        for array in (verts, p1, p2):
+            flat = array.reshape(-1)
+            for k in range(len(flat)):
+                old = flat[k]
+                flat[k] = np.round(old / step) * step
+                if flat[k] != old and not fails(verts, faces, p1, p2):
+                    flat[k] = old
+    return verts, faces, p1, p2
+
+
+def reproducer(name: str, verts, faces, p1, p2) -> str:
+    """The Python code of a shrunk case, to paste into a test."""
+    return (
+        f"# {name} disagrees with the brute force\n"
+        f"verts = np.array({np.asarray(verts).tolist()})\n"
+        f"faces = np.array({np.asarray(faces).tolist()})\n"
+        f"p1, p2 = np.array({np.asarray(p1).tolist()}), np.array({np.asarray(p2).tolist()})"
+    )
+
+
+def snap(points):
+    """Round points to the dyadic `GRID`."""
+    return np.round(np.asarray(points, dtype=np.float64) / GRID) * GRID
+
+
+def random_phantom(kind: str, rng: np.random.Generator, size: int = 12) -> Mesh:
+    """A random surface to test the engines on.
+
+    - "blob": the marching-cubes surface of a smooth random blob,
+    - "staircase": that of random voxels, all flat axis-aligned patches and shared edges,
+    - "soup": random triangles, with duplicates, shared edges, coplanar neighbours and degenerate triangles.
+
+    The vertices are snapped to the dyadic `GRID`.
+    """
+    if kind == "soup":
+        verts = snap(rng.uniform(0, size, size=(30, 3)))
+        faces = rng.integers(0, 30, size=(40, 3))
+        neighbours = np.column_stack([faces[:10, 1], faces[:10, 0], rng.integers(0, 30, 10)])  # shared edges
+        degenerate = np.column_stack([faces[:3, 0], faces[:3, 0], faces[:3, 1]])
+        # a quad split in two: a coplanar neighbour sharing the diagonal
+        quad = snap(verts[faces[0, 0]] + rng.uniform(-2, 2, size=(4, 3)) * [1, 1, 0])
+        verts = np.concatenate([verts, quad])
+        faces = np.concatenate([faces, neighbours, faces[:5], degenerate, [[30, 31, 32], [30, 32, 33]]])
+        return Mesh(verts, faces)
+
+    grid = np.indices((size, size, size)).transpose(1, 2, 3, 0)
+    if kind == "blob":
+        centres = rng.uniform(3, size - 3, size=(3, 3))
+        radii = rng.uniform(1.5, 3.5, size=3)
+        volume = (np.linalg.norm(grid[..., None, :] - centres, axis=-1) < radii).any(axis=-1)
+    elif kind == "staircase":
+        volume = np.zeros((size, size, size), dtype=bool)
+        volume[2:-2, 2:-2, 2:-2] = rng.random((size - 4,) * 3) < 0.4
+    else:
+        raise ValueError(f"Unknown phantom {kind!r}, expected one of {PHANTOM_KINDS}")
+    if not volume.any():
+        volume[size // 2, size // 2, size // 2] = True
+    verts, faces, _, _ = marching_cubes(volume.astype(np.uint8), 0.5)
+    return Mesh(snap(verts), faces)
+
+
+def edge_case_segments(mesh: Mesh, n: int, rng: np.random.Generator):
+    """Random segments for a mesh, on the dyadic `GRID`, n of each kind of `SEGMENT_KINDS`:
+
+    - "random": end points in the box of the mesh, grown by 2,
+    - "vertex": through a vertex, "edge": through a point of an edge, "axis": the same along a coordinate axis,
+    - "coplanar": in the plane of a face, "endpoint": ending on a face (t = 1), "degenerate": p1 = p2.
+
+    Several segments start from the same point so that the packets have more than one segment.
+
+    Returns:
+        tuple: (p1s, p2s, kinds), the (k, 3) end points and the (k,) kind of each segment.
+    """
+    verts = mesh.verts.astype(np.float64)
+    lower, upper = verts.min(axis=0) - 2, verts.max(axis=0) + 2
+    faces = rng.integers(0, len(mesh.faces), size=n)
+    corners = verts[mesh.faces[faces]]  # (n, 3, 3)
+    weights = rng.choice([0.0, 0.25, 0.5, 0.75, 1.0], size=(n, 1))
+    vertices = corners[:, 0]
+    edges = corners[:, 0] + weights * (corners[:, 1] - corners[:, 0])
+    directions = snap(rng.uniform(-4, 4, size=(n, 3)))
+    axes = np.eye(3)[rng.integers(0, 3, size=n)] * rng.choice([-3.0, 3.0], size=(n, 1))
+    before = rng.choice([0.25, 0.5, 1.0], size=(n, 1))
+    # points of the plane of the faces, inside or outside of them
+    planar = lambda: corners[:, 0] + snap(rng.uniform(-1, 2, size=(n, 1))) * (corners[:, 1] - corners[:, 0]) + snap(
+        rng.uniform(-1, 2, size=(n, 1))
+    ) * (corners[:, 2] - corners[:, 0])
+    inside = rng.choice([0.0, 0.25, 0.5], size=(n, 2))
+    on_face = corners[:, 0] + inside[:, :1] * (corners[:, 1] - corners[:, 0]) + inside[:, 1:] * (corners[:, 2] - corners[:, 0])
+
+    starts = snap(rng.uniform(lower, upper, size=(max(n // 4, 1), 3)))
+    segments = {
+        "random": (starts[rng.integers(0, len(starts), size=n)], snap(rng.uniform(lower, upper, size=(n, 3)))),
+        "vertex": (vertices - before * directions, vertices + (1 - before) * directions),
+        "edge": (edges - before * directions, edges + (1 - before) * directions),
+        "axis": (np.where(rng.random((n, 1)) < 0.5, vertices, edges) - before * axes, np.where(rng.random((n, 1)) < 0.5, vertices, edges) + axes),
+        "coplanar": (planar(), planar()),
+        "endpoint": (starts[rng.integers(0, len(starts), size=n)], on_face),
+        "degenerate": (vertices, vertices.copy()),
+    }
+    p1s = snap(np.concatenate([segments[i][0] for i in SEGMENT_KINDS]))
+    p2s = snap(np.concatenate([segments[i][1] for i in SEGMENT_KINDS]))
+    return p1s, p2s, np.repeat(SEGMENT_KINDS, n)
+
+
+def run_campaign(n_phantoms: int, n_segments: int, rng: np.random.Generator, names=None, max_reproducers: int = 3):
+    """Compare the engines with the brute force on random phantoms and edge-case segments.
+
+    Args:
+        n_phantoms: The number of phantoms of each kind of `PHANTOM_KINDS`.
+        n_segments: The number of segments of each kind of `SEGMENT_KINDS` per phantom.
+        rng: The random generator.
+        names: The engines. Defaults to all of them.
+        max_reproducers: The number of failing cases shrunk per engine.
+
+    Returns:
+        tuple: (report, reproducers), a pandas.DataFrame of the disagreements per engine and kind of segment, and the
+            dict name: list of shrunk (verts, faces, p1, p2) cases.
+    """
+    names = list(ENGINES) if names is None else list(names)
+    counts = {(name, kind): 0 for name in names for kind in SEGMENT_KINDS}
+    totals = dict.fromkeys(SEGMENT_KINDS, 0)
+    reproducers = {name: [] for name in names}
+    for kind in PHANTOM_KINDS:
+        for _ in range(n_phantoms):
+            mesh = random_phantom(kind, rng)
+            p1s, p2s, kinds = edge_case_segments(mesh, n_segments, rng)
+            for segment_kind in SEGMENT_KINDS:
+                totals[segment_kind] += np.count_nonzero(kinds == segment_kind)
+            for name, wrong in differences(mesh, p1s, p2s, names).items():
+                for segment_kind in SEGMENT_KINDS:
+                    counts[name, segment_kind] += np.count_nonzero(wrong & (kinds == segment_kind))
+                for k in np.flatnonzero(wrong)[: max_reproducers - len(reproducers[name])]:
+                    fails = lambda verts, faces, p1, p2, name=name: differences(Mesh(verts, faces), p1[None], p2[None], [name])[name][0]
+                    reproducers[name].append(shrink(mesh.verts, mesh.faces, p1s[k], p2s[k], fails))
+
+    report = pandas.DataFrame(
+        [{"engine": name, **{kind: counts[name, kind] for kind in SEGMENT_KINDS}} for name in names]
+        + [{"engine": "segments", **totals}]
+    )
+    return report, reproducers
+
+
+def agreement(meshes: dict, p1s, p2s, names=None, eps: float = 1e-7) -> pandas.DataFrame:
+    """Compare the engines with the brute force on real meshes and segments (e.g. a sample of the pairs of a set).
+
+    The points and the vertices are not on a dyadic grid there, so the brute force and the kernels can round a
+    crossing exactly at the limit of a face differently: the disagreements of segments `near_boundary` of a face are
+    counted as ties rather than errors.
+
+    Args:
+        meshes: dict of name: Mesh.
+        p1s, p2s: (n, 3) arrays of the end points, in numpy indices.
+        names: The engines. Defaults to all of them.
+        eps: The distance to the limits of a face of a tie, in barycentric coordinates and segment parameter.
+
+    Returns:
+        pandas.DataFrame: One row per mesh and engine with the number of segments, hits, disagreements and ties.
+    """
+    p1s = np.ascontiguousarray(p1s, dtype=np.float64).reshape(-1, 3)
+    p2s = np.ascontiguousarray(p2s, dtype=np.float64).reshape(-1, 3)
+    rows = []
+    for mesh_name, mesh in meshes.items():
+        reference = reference_answers(mesh, p1s, p2s)
+        ties = near_boundary(p1s, p2s, mesh.verts.astype(np.float64), mesh.faces.astype(np.int64), eps)
+        for name, wrong in differences(mesh, p1s, p2s, names, reference).items():
+            rows.append(
+                {
+                    "mesh": mesh_name,
+                    "engine": name,
+                    "segments": len(p1s),
+                    "hits": int(np.count_nonzero(reference[0])),
+                    "disagree": int(np.count_nonzero(wrong & ~ties)),
+                    "ties": int(np.count_nonzero(wrong & ties)),
+                }
+            )
+    return pandas.DataFrame(rows)
@@ -0,0 +1,149 @@
+import numpy as np
+from numba import njit
+from numba.typed import List
+from src.modules.backends import IntersectionBackend
+from src.modules.distance_field import DistanceField
+
+# the objectives of a trajectory, in the order of the columns of `trajectory_objectives`, and whether each one is maximised
+OBJECTIVES = ("vessel_clearance", "ventricle_clearance", "length", "cortex_angle")
+MAXIMISE = np.array([True, True, False, False])
+
+
+def trajectory_objectives(entries, targets, spacing, vessels: DistanceField, ventricles: DistanceField, cortex: IntersectionBackend) -> np.ndarray:
+    """The objectives of the trajectories entries[k] -> targets[k], as the columns of one array.
+
+    - the clearance in mm to the vessels and to the ventricles (see `DistanceField.segment_clearance`), to maximise,
+    - the length in mm, to minimise,
+    - the angle in degrees between the trajectory and the normal of the cortex where it crosses it (see
+      `IntersectionBackend.angle`), to minimise.
+
+    Args:
+        entries: (n, 3) array of entry points in numpy indices.
+        targets: (n, 3) array of target points in numpy indices.
+        spacing: The voxel spacing of the image, in mm.
+        vessels, ventricles: The `DistanceField` of the vessels and of the ventricles.
+        cortex: The `IntersectionBackend` of the cortex, or its `NormalField`.
+
+    Returns:
+        (n, 4) float64 array, the columns in the order of `OBJECTIVES`.
+    """
+    entries = np.ascontiguousarray(entries, dtype=np.float64).reshape(-1, 3)
+    targets = np.ascontiguousarray(targets, dtype=np.float64).reshape(-1, 3)
+    objectives = np.empty((len(entries), len(OBJECTIVES)))
+    objectives[:, 0] = vessels.segment_clearance(entries, targets)
+    objectives[:, 1] = ventricles.segment_clearance(entries, targets)
+    objectives[:, 2] = np.linalg.norm((targets - entries) * np.asarray(spacing, dtype=np.float64), axis=1)
+    objectives[:, 3] = cortex.angle_batch(entries, targets)
+    return objectives
+
+
+@njit(cache=True, nogil=True)
+def front_dominates(front, count, p):
+    """Whether one of the first `count` rows of `front` dominates the costs p, from the last one put in the front."""
+    for q in range(count - 1, -1, -1):
+        dominated = True
+        strictly = False
+        for m in range(p.shape[0]):
+            if front[q, m] > p[m]:
+                dominated = False
+                break
+            if front[q, m] < p[m]:
+                strictly = True
+        if dominated and strictly:
+            return True
+    return False
+
+
+@njit(cache=True, nogil=True)
+def sort_fronts(costs, order):
+    """
+    Non-dominated sorting of solutions to minimise, by the efficient non-dominated sort with binary search (ENS-BS).
+
+    The solutions are visited in lexicographic order, so a solution is never dominated by a later one, and each is put
+    in the first front with no solution dominating it. If a solution of front k dominates p, one of every earlier front
+    does too, so that front is found by a binary search over the fronts: O(m n log n) comparisons when the fronts are
+    small, instead of the O(m n²) of comparing every pair. The costs of each front are copied into a contiguous buffer,
+    grown by doubling, so that scanning a front reads memory in order.
+
+    Args:
+    ----
+    costs: np.ndarray
+        (n, m) array of the objectives of each solution, all to minimise
+    order: np.ndarray
+        (n,) the solutions in lexicographic order of their costs
+
+    Returns:
+    -------
+    np.ndarray:
+        (n,) the front of each solution, 0 for the Pareto front
+    """
+    n, m = costs.shape
+    ranks = np.empty(n, dtype=np.int64)
+    fronts = List()
+    counts = np.zeros(n, dtype=np.int64)
+    for p in order:
+        low, high = 0, len(fronts)
+        while low < high:
+            middle = (low + high) // 2
+            if front_dominates(fronts[middle], counts[middle], costs[p]):
+                low = middle + 1
+            else:
+                high = middle
+        ranks[p] = low
+        if low == len(fronts):
+            fronts.append(np.empty((16, m)))
+        front = fronts[low]
+        if counts[low] == len(front):
+            front = np.concatenate((front, np.empty_like(front)))
+            fronts[low] = front
+        front[counts[low]] = costs[p]
+        counts[low] += 1
+    return ranks
+
+
+def costs(objectives: np.ndarray, maximise=MAXIMISE) -> np.ndarray:
+    """The objectives as costs to minimise: the maximised columns are negated."""
+    objectives = np.asarray(objectives, dtype=np.float64)
+    return np.ascontiguousarray(np.where(maximise, -objectives, objectives))
+
+
+def non_dominated_sort(objectives: np.ndarray, maximise=MAXIMISE) -> np.ndarray:
+    """The Pareto front of each solution (row of `objectives`), 0 for the non-dominated ones, 1 for those only
+    dominated by front 0, and so on (see `sort_fronts`)."""
+    objectives = costs(objectives, maximise)
+    order = np.lexsort(objectives.T[::-1])  # by the first column, then the next ones
+    return sort_fronts(objectives, order)
+
+
+def pareto_front(objectives: np.ndarray, maximise=MAXIMISE) -> np.ndarray:
+    """The indices of the non-dominated rows of `objectives`."""
+    return np.flatnonzero(non_dominated_sort(objectives, maximise) == 0)
+
+
+def scalarise(objectives: np.ndarray, weights, maximise=MAXIMISE) -> np.ndarray:
+    """The weighted sum of the objectives, each normalised to [0, 1] over the solutions (0 for the best), so that the
+    weights do not depend on the units; lower is better."""
+    objectives = costs(objectives, maximise)
+    lower, upper = objectives.min(axis=0), objectives.max(axis=0)
+    spread = np.where(upper > lower, upper - lower, 1.0)
+    weights = np.asarray(weights, dtype=np.float64)
+    return ((objectives - lower) / spread) @ (weights / weights.sum())
+
+
+def rank_trajectories(objectives: np.ndarray, weights=None, maximise=MAXIMISE) -> tuple:
+    """Rank trajectories by Pareto front, then by the weighted sum of their objectives within a front.
+
+    Args:
+        objectives: (n, m) array, e.g. from `trajectory_objectives`.
+        weights: (m,) weights of the objectives. Defaults to equal weights.
+        maximise: (m,) whether each objective is maximised. Defaults to those of `OBJECTIVES`.
+
+    Returns:
+        tuple: (order, fronts, scores), the indices of the trajectories from the best, and the front and the score of
+            each trajectory.
+    """
+    if len(objectives) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    fronts = non_dominated_sort(objectives, maximise)
+    scores = scalarise(objectives, np.ones(np.shape(objectives)[1]) if weights is None else weights, maximise)
+    return np.lexsort((scores, fronts)), fronts, scores
@@ -0,0 +1,94 @@
+import numpy as np
+
+
+def trajectory_lengths(entries: np.ndarray, targets: np.ndarray, spacing) -> np.ndarray:
+    """Physical length of every entry x target trajectory.
+
+    Args:
+        entries: (N, 3) array of entry points in numpy indices.
+        targets: (M, 3) array of target points in numpy indices.
+        spacing: The voxel spacing of the image (e.g. `itk_image.GetSpacing()`), in mm.
+
+    Returns:
+        (N, M) array of lengths in mm; row i, column j is the trajectory from entries[i] to targets[j].
+    """
+    difference = (targets[None, :, :] - entries[:, None, :]) * np.asarray(spacing, dtype=np.float64)
+    return np.linalg.norm(difference, axis=-1)
+
+
+def segments_hit_box(entries: np.ndarray, targets: np.ndarray, bounds: np.ndarray, margin: float = 1e-6) -> np.ndarray:
+    """Slab test of every entry x target segment against an axis-aligned bounding box.
+
+    A segment that misses the box cannot intersect with anything inside it. The box is grown by `margin` so that
+    segments touching its faces are kept (the test is conservative).
+
+    Args:
+        entries: (N, 3) array of entry points in numpy indices.
+        targets: (M, 3) array of target points in numpy indices.
+        bounds: (2, 3) array of the minimum and maximum corner of the box (e.g. `Mesh.bounds`).
+        margin: Distance by which the box is grown on every side, or (3,) distances along each axis. Defaults to 1e-6.
+
+    Returns:
+        (N, M) boolean array, True where the segment from entries[i] to targets[j] passes through the box.
+    """
+    lower = np.asarray(bounds[0], dtype=np.float64) - margin
+    upper = np.asarray(bounds[1], dtype=np.float64) + margin
+
+    origin = entries[:, None, :]  # (N, 1, 3)
+    direction = targets[None, :, :] - origin  # (N, M, 3)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1.0 / direction
+        t1 = (lower - origin) * inverse
+        t2 = (upper - origin) * inverse
+    t_near = np.minimum(t1, t2)
+    t_far = np.maximum(t1, t2)
+
+    # a segment parallel to a slab is either always inside it (no constraint) or never (miss)
+    parallel = direction == 0
+    inside = (origin >= lower) & (origin <= upper)
+    t_near = np.where(parallel, np.where(inside, -np.inf, np.inf), t_near)
+    t_far = np.where(parallel, np.where(inside, np.inf, -np.inf), t_far)
+
+    t_enter = np.maximum(t_near.max(axis=-1), 0.0)
+    t_exit = np.minimum(t_far.min(axis=-1), 1.0)
+    return t_enter <= t_exit
+
+
+def prefilter(entries, targets, spacing, target_mesh, critical_mesh, max_length: float = None, radius: float = 0.0) -> dict:
+    """Cheap analytic checks over all entry x target pairs, run before the triangle loops of `check_validity`.
+
+    - (b) a segment that misses the bounding box of the target structure cannot reach it and is invalid.
+    - (c) a trajectory longer than `max_length` is invalid.
+    - (a) a segment that misses the bounding box of the critical structures does not need to be tested against them.
+
+    Args:
+        entries: (N, 3) array of entry points in numpy indices.
+        targets: (M, 3) array of target points in numpy indices.
+        spacing: The voxel spacing of the image, in mm.
+        target_mesh: The `Mesh` of the target structure.
+        critical_mesh: The `Mesh` of the critical structures.
+        max_length: The maximum trajectory length in mm. Defaults to None (no length constraint).
+        radius: The radius of the electrode in mm; the bounding box of the critical structures is grown by it.
+            Defaults to 0.0.
+
+    Returns:
+        dict: (N, M) boolean arrays, in the order of `product(entries, targets)` once flattened:
+            - "candidate": False where the pair is already known to be invalid.
+            - "target_box": False where the segment misses the bounding box of the target structure.
+            - "test_critical": False where the pair cannot intersect with the critical structures.
+            - "length": the trajectory lengths in mm.
+    """
+    lengths = trajectory_lengths(entries, targets, spacing)
+
+    target_box = segments_hit_box(entries, targets, target_mesh.bounds)
+    candidate = target_box.copy()
+    if max_length is not None:
+        candidate &= lengths <= max_length
+
+    return {
+        "candidate": candidate,
+        "target_box": target_box,
+        "test_critical": segments_hit_box(entries, targets, critical_mesh.bounds, 1e-6 + radius / np.asarray(spacing, dtype=np.float64)),
+        "length": lengths,
+    }
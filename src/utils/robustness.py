@@ -0,0 +1,131 @@
+import numpy as np
+from src.modules.backends import IntersectionBackend
+from src.modules.distance_field import DistanceField
+from src.utils.exclusion import NOT_IN_TARGET, CRITICAL, CORTEX_ANGLE, TOO_LONG
+from src.utils.scheduler import run_chunked
+
+ERROR_MODELS = ("normal", "ball")
+
+# the evaluation of one perturbed segment
+SAMPLE_DTYPE = np.dtype([("reasons", np.uint8), ("clearance", np.float64)])
+
+
+def perturb(points: np.ndarray, n_samples: int, error: float, spacing, model: str = "normal", rng: np.random.Generator = None) -> np.ndarray:
+    """Random placements of points under an isotropic error model.
+
+    - "normal": the error along every axis is normally distributed with a standard deviation of `error` mm.
+    - "ball": the error is uniform inside a ball of radius `error` mm.
+
+    Args:
+        points: (k, 3) array of points in numpy indices.
+        n_samples: The number of placements of each point.
+        error: The size of the error in mm.
+        spacing: The voxel spacing of the image, in mm.
+        model: One of `ERROR_MODELS`. Defaults to "normal".
+        rng: The random generator. Defaults to a new unseeded one.
+
+    Returns:
+        (k, n_samples, 3) array of points in numpy indices.
+    """
+    rng = rng or np.random.default_rng()
+    shape = (len(points), n_samples, 3)
+    if model == "normal":
+        offsets = rng.normal(0.0, error, size=shape)
+    elif model == "ball":
+        directions = rng.normal(size=shape)
+        directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+        offsets = directions * error * np.cbrt(rng.random(shape[:2]))[..., None]
+    else:
+        raise ValueError(f"Unknown error model {model!r}, expected one of {ERROR_MODELS}")
+    return points[:, None, :] + offsets / np.asarray(spacing, dtype=np.float64)
+
+
+def segment_reasons(p1s, p2s, spacing, target: IntersectionBackend, critical: IntersectionBackend, cortex: IntersectionBackend, max_length: float = None, max_angle: float = 90 - 55, radius: float = 0.0) -> np.ndarray:
+    """The reason bits of each of the segments p1s[k] -> p2s[k], with the batch queries of the backends.
+
+    Unlike `pair_reasons`, the segments do not need to form an entries x targets grid (e.g. perturbed trajectories).
+    With radius > 0 the segments are capsules of `radius` mm for the critical structures.
+
+    Returns:
+        (n,) uint8 array of reason bits.
+    """
+    reasons = np.zeros(len(p1s), dtype=np.uint8)
+    reasons[~target.intersects_batch(p1s, p2s)] |= NOT_IN_TARGET
+    reasons[critical.capsule_batch(p1s, p2s, radius, spacing)] |= CRITICAL
+    reasons[cortex.angle_batch(p1s, p2s) > max_angle] |= CORTEX_ANGLE
+    if max_length is not None:
+        lengths = np.linalg.norm((p2s - p1s) * np.asarray(spacing, dtype=np.float64), axis=-1)
+        reasons[lengths > max_length] |= TOO_LONG
+    return reasons
+
+
+def robustness(
+    entries: np.ndarray,
+    targets: np.ndarray,
+    spacing,
+    target: IntersectionBackend,
+    critical: IntersectionBackend,
+    cortex: IntersectionBackend,
+    field: DistanceField,
+    executor,
+    workers: int,
+    n_samples: int = 1000,
+    entry_error: float = 1.0,
+    target_error: float = 1.0,
+    model: str = "normal",
+    min_clearance: float = 0.0,
+    max_length: float = None,
+    max_angle: float = 90 - 55,
+    radius: float = 0.0,
+    rng: np.random.Generator = None,
+) -> dict:
+    """Monte Carlo estimate of how safe trajectories stay under placement and registration errors.
+
+    The entry and the target of each trajectory are perturbed `n_samples` times (see `perturb`), and all the perturbed
+    segments go through the hard constraints and the clearance scoring together, in chunks run on the executor (the
+    kernels release the GIL, so a thread pool runs them in parallel). A perturbed segment is safe when it meets every
+    constraint and stays at least `min_clearance` mm from the critical structures.
+
+    Args:
+        entries: (k, 3) array of the entry points of the trajectories, in numpy indices.
+        targets: (k, 3) array of their target points, in numpy indices.
+        spacing: The voxel spacing of the image, in mm.
+        target, critical, cortex: The `IntersectionBackend` of the target structure, critical structures and cortex (or
+            the `NormalField` of the cortex).
+        field: The `DistanceField` of the critical structures.
+        executor: A `concurrent.futures` executor.
+        workers: The number of workers of the executor.
+        n_samples: The number of perturbations of each trajectory. Defaults to 1000.
+        entry_error: The error of the entry points in mm. Defaults to 1.0.
+        target_error: The error of the target points in mm. Defaults to 1.0.
+        model: The error model, one of `ERROR_MODELS`. Defaults to "normal".
+        min_clearance: The minimum distance to the critical structures in mm. Defaults to 0.0.
+        max_length: The maximum trajectory length in mm. Defaults to None (no length constraint).
+        max_angle: The maximum angle in degrees to the normal of the cortex. Defaults to 35.
+        radius: The radius of the electrode in mm. Defaults to 0.0 (a line).
+        rng: The random generator. Defaults to a new unseeded one.
+
+    Returns:
+        dict: (k,) arrays "safe_fraction", "valid_fraction" (the hard constraints only), "clearance" (of the
+            unperturbed trajectory) and "clearance_p05" (the 5th percentile over the perturbations), and the (k,
+            n_samples) uint8 array "reasons" of every perturbed segment.
+    """
+    rng = rng or np.random.default_rng()
+    p1s = perturb(entries, n_samples, entry_error, spacing, model, rng).reshape(-1, 3)
+    p2s = perturb(targets, n_samples, target_error, spacing, model, rng).reshape(-1, 3)
+
+    def evaluate(start, end):
+        samples = np.empty(end - start, dtype=SAMPLE_DTYPE)
+        samples["reasons"] = segment_reasons(p1s[start:end], p2s[start:end], spacing, target, critical, cortex, max_length, max_angle, radius)
+        samples["clearance"] = field.segment_clearance(p1s[start:end], p2s[start:end])
+        return samples
+
+    samples = run_chunked(evaluate, len(p1s), executor, workers, progress=False).reshape(len(entries), n_samples)
+    valid = samples["reasons"] == 0
+    return {
+        "safe_fraction": (valid & (samples["clearance"] >= min_clearance)).mean(axis=1),
+        "valid_fraction": valid.mean(axis=1),
+        "clearance": field.segment_clearance(entries, targets),
+        "clearance_p05": np.percentile(samples["clearance"], 5, axis=1),
+        "reasons": samples["reasons"],
+    }
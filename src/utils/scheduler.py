@@ -0,0 +1,77 @@
+import math
+from concurrent.futures import FIRST_COMPLETED, wait
+from time import perf_counter
+import numpy as np
+from tqdm import tqdm
+
+
+def timed_range(function, start: int, end: int):
+    """Call function(start, end) and also return the time it took, measured where it ran."""
+    begin = perf_counter()
+    result = function(start, end)
+    return result, perf_counter() - begin
+
+
+def run_chunked(
+    function,
+    n: int,
+    executor,
+    workers: int,
+    target_seconds: float = 0.1,
+    first_chunk: int = 64,
+    smoothing: float = 0.5,
+    progress: bool = True,
+) -> np.ndarray:
+    """Run function(start, end) over the index ranges of [0, n) on an executor, with chunks sized from the measured throughput.
+
+    Only the two ints of each range are sent to the workers, which read the data itself from what they share with this
+    process (e.g. module-level arrays inherited by forked workers). The first chunks have `first_chunk` items; then every
+    chunk aims to take `target_seconds`, from a moving average of the items per second measured in the workers, so
+    cheap items go in large chunks and expensive ones in small chunks. Near the end the chunks shrink (guided
+    scheduling: at most the remaining items / (2 * workers)) so that the last chunks finish at about the same time and no
+    worker sits idle while another one works through a large chunk.
+
+    Args:
+        function: A picklable function(start, end) returning an array of end - start results.
+        n: The number of items.
+        executor: A `concurrent.futures` executor (processes or threads).
+        workers: The number of workers of the executor; 2 * workers chunks are kept in flight.
+        target_seconds: The time a chunk should take. Defaults to 0.1.
+        first_chunk: The number of items of the first chunks, before any throughput is known. Defaults to 64.
+        smoothing: The weight of the latest chunk in the moving average of the throughput. Defaults to 0.5.
+        progress: Whether to show a progress bar, updated once per chunk. Defaults to True.
+
+    Returns:
+        np.ndarray: The results of all the items, in index order.
+    """
+    results = {}
+    in_flight = {}
+    rate = None  # items per second
+    next_start = 0
+    bar = tqdm(total=n, disable=not progress)
+
+    def submit():
+        nonlocal next_start
+        remaining = n - next_start
+        size = first_chunk if rate is None else int(rate * target_seconds)
+        size = max(1, min(size, math.ceil(remaining / (2 * workers)), remaining))
+        in_flight[executor.submit(timed_range, function, next_start, next_start + size)] = (next_start, next_start + size)
+        next_start += size
+
+    while next_start < n and len(in_flight) < 2 * workers:
+        submit()
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            start, end = in_flight.pop(future)
+            results[start], seconds = future.result()
+            measured = (end - start) / max(seconds, 1e-9)
+            rate = measured if rate is None else smoothing * measured + (1 - smoothing) * rate
+            bar.update(end - start)
+        while next_start < n and len(in_flight) < 2 * workers:
+            submit()
+    bar.close()
+
+    if not results:
+        return np.zeros(0)
+    return np.concatenate([results[i] for i in sorted(results)])
@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+
+
+class TaskGraph:
+    """
+    TaskGraph Class running functions on a thread pool, each one as soon as the results it depends on are ready.
+
+    A task is a function called with the results of its dependencies as positional arguments. Dependencies must be added
+    before the tasks that use them, so the graph cannot have cycles. Tasks can be added before or after `start`, e.g. to
+    start more work on results that are not ready yet. If a task raises, the tasks depending on it raise the same error.
+
+    Attributes:
+        - times (dict): name: (start, end) of each finished task, in seconds since `start`.
+
+    Methods:
+        - add: Add a task.
+        - start: Start running the tasks whose dependencies are ready, in the background.
+        - result: Wait for a task and return its result.
+        - shutdown: Wait for the running tasks and stop the threads.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self.tasks = {}  # name: (function, dependencies)
+        self.futures = {}  # name: Future, set when the task finishes
+        self.times = {}
+        self._submitted = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._start = None
+
+    def __contains__(self, name: str):
+        return name in self.tasks
+
+    def add(self, name: str, function, *dependencies: str):
+        with self._lock:
+            if name in self.tasks:
+                raise ValueError(f"Task {name!r} already exists")
+            missing = [i for i in dependencies if i not in self.tasks]
+            if missing:
+                raise ValueError(f"Task {name!r} depends on tasks that do not exist: {missing}")
+            self.tasks[name] = (function, dependencies)
+            self.futures[name] = Future()
+        self._submit_ready()
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(self.max_workers)
+        self._start = perf_counter()
+        self._submit_ready()
+        return self
+
+    def result(self, name: str, timeout: float = None):
+        return self.futures[name].result(timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _submit_ready(self):
+        if self._executor is None:
+            return
+        with self._lock:
+            ready = [
+                name
+                for name, (_, dependencies) in self.tasks.items()
+                if name not in self._submitted and all(self.futures[i].done() for i in dependencies)
+            ]
+            self._submitted.update(ready)
+        for name in ready:
+            self._executor.submit(self._run, name)
+
+    def _run(self, name: str):
+        function, dependencies = self.tasks[name]
+        start = perf_counter()
+        result, error = None, None
+        try:
+            result = function(*[self.futures[i].result() for i in dependencies])
+        except BaseException as exception:
+            error = exception
+        self.times[name] = (start - self._start, perf_counter() - self._start)
+        if error is None:
+            self.futures[name].set_result(result)
+        else:
+            self.futures[name].set_exception(error)
+        self._submit_ready()
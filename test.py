@@ -3,9 +3,45 @@ This file contains unit tests for the mesh functions for intersection checking a
 """
 
 import unittest
+import tempfile
+from pathlib import Path
 import numpy as np
 from src.utils.marching_cubes import check_angle_of_intersection, check_distance_intersection
-import numpy as np
+from src.utils.marching_cubes import check_intersect, check_intersect_mesh, check_angle_of_intersection_mesh, warm_up
+from src.utils.marching_cubes import intersected_component
+from src.utils.marching_cubes import segment_components_intersect, segment_mesh_angle
+from src.utils.marching_cubes import marching_cubes, marching_cubes_cropped, marching_cubes_bricked, mesh_structure, segment_mesh_distance
+from src.modules.mesh import Mesh
+from src.modules.backends import BACKENDS, make_backend
+from src.modules.volumes import VolumeStore, crop_mask, union_masks
+from src.modules.bricks import brick_occupancy, read_region
+from src.modules.incremental import IncrementalSurface
+from src.modules.sweep import SweepBackend, sweep_hull, cull_mesh
+from src.modules.bvh import BVH
+from src.utils.prefilter import trajectory_lengths, segments_hit_box, prefilter
+from src.utils.linear import point_to_numpy_idx, points_to_numpy_idx
+from src.modules.planner import Planner
+from src.utils.task_graph import TaskGraph
+from src.utils.scheduler import run_chunked
+from src.utils.candidates import PairGrid, sample_surface, sample_mask, surface_area
+from src.modules.distance_field import DistanceField
+from src.modules.normal_field import NormalField
+from src.utils.robustness import perturb, segment_reasons, robustness
+from src.utils.pareto import non_dominated_sort, rank_trajectories, trajectory_objectives
+from src.utils.oracle import APPROXIMATE_ENGINES, ENGINES, SEGMENT_KINDS, run_campaign, reference_answers, near_boundary, shrink
+from concurrent.futures import ThreadPoolExecutor
+import SimpleITK as sitk
+from src.utils.exclusion import NOT_IN_TARGET, CRITICAL, CORTEX_ANGLE, TOO_LONG, prefilter_reasons, combination_counts, reason_sets
+from src.utils.exclusion import constraint_reasons, update_reasons, save_reasons, load_reasons
+
+
+def box_mesh(lower, upper):
+    """The closed triangle surface of an axis-aligned box"""
+    verts = np.array([[x, y, z] for x in (lower[0], upper[0]) for y in (lower[1], upper[1]) for z in (lower[2], upper[2])], dtype=np.float64)
+    faces = np.array(
+        [[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1], [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]]
+    )
+    return Mesh(verts, faces)
 
 
 class Test(unittest.TestCase):
@@ -42,6 +78,635 @@ class Test(unittest.TestCase):
         expected_distance = 0
         self.assertAlmostEqual(check_distance_intersection(p1, p2, verts, faces), expected_distance, delta=1e-10)
 
+    def test_mesh_layout(self):
+        """
+        Test that the Mesh stores compact arrays and the per-triangle data in structure-of-arrays layout
+        """
+        verts = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+        faces = np.array([[0, 1, 2], [0, 1, 3]])
+        mesh = Mesh(verts, faces)
+        self.assertEqual(mesh.verts.dtype, np.float32)
+        self.assertEqual(mesh.faces.dtype, np.int32)
+        self.assertEqual(mesh.edge1.shape, (3, 2))
+        self.assertTrue(mesh.edge2.flags["C_CONTIGUOUS"])
+        np.testing.assert_array_equal(mesh.normal[:, 0], [0, 0, 1])
+        np.testing.assert_array_equal(mesh["faces"], faces)
+
+    def test_mesh_kernels(self):
+        """
+        Test that the Mesh kernels give the same answers as check_intersect and check_angle_of_intersection
+        """
+        verts = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=np.float64)
+        faces = np.array([[0, 1, 2]])
+        mesh = Mesh(verts, faces)
+        lines = [
+            ([0.2, 0.2, -1], [0.2, 0.2, 1]),  # crosses
+            ([0.2, 0.2, -1], [0.3, 0.1, 2]),  # crosses at an angle
+            ([0.2, 0.2, 1], [0.2, 0.2, 2]),  # stops before the surface
+            ([2, 2, -1], [2, 2, 1]),  # misses
+        ]
+        for p1, p2 in lines:
+            p1, p2 = np.array(p1, dtype=np.float64), np.array(p2, dtype=np.float64)
+            self.assertEqual(check_intersect_mesh(p1, p2, mesh), check_intersect(p1, p2, verts, faces))
+            self.assertAlmostEqual(
+                check_angle_of_intersection_mesh(p1, p2, mesh), check_angle_of_intersection(p1, p2, verts, faces), delta=1e-10
+            )
+
+    def test_warm_up(self):
+        """
+        Test that the warm-up compiles the Mesh kernels and reports the time taken
+        """
+        self.assertGreaterEqual(warm_up(), 0)
+        self.assertTrue(segment_components_intersect.signatures)
+        self.assertTrue(segment_mesh_angle.signatures)
+
+    def test_trajectory_lengths(self):
+        """
+        Test that the trajectory lengths are scaled by the spacing
+        """
+        entries = np.array([[0, 0, 0], [1, 1, 1]], dtype=np.float64)
+        targets = np.array([[3, 4, 0]], dtype=np.float64)
+        lengths = trajectory_lengths(entries, targets, spacing=(2.0, 2.0, 2.0))
+        np.testing.assert_allclose(lengths, [[10.0], [2 * np.sqrt(4 + 9 + 1)]])
+
+    def test_segments_hit_box(self):
+        """
+        Test the slab test against a unit box, including segments parallel to its faces and stopping short of it
+        """
+        bounds = np.array([[0, 0, 0], [1, 1, 1]], dtype=np.float64)
+        entries = np.array([[-1, 0.5, 0.5], [-1, 3, 0.5]], dtype=np.float64)
+        targets = np.array([[2, 0.5, 0.5], [-0.5, 0.5, 0.5], [0.5, 0.5, 0.5], [2, -1, 0.5]], dtype=np.float64)
+        expected = [[True, False, True, True], [False, False, True, True]]
+        np.testing.assert_array_equal(segments_hit_box(entries, targets, bounds), expected)
+
+    def test_exclusion_reasons(self):
+        """
+        Test the reason bits decided by the prefilter, the statistics computed from the bits and their saved file
+        """
+        prefilter_masks = {"target_box": np.array([[True, False], [True, True]]), "length": np.array([[10.0, 90.0], [50.0, 70.0]])}
+        reasons = prefilter_reasons(prefilter_masks, max_length=60)
+        np.testing.assert_array_equal(reasons, [[0, NOT_IN_TARGET | TOO_LONG], [0, TOO_LONG]])
+
+        reasons[1, 0] |= CRITICAL | CORTEX_ANGLE
+        counts = combination_counts(reasons)
+        self.assertEqual(counts[()], 1)
+        self.assertEqual(counts[("not intersect with hippo campus", "too long")], 1)
+        self.assertEqual(counts[("too shear cortex", "in vessels or ventricles")], 1)
+        self.assertEqual(reason_sets(reasons)["too long"], {1, 3})
+
+        # the saved reasons are only read back for the same entries and targets
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory, "reasons.npz")
+            self.assertIsNone(load_reasons(path, ["e1", "e2"], ["t1", "t2"]))
+            save_reasons(path, reasons, np.array(["e1", "e2"], dtype=object), ["t1", "t2"])
+            np.testing.assert_array_equal(load_reasons(path, ["e1", "e2"], ["t1", "t2"]), reasons)
+            self.assertIsNone(load_reasons(path, ["e1", "e3"], ["t1", "t2"]))
+
+    def test_mesh_components(self):
+        """
+        Test that disconnected parts of a mesh become separate components and that the hit component is reported
+        """
+        verts = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [5, 5, 5], [6, 5, 5], [5, 6, 5], [0, 0, 1]], dtype=np.float64)
+        faces = np.array([[3, 4, 5], [0, 1, 2], [0, 1, 6]])
+        mesh = Mesh(verts, faces, split_components=True)
+        self.assertEqual(len(mesh.component_ranges), 2)
+        hit = intersected_component(np.array([5.2, 5.2, 4.0]), np.array([5.2, 5.2, 6.0]), mesh)
+        np.testing.assert_array_equal(mesh.component_bounds[hit], [[5, 5, 5], [6, 6, 5]])
+        self.assertEqual(intersected_component(np.array([2.0, 2.0, -1.0]), np.array([2.0, 2.0, 1.0]), mesh), -1)
+
+    def test_backends(self):
+        """
+        Test that every intersection backend for planning gives the answers of the numba kernels on a closed surface (a
+        cube), and that vtkOBBTree, which does not, cannot be selected
+        """
+        verts = np.array([[x, y, z] for x in (0, 2) for y in (0, 2) for z in (0, 2)], dtype=np.float64)
+        faces = np.array(
+            [[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1], [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]]
+        )
+        mesh = Mesh(verts, faces)
+        lines = [([1.1, 0.7, 1.3], [3.0, 1.2, 2.5]), ([-1, 0.5, 0.5], [3, 1.5, 1.5]), ([-1, -1, -1], [-0.5, 3, 3]), ([0.5, 0.5, 0.5], [1.5, 1.5, 1.5])]
+        reference = make_backend("numba", mesh)
+        for name in BACKENDS:
+            backend = make_backend(name, mesh)
+            for p1, p2 in lines:
+                p1, p2 = np.array(p1, dtype=np.float64), np.array(p2, dtype=np.float64)
+                self.assertEqual(backend.intersects(p1, p2), reference.intersects(p1, p2), name)
+                self.assertAlmostEqual(backend.angle(p1, p2), reference.angle(p1, p2), delta=1e-6, msg=name)
+        self.assertNotIn("vtk_obbtree", BACKENDS)
+        with self.assertRaises(ValueError):
+            make_backend("vtk_obbtree", mesh)
+
+    def test_packet_queries(self):
+        """
+        Test that the packet queries of the BVH give the answers of the single segment queries, with several packets
+        """
+        grid = np.indices((16, 16, 16)).transpose(1, 2, 3, 0)
+        ball = (np.linalg.norm(grid - 7.5, axis=-1) < 6).astype(np.uint8)
+        verts, faces, _, _ = marching_cubes(ball, 0.5)
+        backend = make_backend("bvh", Mesh(verts, faces))
+        rng = np.random.default_rng(0)
+        p1 = np.array([-4.0, 7.2, 7.9])
+        p2s = rng.uniform(2, 13, size=(100, 3))
+        intersects = [backend.intersects(p1, p2) for p2 in p2s]
+        angles = [backend.angle(p1, p2) for p2 in p2s]
+        for packet_size in (1, 7, 128):
+            np.testing.assert_array_equal(backend.bvh.intersects_packet(p1, p2s, packet_size), intersects)
+            np.testing.assert_allclose(backend.bvh.angle_packet(p1, p2s, packet_size), angles)
+        self.assertEqual(backend.intersects_packet(p1, p2s[:0]).shape, (0,))
+
+    def test_points_to_numpy_idx(self):
+        """
+        Test that the vectorized conversion to numpy indices matches the conversion of one point at a time
+        """
+        image = sitk.Image(20, 30, 40, sitk.sitkUInt8)
+        image.SetOrigin((-10.0, 5.0, 2.5))
+        image.SetSpacing((0.5, 1.0, 2.0))
+        image.SetDirection((0, 1, 0, -1, 0, 0, 0, 0, 1))
+        points = np.random.default_rng(0).uniform(-20, 20, size=(50, 3))
+        expected = [point_to_numpy_idx(i, image) for i in points]
+        np.testing.assert_allclose(points_to_numpy_idx(points, image), expected)
+
+    def test_planner(self):
+        """
+        Test the answers of the planner to each kind of request, on boxes in an image whose world coordinates are the
+        numpy indices, and the edits of its critical structures
+        """
+        planner = Planner(
+            make_backend("bvh", box_mesh([2, 2, 2], [4, 4, 4])),  # target
+            make_backend("bvh", box_mesh([7, 2, 6], [9, 4, 8])),  # critical
+            make_backend("bvh", box_mesh([1, 1, 1], [12, 12, 12])),  # cortex
+            sitk.Image(20, 20, 20, sitk.sitkUInt8),
+            targets=[[3, 3, 3], [3.5, 3.5, 3.5], [10, 10, 10]],
+            target_ids=["a", "b", "c"],
+        )
+        valid, critical, shear = [15, 3, 3], [15, 3, 10.5], [13, 3, 16]
+        self.assertEqual(planner.evaluate(valid, [3, 3, 3]), {"valid": True, "reasons": [], "length_mm": 12.0, "cortex_angle": 0.0})
+        self.assertEqual(planner.evaluate(critical, [3, 3, 3])["reasons"], ["in vessels or ventricles"])
+        self.assertEqual(planner.evaluate(shear, [3, 3, 3])["reasons"], ["too shear cortex"])
+
+        best = planner.best_target(valid)
+        self.assertEqual((best["target_id"], best["n_valid"]), ("b", 2))
+
+        rescored = planner.rescore([(critical, [3, 3, 3]), (valid, [3, 3, 3]), (valid, [3.5, 3.5, 3.5])], k=1)
+        self.assertEqual([i["rank"] for i in rescored], [2])
+
+        response = planner.handle({"id": 7, "op": "evaluate", "entry": valid, "target": [10, 10, 10]})
+        self.assertEqual((response["ok"], response["id"], response["result"]["reasons"]), (True, 7, ["not intersect with hippo campus", "too shear cortex"]))
+        self.assertFalse(planner.handle({"op": "evaluate", "entry": valid})["ok"])
+        self.assertFalse(planner.handle({"op": "unknown"})["ok"])
+        # fewer ids than targets
+        response = planner.handle({"op": "best_target", "entry": valid, "targets": [[3, 3, 3], [3.5, 3.5, 3.5]], "target_ids": ["a"]})
+        self.assertEqual((response["ok"], response["error"].split(":")[0]), (False, "IndexError"))
+        self.assertEqual(planner.handle({"op": "stats"})["result"]["evaluate"]["count"], 2)
+        self.assertFalse(planner.handle({"op": "edit", "lower": [0, 0, 0], "values": [[[1]]]})["ok"])
+
+        # critical structures drawn while the planner runs, into the mask of its incremental surface
+        surface = IncrementalSurface(crop_mask(np.zeros((20, 20, 20), dtype=np.uint8)), brick=4)
+        editable = Planner(planner.target, surface.backend, planner.cortex, planner.reference_image, surface=surface)
+        self.assertTrue(editable.evaluate(valid, [3, 3, 3])["valid"])
+        response = editable.handle({"op": "edit", "lower": [10, 2, 2], "values": np.ones((2, 3, 3), dtype=int).tolist()})
+        self.assertTrue(response["ok"])
+        self.assertEqual(editable.evaluate(valid, [3, 3, 3])["reasons"], ["in vessels or ventricles"])
+        self.assertFalse(editable.handle({"op": "edit", "lower": [-5, 10, 10], "values": [[[1]]]})["ok"])
+        self.assertFalse(editable.handle({"op": "edit", "lower": [500, 500, 500], "values": [[[1]]]})["ok"])
+
+    def test_task_graph(self):
+        """
+        Test that the tasks get the results of their dependencies, also when added after the start, and that errors
+        reach the tasks depending on the failed one
+        """
+        graph = TaskGraph(max_workers=2)
+        graph.add("a", lambda: 2)
+        graph.add("b", lambda a: a * 3, "a")
+        graph.start()
+        graph.add("c", lambda a, b: a + b, "a", "b")
+        graph.add("error", lambda b: 1 / 0, "b")
+        graph.add("after error", lambda error: error, "error")
+        self.assertEqual(graph.result("c"), 8)
+        with self.assertRaises(ZeroDivisionError):
+            graph.result("after error")
+        with self.assertRaises(ValueError):
+            graph.add("d", lambda missing: missing, "missing")
+        graph.shutdown()
+        self.assertLessEqual(graph.times["a"][1], graph.times["b"][0])
+
+    def test_run_chunked(self):
+        """
+        Test that the chunked scheduler covers every index once, in order, with chunks shrinking towards the end
+        """
+        ranges = []
+
+        def function(start, end):
+            ranges.append((start, end))
+            return np.arange(start, end)
+
+        with ThreadPoolExecutor(2) as executor:
+            np.testing.assert_array_equal(run_chunked(function, 1000, executor, 2, first_chunk=100, progress=False), np.arange(1000))
+            self.assertEqual(len(run_chunked(function, 0, executor, 2, progress=False)), 0)
+        sizes = [end - start for start, end in sorted(ranges)]
+        self.assertEqual(sum(sizes), 1000)
+        self.assertLess(sizes[-1], sizes[0])
+
+    def test_candidates(self):
+        """
+        Test that the implicit pairs follow the order of product(entries, targets), that the sampled entries lie on
+        the surface (or off it, where their segments cross it) and the sampled targets inside the mask
+        """
+        from itertools import product
+
+        entries, targets = np.arange(12.0).reshape(4, 3), -np.arange(9.0).reshape(3, 3)
+        pairs = PairGrid(entries, targets)
+        expected = list(product(entries, targets))
+        self.assertEqual(len(pairs), len(expected))
+        np.testing.assert_array_equal(np.array(pairs[:]), np.array(expected))
+        np.testing.assert_array_equal(np.array(pairs[-1]), np.array(expected[-1]))
+        entry_idx, target_idx = pairs.indices(2, 10)
+        self.assertEqual(entry_idx.dtype, np.int32)
+        np.testing.assert_array_equal(entries[entry_idx], np.array(expected[2:10])[:, 0])
+        np.testing.assert_array_equal(targets[target_idx], np.array(expected[2:10])[:, 1])
+        self.assertEqual([(start, end) for start, end, _, _ in pairs.blocks(5)], [(0, 5), (5, 10), (10, 12)])
+
+        rng = np.random.default_rng(0)
+        mesh = box_mesh((1, 2, 3), (3, 4, 5))
+        self.assertAlmostEqual(surface_area(mesh, (1, 1, 1)), 24)
+        self.assertAlmostEqual(surface_area(mesh, (2, 1, 1)), 40)
+        points = sample_surface(mesh, 1000, rng)
+        on_face = np.isclose(points, (1, 2, 3)) | np.isclose(points, (3, 4, 5))
+        self.assertTrue(on_face.any(axis=1).all())
+        self.assertTrue(((points >= (1, 2, 3)) & (points <= (3, 4, 5))).all())
+
+        volume = np.zeros((10, 12, 14), dtype=np.uint8)
+        volume[2:5, 3:7, 5:9] = 1
+        points = sample_mask(crop_mask(volume), 1000, rng)
+        self.assertTrue(volume[tuple(np.round(points).astype(int).T)].all())
+
+        # entries moved off a ball: their segments cross its surface at the angle they would have from further out
+        ball = (np.square(np.indices((24, 24, 24)) - 11.5).sum(axis=0) < 64).astype(np.uint8)
+        verts, faces, _, _ = marching_cubes_cropped(crop_mask(ball), 0.5)
+        sphere = Mesh(verts, faces)
+        backend = make_backend("numba", sphere)
+        target = np.array([13.0, 11.5, 11.5])
+        self.assertTrue((backend.angle_batch(sample_surface(sphere, 200, rng), np.tile(target, (200, 1))) == 0).any())
+        entries = sample_surface(sphere, 200, rng, offset=1.0, mask=crop_mask(ball))
+        self.assertFalse(ball[tuple(np.round(entries).astype(int).T)].any())
+        direction = (entries - target) / np.linalg.norm(entries - target, axis=1)[:, None]
+        angles = backend.angle_batch(entries, np.tile(target, (200, 1)))
+        self.assertTrue((angles > 0).all())
+        np.testing.assert_allclose(angles, backend.angle_batch(entries + 2 * direction, np.tile(target, (200, 1))), atol=1e-6)
+
+    def test_robustness(self):
+        """
+        Test the distance field against the distances to the voxels of the mask, the batch queries against the single
+        ones, and that trajectories stay valid without errors and are perturbed within the error radius
+        """
+        volume = np.zeros((12, 12, 12), dtype=np.uint8)
+        volume[7:9, 2:5, 6:9] = 1
+        spacing = (1.0, 2.0, 0.5)
+        field = DistanceField(crop_mask(volume), spacing, max_distance=4.0)
+        voxels = np.argwhere(volume) * spacing
+        points = np.argwhere(np.ones_like(volume)).astype(np.float64)
+        expected = np.minimum(np.linalg.norm(points[:, None] * spacing - voxels[None], axis=-1).min(axis=1), 4.0)
+        np.testing.assert_allclose(field.sample(points), expected, rtol=1e-6)
+        np.testing.assert_allclose(field.segment_clearance([[0, 3, 7], [0, 11, 0]], [[11, 3, 7], [11, 11, 0]]), [0.0, 4.0])
+
+        target, critical, cortex = (
+            make_backend("bvh", box_mesh([2, 2, 2], [4, 4, 4])),
+            make_backend("bvh", box_mesh([7, 2, 6], [9, 4, 8])),
+            make_backend("bvh", box_mesh([1, 1, 1], [12, 12, 12])),
+        )
+        rng = np.random.default_rng(0)
+        p1s, p2s = rng.uniform(0, 16, size=(200, 3)), rng.uniform(1, 5, size=(200, 3))
+        for backend in (target, critical, cortex):
+            np.testing.assert_array_equal(backend.intersects_batch(p1s, p2s), [backend.intersects(i, j) for i, j in zip(p1s, p2s)])
+            np.testing.assert_allclose(backend.angle_batch(p1s, p2s), [backend.angle(i, j) for i, j in zip(p1s, p2s)])
+            self.assertEqual(len(make_backend("numba", backend.mesh).intersects_batch(p1s[:0], p2s[:0])), 0)
+
+        entries, targets = np.array([[15.0, 3, 3], [15, 3, 10.5]]), np.array([[3.0, 3, 3], [3, 3, 3]])
+        np.testing.assert_array_equal(segment_reasons(entries, targets, (1, 1, 1), target, critical, cortex), [0, CRITICAL])
+        with ThreadPoolExecutor(2) as executor:
+            result = robustness(entries, targets, (1, 1, 1), target, critical, cortex, field, executor, 2, n_samples=50, entry_error=0, target_error=0)
+            np.testing.assert_array_equal(result["valid_fraction"], [1, 0])
+            result = robustness(entries, targets, (1, 1, 1), target, critical, cortex, field, executor, 2, n_samples=50, min_clearance=5.0)
+            np.testing.assert_array_equal(result["safe_fraction"], [0, 0])  # the field is clipped at 4 mm
+        jittered = perturb(entries, 1000, 2.0, spacing, "ball", rng)
+        self.assertEqual(jittered.shape, (2, 1000, 3))
+        self.assertLessEqual(np.linalg.norm((jittered - entries[:, None]) * spacing, axis=-1).max(), 2.0 + 1e-9)
+
+    def test_capsule(self):
+        """
+        Test the segment to mesh distance against densely sampled points, and that the capsule queries of the BVH and
+        the prefilter with a radius agree with the brute force distance
+        """
+        mesh = box_mesh([2, 2, 2], [4, 5, 6])
+        spacing = np.array([1.0, 0.5, 2.0])
+        rng = np.random.default_rng(0)
+        t = np.linspace(0, 1, 201)
+        uv = np.array([(u, v) for u in t[::4] for v in t[::4] if u + v <= 1])
+        surface = np.concatenate([mesh.v0[:, i] + np.outer(uv[:, 0], mesh.edge1[:, i]) + np.outer(uv[:, 1], mesh.edge2[:, i]) for i in range(len(mesh))])
+        for p1, p2 in rng.uniform(-2, 8, size=(20, 2, 3)):
+            points = p1 + np.outer(t, p2 - p1)
+            sampled = np.sqrt((((points[:, None] - surface[None]) * spacing) ** 2).sum(axis=-1).min())
+            distance = segment_mesh_distance(p1, p2, mesh.v0, mesh.edge1, mesh.edge2, spacing)
+            self.assertLessEqual(distance, sampled + 1e-9)
+            self.assertAlmostEqual(distance, sampled, delta=0.15)
+        self.assertEqual(segment_mesh_distance(np.array([0.0, 3, 3]), np.array([9.0, 3, 3]), mesh.v0, mesh.edge1, mesh.edge2, spacing), 0.0)
+
+        backend, brute = make_backend("bvh", mesh), make_backend("numba", mesh)
+        p1 = np.array([-1.0, 3.5, 4.0])
+        p2s = rng.uniform(-3, 9, size=(300, 3))
+        np.testing.assert_array_equal(backend.capsule_packet(p1, p2s, 0.0, spacing), backend.intersects_packet(p1, p2s))
+        for radius in (0.3, 1.0, 3.0):
+            expected = brute.capsule_packet(p1, p2s, radius, spacing)
+            np.testing.assert_array_equal(backend.capsule_packet(p1, p2s, radius, spacing), expected)
+            np.testing.assert_array_equal(backend.capsule_batch(np.broadcast_to(p1, p2s.shape), p2s, radius, spacing), expected)
+            tested = prefilter(p1[None], p2s, spacing, mesh, mesh, radius=radius)["test_critical"][0]
+            self.assertFalse((expected & ~tested).any())
+        self.assertGreater(backend.capsule_packet(p1, p2s, 3.0, spacing).sum(), backend.capsule_packet(p1, p2s, 0.3, spacing).sum())
+
+    def test_cropped_masks(self):
+        """
+        Test that masks are cropped to their bounding box and that the union of cropped masks matches the full arrays
+        """
+        a = np.zeros((6, 7, 8), dtype=np.uint8)
+        b = np.zeros((6, 7, 8), dtype=np.uint8)
+        a[1:3, 2:4, 3:5] = 1
+        b[4, 5, 6] = 1
+        cropped_a, cropped_b = crop_mask(a), crop_mask(b)
+        self.assertEqual(cropped_a.offset, (1, 2, 3))
+        self.assertEqual(cropped_a.array.shape, (2, 2, 2))
+        np.testing.assert_array_equal(cropped_a.full(), a)
+        np.testing.assert_array_equal(union_masks(cropped_a, cropped_b).full(), np.logical_or(a, b))
+
+    def test_volume_store_cache(self):
+        """
+        Test that a mask read from the memory-mapped cache equals the freshly decoded one
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            decoded = VolumeStore(Path("week-2", "practicals", "TestSet"), cache_dir).mask("r_hippoTest.nii.gz")
+            cached = VolumeStore(Path("week-2", "practicals", "TestSet"), cache_dir).mask("r_hippoTest.nii.gz")
+            self.assertIsInstance(cached.array, np.memmap)
+            self.assertEqual(cached.offset, decoded.offset)
+            np.testing.assert_array_equal(cached.full(), decoded.full())
+
+    def test_marching_cubes_cropped(self):
+        """
+        Test that meshing a cropped mask gives the same surface as meshing the full volume, also when the mask touches
+        the edge of the volume, and that the mesh of a structure is split into its connected components
+        """
+        volume = np.zeros((10, 12, 14), dtype=np.uint8)
+        volume[0:4, 3:7, 5:9] = 1  # touches the edge
+        volume[6:9, 8:11, 10:13] = 1
+        verts, faces, _, _ = marching_cubes(volume, 0.5)
+        cropped_verts, cropped_faces, _, _ = marching_cubes_cropped(crop_mask(volume), 0.5)
+        np.testing.assert_array_equal(cropped_verts, verts)
+        np.testing.assert_array_equal(cropped_faces, faces)
+
+        name, mesh = mesh_structure("a", crop_mask(volume), split_components=True)
+        self.assertEqual((name, len(mesh.component_ranges)), ("a", 2))
+        np.testing.assert_array_equal(mesh.bounds, [verts.min(axis=0), verts.max(axis=0)])
+
+    def test_bricked_volumes(self):
+        """
+        Test that the bricked volume layer gives the same results as the in-memory one: the streamed masks, their union,
+        the triangles of marching cubes (seams included) and the distance field
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            decoded = VolumeStore(Path("week-2", "practicals", "TestSet"), Path(cache_dir, "a")).mask("ventriclesTest.nii.gz")
+            streamed = VolumeStore(Path("week-2", "practicals", "TestSet"), Path(cache_dir, "b"), memory_budget=4096).mask("ventriclesTest.nii.gz")
+            self.assertIsInstance(streamed.array, np.memmap)
+            self.assertEqual(streamed.offset, decoded.offset)
+            np.testing.assert_array_equal(streamed.full(), decoded.full())
+
+            rng = np.random.default_rng(0)
+            volume = (rng.random((14, 15, 16)) < 0.3).astype(np.uint8)
+            volume[:, :, :3] = 0
+            a, b = crop_mask(volume * (rng.random(volume.shape) < 0.5)), crop_mask(volume)
+            union = union_masks(a, b, path=Path(cache_dir, "union.npy"), memory_budget=500)
+            self.assertIsInstance(union.array, np.memmap)
+            np.testing.assert_array_equal(union.full(), union_masks(a, b).full())
+
+        occupancy = brick_occupancy(b.array, 4)
+        for index in np.ndindex(occupancy.shape):
+            self.assertEqual(occupancy[index], b.array[tuple(slice(4 * i, 4 * i + 4) for i in index)].any())
+        verts, faces, _, _ = marching_cubes_cropped(b, 0.5)
+        bricked_verts, bricked_faces = marching_cubes_bricked(b, 0.5, memory_budget=24 * 6**3)  # bricks of 4 cubes
+
+        def triangles(verts, faces):  # the oriented triangles, from their smallest vertex
+            triangles = [[tuple(i) for i in triangle] for triangle in verts[faces].tolist()]
+            return sorted(tuple(i[i.index(min(i)) :] + i[: i.index(min(i))]) for i in triangles)
+
+        self.assertEqual(len(bricked_verts), len(verts))
+        self.assertEqual(triangles(bricked_verts, bricked_faces), triangles(verts, faces))
+
+        spacing = (1.0, 2.0, 0.5)
+        field = DistanceField(b, spacing, max_distance=4.0)
+        bricked = DistanceField(b, spacing, max_distance=4.0, memory_budget=200_000)  # bricks of 2 voxels
+        np.testing.assert_array_equal(bricked.offset, field.offset)
+        np.testing.assert_array_equal(bricked.array, field.array)
+
+    def test_incremental_surface(self):
+        """
+        Test that after local edits the spliced mesh is the one meshed from scratch, that the refit BVH answers like a
+        new one, that evaluating only the pairs through the dirty regions gives the reasons of a full evaluation, and
+        that undoing the edits gives back the reasons from before them
+        """
+        rng = np.random.default_rng(1)
+        volume = np.zeros((20, 22, 24), dtype=np.uint8)
+        volume[3:17, 4:18, 5:20] = rng.random((14, 14, 15)) < 0.6
+        initial = crop_mask(volume)
+        surface = IncrementalSurface(initial, brick=4)
+        before = initial.array.copy()
+        # the same edits, written into a memory-mapped copy of the mask
+        bricked = IncrementalSurface(crop_mask(volume), brick=4, memory_budget=2048)
+        entries, targets = rng.random((40, 3)) * volume.shape, rng.random((30, 3)) * volume.shape
+        reasons = constraint_reasons(CRITICAL, surface.backend, entries, targets, np.ones((40, 30), dtype=bool))
+        initial_volume, initial_reasons = volume.copy(), reasons.copy()
+
+        # a block flipped and saved as a new mask, then two slices written directly
+        for lower, upper, whole_mask in [((8, 9, 1), (11, 12, 6), True), ((0, 0, 0), (2, 22, 24), False)]:
+            edit = tuple(slice(l, u) for l, u in zip(lower, upper))
+            volume[edit] = 1 - volume[edit]
+            boxes = surface.update(crop_mask(volume)) if whole_mask else surface.edit(lower, volume[edit])
+            bricked.update(crop_mask(volume)) if whole_mask else bricked.edit(lower, volume[edit])
+            verts, faces = marching_cubes_bricked(crop_mask(volume), 0.5)
+            np.testing.assert_array_equal(surface.mesh.verts, verts)
+            np.testing.assert_array_equal(surface.mesh.faces, faces)
+            np.testing.assert_array_equal(bricked.mesh.faces, faces)
+            np.testing.assert_array_equal(read_region(surface.mask, (0, 0, 0), volume.shape), volume)
+
+            bvh = BVH(Mesh(verts, faces))
+            p1s, p2s = rng.random((2000, 3)) * volume.shape, rng.random((2000, 3)) * volume.shape
+            np.testing.assert_array_equal(surface.bvh.intersects_batch(p1s, p2s), bvh.intersects_batch(p1s, p2s))
+            np.testing.assert_array_equal(surface.bvh.angle_batch(p1s, p2s), bvh.angle_batch(p1s, p2s))
+            np.testing.assert_array_equal(surface.bvh.intersects_batch(p1s, p2s, 0.7, (1, 2, 0.5)), bvh.intersects_batch(p1s, p2s, 0.7, (1, 2, 0.5)))
+
+            affected = update_reasons(reasons, CRITICAL, surface.backend, entries, targets, boxes)
+            self.assertLess(np.count_nonzero(affected), affected.size)
+            np.testing.assert_array_equal(reasons, constraint_reasons(CRITICAL, surface.backend, entries, targets, np.ones((40, 30), dtype=bool)))
+        self.assertNotEqual(np.count_nonzero(reasons != initial_reasons), 0)
+        update_reasons(reasons, CRITICAL, surface.backend, entries, targets, surface.edit((0, 0, 0), initial_volume))
+        np.testing.assert_array_equal(reasons, initial_reasons)
+        # edits that do not lie inside the volume
+        for lower, values in [((-5, 10, 10), np.ones((1, 1, 1))), ((500, 500, 500), np.ones((1, 1, 1))), ((18, 0, 0), np.ones((3, 1, 1))), ((0, 0, 0), np.ones((2, 2)))]:
+            with self.assertRaises(ValueError):
+                surface.edit(lower, values)
+        # the edits are written into a copy, not into the mask given to the surface
+        self.assertIsInstance(bricked.mask.array, np.memmap)
+        np.testing.assert_array_equal(initial.array, before)
+
+    def test_pareto_ranking(self):
+        """
+        Test the fronts of the non-dominated sort against peeling the non-dominated solutions by brute force, with many
+        ties, the ranking and the objectives of trajectories, and that no densely sampled trajectory is ranked with a
+        cortex angle of 0 while it crosses the cortex
+        """
+        rng = np.random.default_rng(0)
+        maximise = np.array([True, True, False, False])
+        objectives = rng.integers(0, 5, (300, 4)).astype(np.float64)
+        costs = np.where(maximise, -objectives, objectives)
+        dominates = (costs[:, None] <= costs[None]).all(axis=2) & (costs[:, None] < costs[None]).any(axis=2)
+        expected, left, front = np.full(300, -1), np.ones(300, dtype=bool), 0
+        while left.any():
+            current = left & ~dominates[left].any(axis=0)
+            expected[current] = front
+            left &= ~current
+            front += 1
+        np.testing.assert_array_equal(non_dominated_sort(objectives, maximise), expected)
+
+        order, fronts, scores = rank_trajectories(objectives, [1, 1, 1, 1], maximise)
+        np.testing.assert_array_equal(fronts, expected)
+        self.assertTrue((np.diff(fronts[order]) >= 0).all())
+        same = np.diff(fronts[order]) == 0
+        self.assertTrue((np.diff(scores[order])[same] >= 0).all())
+        # with all the weight on the length, the shortest trajectory of the front comes first
+        order, fronts, _ = rank_trajectories(objectives, [0, 0, 1, 0], maximise)
+        self.assertEqual(objectives[order[0], 2], objectives[fronts == 0, 2].min())
+
+        volume = np.zeros((20, 20, 20), dtype=np.uint8)
+        volume[8:12, 8:12, 8:12] = 1
+        field = DistanceField(crop_mask(volume), (1, 1, 1), 10.0)
+        verts, faces, _, _ = marching_cubes(volume, 0.5)
+        cortex = make_backend("bvh", Mesh(verts, faces))
+        entries, targets = np.array([[2.0, 10, 10], [2.0, 2, 2]]), np.array([[18.0, 10, 10], [2.0, 2, 18]])
+        result = trajectory_objectives(entries, targets, (1, 1, 1), field, field, cortex)
+        self.assertEqual(result.shape, (2, 4))
+        np.testing.assert_array_equal(result[:, 0], result[:, 1])
+        self.assertEqual(result[0, 0], 0.0)
+        self.assertGreater(result[1, 0], 5.0)
+        np.testing.assert_allclose(result[:, 2], [16.0, 16.0])
+        self.assertAlmostEqual(result[0, 3], cortex.angle(entries[0], targets[0]))
+
+        # entries sampled just outside a ball of cortex, like dense_sampling.py, to targets inside the cube
+        rng = np.random.default_rng(0)
+        ball = (np.square(np.indices((20, 20, 20)) - 9.5).sum(axis=0) < 49).astype(np.uint8)
+        verts, faces, _, _ = marching_cubes_cropped(crop_mask(ball), 0.5)
+        cortex = make_backend("bvh", Mesh(verts, faces))
+        entries = sample_surface(cortex.mesh, 300, rng, offset=1.0, mask=crop_mask(ball))
+        targets = sample_mask(crop_mask(volume), 300, rng)
+        objectives = trajectory_objectives(entries, targets, (1, 1, 1), field, field, cortex)
+        order, _, _ = rank_trajectories(objectives, [1, 1, 1, 1])
+        crosses = cortex.intersects_batch(entries[order], targets[order])
+        self.assertTrue(crosses.all())
+        self.assertTrue((objectives[order, 3][crosses] > 0).all())
+
+    def test_differential_oracle(self):
+        """
+        Test that every exact engine gives the answers of the brute force on random phantoms and edge-case segments,
+        that a failing case shrinks to a single face, and that segments ending on a face are ties
+        """
+        names = [i for i in ENGINES if i not in APPROXIMATE_ENGINES]
+        report, reproducers = run_campaign(1, 10, np.random.default_rng(0), names)
+        self.assertEqual(report.iloc[:-1][list(SEGMENT_KINDS)].to_numpy().sum(), 0, report.to_string())
+        self.assertEqual(sum(len(i) for i in reproducers.values()), 0)
+
+        # an engine that forgets the last face
+        def fails(verts, faces, p1, p2):
+            mesh = Mesh(verts, faces)
+            forgetful = make_backend("numba", Mesh(verts, faces[:-1])).intersects(p1, p2) if len(faces) > 1 else False
+            return reference_answers(mesh, p1[None], p2[None])[0][0] != forgetful
+
+        verts, faces, _, _ = marching_cubes(np.pad(np.ones((4, 4, 4), dtype=np.uint8), 2), 0.5)
+        p1, p2 = verts[faces[-1]].mean(axis=0) + [0.1, 0.2, 3.0], verts[faces[-1]].mean(axis=0) - [0.1, 0.2, 3.0]
+        self.assertTrue(fails(verts, faces, p1, p2))
+        verts, faces, p1, p2 = shrink(verts, faces, p1, p2, fails)
+        self.assertEqual(faces.shape, (1, 3))
+        self.assertEqual(len(verts), 3)
+        self.assertTrue(fails(verts, faces, p1, p2))
+
+        verts, faces = np.array([[0.0, 0, 0], [1, 0, 0], [0, 1, 0]]), np.array([[0, 1, 2]])
+        p1s = np.array([[0.2, 0.2, 1.0], [0.2, 0.2, 1.0], [5.0, 5.0, 1.0]])
+        p2s = np.array([[0.2, 0.2, 0.0], [0.2, 0.2, -1.0], [5.0, 5.0, -1.0]])
+        np.testing.assert_array_equal(near_boundary(p1s, p2s, verts, faces, 1e-7), [True, False, False])
+
+    def test_sweep_culling(self):
+        """
+        Test that a backend culled to the convex hull of the entries and targets keeps fewer triangles and answers like
+        one of the whole mesh, also for capsules, and that it culls again when asked about points outside of the hull
+        """
+        grid = np.indices((24, 24, 24)).transpose(1, 2, 3, 0)
+        ball = (np.linalg.norm(grid - 11.5, axis=-1) < 10).astype(np.uint8)
+        verts, faces, _, _ = marching_cubes(ball, 0.5)
+        mesh = Mesh(verts, faces)
+        whole = make_backend("bvh", mesh)
+        rng = np.random.default_rng(0)
+        entries = rng.uniform([0, 0, 0], [6, 6, 23], size=(10, 3))
+        targets = rng.uniform([8, 8, 8], [12, 12, 12], size=(15, 3))
+        backend = SweepBackend("bvh", mesh, np.concatenate([entries, targets]), 1.5, (1, 1, 2))
+        self.assertLess(len(backend.culled), len(mesh) / 2)
+        for entry in entries:
+            np.testing.assert_array_equal(backend.intersects_packet(entry, targets), whole.intersects_packet(entry, targets))
+            np.testing.assert_array_equal(backend.angle_packet(entry, targets), whole.angle_packet(entry, targets))
+            np.testing.assert_array_equal(backend.capsule_packet(entry, targets, 1.5, (1, 1, 2)), whole.capsule_packet(entry, targets, 1.5, (1, 1, 2)))
+        self.assertEqual(backend.culls, 1)
+
+        # a fiducial moved to the other side
+        entry, moved = np.array([23.0, 23.0, 2.0]), backend.culled
+        self.assertEqual(backend.angle(entry, targets[0]), whole.angle(entry, targets[0]))
+        self.assertEqual(backend.culls, 2)
+        self.assertGreater(len(backend.culled), len(moved))
+
+        # flat points have no hull, their bounding box is used; culling keeps the order of the faces
+        planes, _ = sweep_hull([[0, 0, 0], [4, 0, 0], [0, 4, 0]])
+        self.assertEqual(planes.shape, (6, 4))
+        culled = cull_mesh(mesh, planes, 0.5)
+        self.assertLess(len(culled), len(mesh))
+        kept = [tuple(i) for i in mesh.verts[mesh.faces].reshape(-1, 9)]
+        positions = [kept.index(tuple(i)) for i in culled.verts[culled.faces].reshape(-1, 9)]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_normal_field(self):
+        """
+        Test that the angles of the normal field of a sphere are those of its radial normal, steadier than those of the triangles of its marching cubes, and the same when computed brick by brick
+        """
+        center, radius = np.array([20.0, 20.0, 20.0]), 12
+        mask = crop_mask(np.linalg.norm(np.indices((40, 40, 40)).transpose(1, 2, 3, 0) - center, axis=-1) <= radius)
+        field = NormalField(mask, (1, 1, 1))
+        bricked = NormalField(mask, (1, 1, 1), memory_budget=2**17)
+        np.testing.assert_array_equal(field.array, bricked.array)
+        np.testing.assert_array_equal(field.gradient, bricked.gradient)
+
+        rng = np.random.default_rng(0)
+        directions = rng.normal(size=(500, 3))
+        entries = center + 19 * directions / np.linalg.norm(directions, axis=1)[:, None]
+        targets = center + rng.uniform(-3, 3, size=(500, 3))
+        crossings = field.crossings(entries, targets)
+        np.testing.assert_allclose(np.linalg.norm(crossings - center, axis=1), radius, atol=0.5)
+        d, normals = targets - entries, crossings - center
+        expected = np.degrees(np.arccos(np.abs((d * normals).sum(1)) / np.linalg.norm(d, axis=1) / np.linalg.norm(normals, axis=1)))
+        angles = field.angle_batch(entries, targets)
+        mesh_angles = make_backend("bvh", Mesh(*marching_cubes(mask.full().astype(np.float64), 0.5)[:2])).angle_batch(entries, targets)
+        self.assertLess(np.abs(angles - expected).max(), 10)
+        self.assertLess(np.abs(angles - expected).mean(), np.abs(mesh_angles - expected).mean() / 2)
+        np.testing.assert_array_equal(field.angle_packet(entries[0], targets), field.angle_batch(np.repeat(entries[:1], 500, axis=0), targets))
+        self.assertEqual(field.angle(entries[0], targets[0]), angles[0])
+
+        # segments inside or outside of the sphere do not cross it, the field is in mm
+        self.assertEqual(field.angle(center, center + [3.0, 0.0, 0.0]), 0.0)
+        self.assertTrue(np.isnan(field.crossings([0.0, 0.0, 0.0], [0.0, 39.0, 0.0])).all())
+        stretched = NormalField(mask, (1, 1, 2))
+        self.assertAlmostEqual(stretched.angle([20.0, 20.0, 39.0], [20.0, 20.0, 20.0]), 0.0, delta=1e-3)
+        self.assertAlmostEqual(stretched.angle(center + [19.0, 0.0, 19.0], center), np.degrees(np.arccos(0.8)), delta=3)
+
 
 if __name__ == "__main__":
     unittest.main()